@@ -0,0 +1,455 @@
+'''
+Benchmarks for RA-CNN training and inference. Reads the same config.ini
+as train_RA_CNN.py; run, e.g.:
+
+    python benchmark_RA_CNN.py --inifile=/path/to/movies_config.ini --benchmark=masking
+
+For the list of benchmarks and arguments, use:
+
+    python benchmark_RA_CNN.py -h
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import subprocess
+import time
+import random
+random.seed(1337)
+import configparser
+import optparse
+
+import numpy as np
+from sklearn.metrics import f1_score
+
+import rationale_CNN
+import train_RA_CNN
+import numpy_RA_CNN
+import cascade_RA_CNN
+
+
+def evaluate_docs(r_CNN, documents, batch_size=256):
+    '''
+    returns (F, docs/sec) of r_CNN on the given documents, with F
+    computed on thresholded (.5) document predictions.
+    '''
+    start = time.time()
+    doc_preds = r_CNN.predict_docs(documents, batch_size=batch_size)[0]
+    elapsed = time.time() - start
+
+    y = np.array([d.doc_y for d in documents])
+    return f1_score(y, doc_preds > .5), len(documents) / elapsed
+
+
+def benchmark_masking(data_path, wvs_path, max_doc_lens=(50, 200, 500), val_split=.1, **train_kwargs):
+    '''
+    Compare training time, inference throughput and validation F with and
+    without padded-sentence masking, at each of max_doc_lens.
+    '''
+    documents = train_RA_CNN.read_data(path=data_path)
+    random.shuffle(documents)
+    validation_documents = documents[-int(val_split*len(documents)):]
+
+    results = []
+    for max_doc_len in max_doc_lens:
+        for mask_padding in (False, True):
+            print("\n-- max_doc_len: %s, mask_padding: %s --" % (max_doc_len, mask_padding))
+            start = time.time()
+            r_CNN, _, _ = train_RA_CNN.train_CNN_rationales_model(data_path, wvs_path,
+                                documents=documents, val_split=val_split,
+                                max_doc_len=max_doc_len, mask_padding=mask_padding,
+                                **train_kwargs)
+            train_time = time.time() - start
+
+            val_f, docs_per_sec = evaluate_docs(r_CNN, validation_documents)
+            results.append((max_doc_len, mask_padding, train_time, docs_per_sec, val_f))
+
+    print("\nmax_doc_len\tmask_padding\ttrain secs\tdocs/sec\tval F")
+    for result in results:
+        print("%s\t%s\t%.1f\t%.1f\t%.4f" % result)
+    return results
+
+
+def benchmark_cascade(data_path, wvs_path, val_split=.1, screen_filters=8, band=(.2, .8), 
+                        batch_size=256, **train_kwargs):
+    '''
+    Train a small doc-CNN (screen_filters filters per n-gram) and an RA-CNN,
+    then compare, on the held-out documents, the full RA-CNN alone against 
+    the cascade (see cascade_RA_CNN): the fraction of documents routed to 
+    the RA-CNN, end-to-end throughput and F.
+    '''
+    documents = train_RA_CNN.read_data(path=data_path)
+    random.shuffle(documents)
+    validation_documents = documents[-int(val_split*len(documents)):]
+
+    screen_CNN, _, _ = train_RA_CNN.train_CNN_rationales_model(data_path, wvs_path,
+                            documents=documents, val_split=val_split, model_name="doc-CNN",
+                            n_filters=screen_filters, **train_kwargs)
+    r_CNN, _, _ = train_RA_CNN.train_CNN_rationales_model(data_path, wvs_path,
+                            documents=documents, val_split=val_split, **train_kwargs)
+    cascade = cascade_RA_CNN.CascadePredictor(screen_CNN, r_CNN, band=band)
+
+    # warm up (compiles the prediction functions)
+    for model in (screen_CNN, r_CNN):
+        model.predict_docs(validation_documents[:batch_size])
+
+    y = np.array([d.doc_y for d in validation_documents])
+    results = []
+    for name, model in (("RA-CNN", r_CNN), ("cascade", cascade)):
+        start = time.time()
+        ranked = model.predict_and_rank_sentences_for_docs(validation_documents, batch_size=batch_size)
+        elapsed = time.time() - start
+        doc_preds = np.array([doc_pred for doc_pred, _ in ranked])
+        results.append((name, elapsed, len(validation_documents) / elapsed, f1_score(y, doc_preds > .5)))
+
+    print("\nrouted %.3f of %s held-out documents (band: %s)" % 
+            (cascade.routed_fraction(), len(validation_documents), band))
+    print("model\tsecs\tdocs/sec\tval F")
+    for result in results:
+        print("%s\t%.2f\t%.1f\t%.4f" % result)
+    print("speedup: %.2fx" % (results[0][1] / results[1][1]))
+    return cascade.routed_fraction(), results
+
+
+def time_train_steps(model, X, y, batch_size=50, n_steps=20):
+    ''' mean secs per train_on_batch call over n_steps minibatches of (X, y) '''
+    # one warm-up step, which includes compiling the training function
+    model.train_on_batch(X[:batch_size], y[:batch_size])
+    start = time.time()
+    for step in range(n_steps):
+        batch = np.arange(step*batch_size, (step+1)*batch_size) % X.shape[0]
+        model.train_on_batch(X[batch], y[batch])
+    return (time.time() - start) / n_steps
+
+
+def benchmark_embeddings(data_path, wvs_path, val_split=.1, batch_size=50, **train_kwargs):
+    '''
+    Compare per-step document model training time, total training time and 
+    validation F with tuned (as usual) and frozen word embeddings.
+    '''
+    documents = train_RA_CNN.read_data(path=data_path)
+    random.shuffle(documents)
+    validation_documents = documents[-int(val_split*len(documents)):]
+
+    results = []
+    for freeze_embeddings in (False, True):
+        print("\n-- freeze_embeddings: %s --" % freeze_embeddings)
+        start = time.time()
+        r_CNN, _, p = train_RA_CNN.train_CNN_rationales_model(data_path, wvs_path,
+                            documents=documents, val_split=val_split, batch_size=batch_size,
+                            freeze_embeddings=freeze_embeddings, **train_kwargs)
+        train_time = time.time() - start
+
+        val_f, _ = evaluate_docs(r_CNN, validation_documents)
+
+        # note that this updates the model, so comes after evaluation
+        X = np.array([d.get_padded_sequences(p, labels_too=False) for d in documents])
+        y = np.array([d.doc_y for d in documents])
+        step_time = time_train_steps(r_CNN.doc_model, X, y, batch_size=batch_size)
+        results.append((freeze_embeddings, step_time * 1000, train_time, val_f))
+
+    print("\nfreeze_embeddings\tms/step\ttrain secs\tval F")
+    for result in results:
+        print("%s\t%.1f\t%.1f\t%.4f" % result)
+    return results
+
+
+def preprocess_docs(data_path, max_features, max_sent_len, max_doc_len, n_docs):
+    ''' the first n_docs documents, with sequences built by a Preprocessor fit to them '''
+    documents = train_RA_CNN.read_data(path=data_path)[:n_docs]
+    all_sentences = []
+    for d in documents:
+        all_sentences.extend(d.sentences)
+    p = rationale_CNN.Preprocessor(max_features=max_features, max_sent_len=max_sent_len, 
+                                    max_doc_len=max_doc_len)
+    p.preprocess(all_sentences)
+    p.generate_document_sequences(documents)
+    return documents, p
+
+
+def benchmark_encoder(data_path, max_features=20000, max_sent_len=10, max_doc_len=200, 
+                        n_docs=1000, batch_size=50):
+    '''
+    Compare inference throughput and training step time of the conv2d and 
+    conv1d sentence encoders (on an untrained RA-CNN), after checking that 
+    the conv1d model, loaded with the conv2d model's weights, makes the 
+    same predictions.
+    '''
+    documents, p = preprocess_docs(data_path, max_features, max_sent_len, max_doc_len, n_docs)
+
+    X = np.array([d.get_padded_sequences(p, labels_too=False) for d in documents])
+    y = np.array([d.doc_y for d in documents])
+
+    weights_path = "encoder-benchmark-weights.hdf5"
+    results, predictions = [], []
+    for encoder in ("conv2d", "conv1d"):
+        print("\n-- encoder: %s --" % encoder)
+        r_CNN = rationale_CNN.RationaleCNN(p, filters=[1,2,3], encoder=encoder)
+        r_CNN.build_RA_CNN_model()
+        if encoder == "conv2d":
+            r_CNN.doc_model.save_weights(weights_path, overwrite=True)
+        else:
+            r_CNN.load_doc_model_weights(weights_path)
+
+        # warm up (compiles the prediction function)
+        r_CNN.predict_docs(documents[:batch_size])
+        start = time.time()
+        doc_preds, sent_preds = r_CNN.predict_docs(documents)[:2]
+        docs_per_sec = len(documents) / (time.time() - start)
+        predictions.append((doc_preds, sent_preds))
+
+        step_time = time_train_steps(r_CNN.doc_model, X, y, batch_size=batch_size)
+        results.append((encoder, docs_per_sec, step_time * 1000))
+    os.remove(weights_path)
+
+    max_diff = max(np.max(np.abs(a - b)) for a, b in zip(*predictions))
+    print("\nmax absolute difference in predictions: %s" % max_diff)
+    assert max_diff < 1e-4, "encoders disagree!"
+
+    print("encoder\tdocs/sec\tms/step")
+    for result in results:
+        print("%s\t%.1f\t%.1f" % result)
+    return results
+
+
+def benchmark_numpy(data_path, max_features=20000, max_sent_len=10, max_doc_len=200, 
+                        n_docs=1000, batch_size=256, weights_path=None):
+    '''
+    Compare predict_and_rank_sentences_for_docs throughput of RationaleCNN and
+    of the NumPy engine (numpy_RA_CNN), and check that they agree. If 
+    weights_path is None, an untrained RA-CNN's (saved) weights are used.
+    '''
+    documents, p = preprocess_docs(data_path, max_features, max_sent_len, max_doc_len, n_docs)
+
+    r_CNN = rationale_CNN.RationaleCNN(p, filters=[1,2,3])
+    r_CNN.build_RA_CNN_model()
+    if weights_path is None:
+        weights_path = "numpy-benchmark-weights.hdf5"
+        r_CNN.doc_model.save_weights(weights_path, overwrite=True)
+    else:
+        r_CNN.load_doc_model_weights(weights_path)
+
+    start = time.time()
+    np_CNN = numpy_RA_CNN.NumpyRationaleCNN(weights_path, p)
+    print("loaded numpy model in %.2f secs" % (time.time() - start))
+
+    # warm up (compiles the prediction function)
+    r_CNN.predict_docs(documents[:batch_size])
+
+    results = []
+    for name, model in (("keras", r_CNN), ("numpy", np_CNN)):
+        start = time.time()
+        ranked = model.predict_and_rank_sentences_for_docs(documents, batch_size=batch_size)
+        results.append((name, len(documents) / (time.time() - start), ranked))
+
+    if weights_path == "numpy-benchmark-weights.hdf5":
+        os.remove(weights_path)
+
+    (_, _, keras_ranked), (_, _, numpy_ranked) = results
+    max_diff = max(abs(k_pred - n_pred) for (k_pred, _), (n_pred, _) in zip(keras_ranked, numpy_ranked))
+    n_same = sum(k_r == n_r for (_, k_r), (_, n_r) in zip(keras_ranked, numpy_ranked))
+    print("\nmax absolute difference in doc predictions: %s" % max_diff)
+    print("identical rationales for %s/%s docs" % (n_same, len(documents)))
+    assert max_diff < 1e-4, "numpy predictions differ!"
+
+    print("engine\tdocs/sec")
+    for name, docs_per_sec, _ in results:
+        print("%s\t%.1f" % (name, docs_per_sec))
+    return [result[:2] for result in results]
+
+
+def benchmark_sentence_cache(data_path, max_features=20000, max_sent_len=10, max_doc_len=200, 
+                                n_docs=1000, batch_size=256, weights_path=None, cache_size=100000):
+    '''
+    Compare predict_docs throughput with and without the sentence cache, for
+    the keras and NumPy engines: a cold pass over the documents (hits are 
+    sentences repeated across documents) and a warm pass (re-scoring them).
+    Checks that cached and uncached predictions agree.
+    '''
+    documents, p = preprocess_docs(data_path, max_features, max_sent_len, max_doc_len, n_docs)
+
+    r_CNN = rationale_CNN.RationaleCNN(p, filters=[1,2,3])
+    r_CNN.build_RA_CNN_model()
+    if weights_path is None:
+        weights_path = "cache-benchmark-weights.hdf5"
+        r_CNN.doc_model.save_weights(weights_path, overwrite=True)
+    else:
+        r_CNN.load_doc_model_weights(weights_path)
+    np_CNN = numpy_RA_CNN.NumpyRationaleCNN(weights_path, p)
+
+    if weights_path == "cache-benchmark-weights.hdf5":
+        os.remove(weights_path)
+
+    # warm up (compiles the prediction functions)
+    r_CNN.predict_docs(documents[:batch_size])
+    r_CNN.encode_sentence_rows(np.zeros((1, max_sent_len), dtype="int32"))
+
+    results = []
+    for name, model in (("keras", r_CNN), ("numpy", np_CNN)):
+        model.sentence_cache = None
+        start = time.time()
+        doc_preds = model.predict_docs(documents, batch_size=batch_size)[0]
+        results.append((name, "none", len(documents) / (time.time() - start), None))
+
+        model.sentence_cache = numpy_RA_CNN.SentenceCache(cache_size)
+        for run in ("cold", "warm"):
+            start = time.time()
+            cached_doc_preds = model.predict_docs(documents, batch_size=batch_size)[0]
+            results.append((name, run, len(documents) / (time.time() - start), model.sentence_cache.hit_rate()))
+            max_diff = np.abs(cached_doc_preds - doc_preds).max()
+            assert max_diff < 1e-4, "cached %s predictions differ (by %s)!" % (name, max_diff)
+        model.sentence_cache = None
+
+    print("engine\tcache\tdocs/sec\thit rate (cumulative)")
+    for name, run, docs_per_sec, hit_rate in results:
+        print("%s\t%s\t%.1f\t%s" % (name, run, docs_per_sec, 
+                                        "-" if hit_rate is None else "%.3f" % hit_rate))
+    return results
+
+
+def benchmark_imports():
+    '''
+    Time (in fresh interpreters) importing rationale_CNN for preprocessing 
+    only, and then importing keras for modeling; fails if the former loads
+    keras.
+    '''
+    probe = ("import json, resource, sys, time; start = time.time(); %s; "
+             "print(json.dumps([time.time() - start, 'keras' in sys.modules, "
+             "resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))")
+    statements = [("preprocessing", "from rationale_CNN import Preprocessor, Document"),
+                  ("model", "import rationale_CNN; rationale_CNN.import_keras()")]
+
+    results = []
+    for name, statement in statements:
+        output = subprocess.check_output([sys.executable, "-c", probe % statement])
+        secs, keras_loaded, max_rss = json.loads(output.decode("utf8").strip().split("\n")[-1])
+        results.append((name, secs, keras_loaded, max_rss))
+
+    print("import\tsecs\tkeras loaded\tmax RSS")
+    for result in results:
+        print("%s\t%.2f\t%s\t%s" % result)
+    assert not results[0][2], "importing Preprocessor and Document loaded keras!"
+    return results
+
+
+def benchmark_preprocessing(data_path, max_features=20000, max_sent_len=10, stopword=True):
+    '''
+    Time Preprocessor.build_sequences against the reference keras pipeline 
+    (remove_stopwords -> texts_to_sequences -> pad_sequences) and check
+    that both produce identical output (and vocabularies).
+    '''
+    from keras.preprocessing.sequence import pad_sequences
+    from keras.preprocessing.text import Tokenizer
+
+    documents = train_RA_CNN.read_data(path=data_path)
+    all_sentences = []
+    for d in documents:
+        all_sentences.extend(d.sentences)
+
+    p = rationale_CNN.Preprocessor(max_features=max_features, max_sent_len=max_sent_len, 
+                                    stopword=stopword)
+    start = time.time()
+    p.preprocess(all_sentences)
+    print("fit tokenizer on %s sentences in %.2f secs" % (len(all_sentences), time.time() - start))
+
+    processed = p.remove_stopwords(all_sentences) if stopword else all_sentences
+    keras_tokenizer = Tokenizer(num_words=max_features)
+    keras_tokenizer.fit_on_texts(processed)
+    assert keras_tokenizer.word_index == p.tokenizer.word_index, "vocabulary differs from keras!"
+
+    start = time.time()
+    X_ref = np.array(pad_sequences(list(keras_tokenizer.texts_to_sequences_generator(processed)), 
+                                   maxlen=max_sent_len))
+    ref_time = time.time() - start
+
+    start = time.time()
+    X = p.build_sequences(all_sentences)
+    fused_time = time.time() - start
+
+    print("keras pipeline: %.2f secs; fused build_sequences: %.2f secs" % (ref_time, fused_time))
+    assert X.dtype == np.int32 and np.array_equal(X, X_ref), "build_sequences output differs from keras!"
+    print("outputs identical.")
+
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-i', '--inifile',
+        action="store", dest="inifile",
+        help="path to .ini file", default="config.ini")
+
+    parser.add_option('-b', '--benchmark', dest="benchmark",
+        help="benchmark to run; one of {masking, preprocessing, embeddings, encoder, numpy, sentence-cache, cascade, imports}",
+        default="masking")
+
+    parser.add_option('-w', '--weights', dest="weights_path",
+        help="trained doc_model weights to use for the numpy and sentence-cache benchmarks (default: untrained)",
+        default=None)
+
+    parser.add_option('--band', dest="band",
+        help="comma-separated (lower, upper) screening probabilities routed to the RA-CNN, for the cascade benchmark",
+        default="0.2,0.8")
+
+    parser.add_option('--sf', '--screen-filters', dest="screen_filters",
+        help="number of filters (per n-gram) of the screening doc-CNN, for the cascade benchmark",
+        default=8, type="int")
+
+    parser.add_option('--se', '--sentence-epochs', dest="sentence_nb_epochs",
+        help="number of epochs to (pre-)train sentence model for",
+        default=5, type="int")
+
+    parser.add_option('--de', '--document-epochs', dest="document_nb_epochs",
+        help="number of epochs to train the document model for",
+        default=5, type="int")
+
+    parser.add_option('--mdls', '--max-doc-lengths', dest="max_doc_lens",
+        help="comma-separated maximum document lengths to compare",
+        default="50,200,500")
+
+    parser.add_option('--msl', '--max-sent-length', dest="max_sent_len",
+        help="maximum length (in tokens) of a given sentence",
+        default=10, type="int")
+
+    parser.add_option('--mf', '--max-features', dest="max_features",
+        help="maximum number of unique tokens",
+        default=20000, type="int")
+
+    (options, args) = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    print("reading config file: %s" % options.inifile)
+    config.read(options.inifile)
+    data_path = config['paths']['data_path']
+    wv_path   = config['paths']['word_vectors_path']
+
+    train_kwargs = dict(nb_epoch_sentences=options.sentence_nb_epochs,
+                        nb_epoch_doc=options.document_nb_epochs,
+                        max_sent_len=options.max_sent_len,
+                        max_features=options.max_features)
+
+    if options.benchmark == "masking":
+        max_doc_lens = [int(l) for l in options.max_doc_lens.split(",")]
+        benchmark_masking(data_path, wv_path, max_doc_lens=max_doc_lens, **train_kwargs)
+    elif options.benchmark == "preprocessing":
+        benchmark_preprocessing(data_path, max_features=options.max_features, 
+                                max_sent_len=options.max_sent_len)
+    elif options.benchmark == "embeddings":
+        benchmark_embeddings(data_path, wv_path, **train_kwargs)
+    elif options.benchmark == "encoder":
+        benchmark_encoder(data_path, max_features=options.max_features, 
+                            max_sent_len=options.max_sent_len)
+    elif options.benchmark == "numpy":
+        benchmark_numpy(data_path, max_features=options.max_features, 
+                            max_sent_len=options.max_sent_len, weights_path=options.weights_path)
+    elif options.benchmark == "sentence-cache":
+        benchmark_sentence_cache(data_path, max_features=options.max_features, 
+                            max_sent_len=options.max_sent_len, weights_path=options.weights_path)
+    elif options.benchmark == "cascade":
+        band = tuple(float(b) for b in options.band.split(","))
+        benchmark_cascade(data_path, wv_path, screen_filters=options.screen_filters, band=band, 
+                            **train_kwargs)
+    elif options.benchmark == "imports":
+        benchmark_imports()
+    else:
+        print("unknown benchmark: %s" % options.benchmark)
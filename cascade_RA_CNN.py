@@ -0,0 +1,70 @@
+'''
+Cascade inference: a cheap screening model (e.g., a doc-CNN with few
+filters) scores every document, and only those whose screening probability
+falls inside an uncertainty band are passed to the full RA-CNN for
+(re-)prediction and rationale ranking. E.g.,
+
+    cascade = CascadePredictor(doc_CNN, r_CNN, band=(0.2, 0.8))
+    results = cascade.predict_and_rank_sentences_for_docs(docs, num_rationales=3)
+    print(cascade.routed_fraction())
+
+Documents outside the band get the screening probability and no rationales.
+To also extract rationales for every document flagged positive, extend the
+band to 1, e.g., band=(0.3, 1.0). Either model may be a RationaleCNN or a
+NumpyRationaleCNN; see benchmark_RA_CNN.py --benchmark=cascade for the
+fraction routed and the speedup on held-out data.
+'''
+import numpy as np
+
+
+class CascadePredictor:
+
+    def __init__(self, screen_model, full_model, band=(0.2, 0.8)):
+        '''
+        screen_model: a model whose predict_docs returns document probabilities
+                    (doc-CNN or RA-CNN)
+        full_model: an RA-CNN
+        band: (lower, upper) screening probabilities (inclusive) for which
+                    documents are routed to full_model
+
+        The models must share their preprocessing (vocabulary and lengths),
+        as Document instances cache their token sequences.
+        '''
+        screen_p, full_p = screen_model.preprocessor, full_model.preprocessor
+        assert (screen_p.get_settings() == full_p.get_settings() and
+                screen_p.tokenizer.word_index == full_p.tokenizer.word_index), \
+                    "the screening and full models must use the same preprocessing!"
+
+        self.screen_model = screen_model
+        self.full_model = full_model
+        self.band = band
+        self.n_docs, self.n_routed = 0, 0
+
+    def routed_fraction(self):
+        ''' the fraction of documents scored so far that were routed to the full model '''
+        return self.n_routed / float(self.n_docs) if self.n_docs > 0 else 0.
+
+    def route(self, screen_preds):
+        lower, upper = self.band
+        return (screen_preds >= lower) & (screen_preds <= upper)
+
+    def predict_and_rank_sentences_for_docs(self, docs, batch_size=256, num_rationales=3, threshold=0):
+        '''
+        as per RationaleCNN.predict_and_rank_sentences_for_docs: returns a list
+        of (doc_pred, rationales) tuples in the same order as docs, where
+        rationales is empty for documents that were not routed
+        '''
+        screen_preds = self.screen_model.predict_docs(docs, batch_size=batch_size)[0]
+        routed = np.flatnonzero(self.route(screen_preds))
+
+        results = [(doc_pred, []) for doc_pred in screen_preds]
+        if len(routed) > 0:
+            full_results = self.full_model.predict_and_rank_sentences_for_docs(
+                                [docs[i] for i in routed], batch_size=batch_size,
+                                num_rationales=num_rationales, threshold=threshold)
+            for i, result in zip(routed, full_results):
+                results[i] = result
+
+        self.n_docs += len(docs)
+        self.n_routed += len(routed)
+        return results
@@ -0,0 +1,118 @@
+'''
+Load test a running serve_RA_CNN.py server on localhost, e.g.,
+
+    python loadtest_RA_CNN.py --input=corpus.csv --port=8000 --concurrency=32 --requests=5000
+
+Each of concurrency clients sends documents from the input CSV (as per
+score_RA_CNN.py; cycled as need be) one at a time, over a kept-alive
+connection. Reports client-side throughput and p50/p99 latency, then the
+server's own metrics.
+'''
+import json
+import time
+import asyncio
+import optparse
+import itertools
+
+import numpy as np
+
+from score_RA_CNN import iter_sentences
+
+
+async def open_connection(host, port, unix_socket):
+    if unix_socket is not None:
+        return await asyncio.open_unix_connection(unix_socket)
+    return await asyncio.open_connection(host, port)
+
+async def request(reader, writer, method, path, payload=None):
+    ''' returns (status code, response JSON) '''
+    body = b"" if payload is None else json.dumps(payload).encode("utf8")
+    writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                  "Content-Length: %s\r\n\r\n" % (method, path, len(body))).encode("latin-1") + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split(b" ")[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        if name.strip().lower() == "content-length":
+            content_length = int(value)
+    return status, json.loads((await reader.readexactly(content_length)).decode("utf8"))
+
+async def client(docs, n_requests, latencies, errors, host, port, unix_socket, num_rationales):
+    reader, writer = await open_connection(host, port, unix_socket)
+    for _ in range(n_requests):
+        _, sentences = next(docs)
+        start = time.time()
+        status, _ = await request(reader, writer, "POST", "/predict",
+                                  {"sentences": sentences, "num_rationales": num_rationales})
+        latencies.append(time.time() - start)
+        if status != 200:
+            errors.append(status)
+    writer.close()
+
+async def load_test(input_path, host="127.0.0.1", port=8000, unix_socket=None,
+                        concurrency=32, n_requests=5000, num_rationales=3):
+    # (shared by all clients; the event loop is single threaded)
+    docs = itertools.cycle(list(itertools.islice(iter_sentences(input_path), n_requests)))
+    latencies, errors = [], []
+    per_client = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+
+    start = time.time()
+    await asyncio.gather(*[client(docs, n, latencies, errors, host, port, unix_socket, num_rationales)
+                            for n in per_client if n > 0])
+    elapsed = time.time() - start
+
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    print("%s requests (%s errors) from %s clients in %.2f secs: %.1f docs/sec" %
+            (len(latencies), len(errors), concurrency, elapsed, len(latencies) / elapsed))
+    print("client latency: p50 %.1f ms, p99 %.1f ms" % (p50, p99))
+
+    reader, writer = await open_connection(host, port, unix_socket)
+    _, metrics = await request(reader, writer, "GET", "/metrics")
+    writer.close()
+    print("server metrics: %s" % json.dumps(metrics, sort_keys=True))
+    return metrics
+
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-i', '--input', dest="input_path",
+        help="CSV of documents to send (doc_id,doc_lbl,sentence_number,sentence,sentence_lbl)")
+
+    parser.add_option('--host', dest="host",
+        help="server host",
+        default="127.0.0.1")
+
+    parser.add_option('--port', dest="port",
+        help="server port",
+        default=8000, type="int")
+
+    parser.add_option('-u', '--unix-socket', dest="unix_socket",
+        help="server Unix socket (rather than host and port)",
+        default=None)
+
+    parser.add_option('-c', '--concurrency', dest="concurrency",
+        help="number of concurrent clients",
+        default=32, type="int")
+
+    parser.add_option('-n', '--requests', dest="n_requests",
+        help="total number of requests to send",
+        default=5000, type="int")
+
+    parser.add_option('-k', '--num-rationales', dest="num_rationales",
+        help="number of rationales to request per document",
+        default=3, type="int")
+
+    (options, args) = parser.parse_args()
+    if options.input_path is None:
+        parser.error("--input is required")
+
+    asyncio.run(load_test(options.input_path, host=options.host, port=options.port,
+                          unix_socket=options.unix_socket, concurrency=options.concurrency,
+                          n_requests=options.n_requests, num_rationales=options.num_rationales))
@@ -0,0 +1,92 @@
+'''
+A single-file, versioned format for trained models ("bundles"), holding
+the model architecture, the raw weight arrays, the (compact) vocabulary
+and the preprocessing and model settings. Weights are stored uncompressed
+and aligned, so that they are memory-mapped on loading rather than read
+in; serving processes on the same host thus share one physical copy of
+them (via the page cache).
+
+The layout is: an 8 byte magic string, the format version and the length
+of the JSON header (as little-endian uint32 and uint64), the header, then
+the weight arrays, each starting at a multiple of ALIGNMENT bytes.
+
+See RationaleCNN.save_bundle, RationaleCNN(bundle_path=...) and
+NumpyRationaleCNN (which accepts bundles, too).
+'''
+import os
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b"RACNNBDL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sIQ")
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def is_bundle(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_bundle(path, architecture, layer_weights, vocabulary, settings):
+    '''
+    architecture: the model JSON (as per to_json)
+    layer_weights: an OrderedDict mapping layer names to lists of weight arrays
+    vocabulary: the words, ordered by token index (starting at 1)
+    settings: a (JSON serializable) dictionary of preprocessing and model settings
+    '''
+    weight_specs, arrays, offset = [], [], 0
+    for layer_name, weights in layer_weights.items():
+        array_specs = []
+        for w in weights:
+            w = np.ascontiguousarray(w)
+            offset = _aligned(offset)
+            array_specs.append({"dtype": w.dtype.str, "shape": list(w.shape), "offset": offset})
+            arrays.append((offset, w))
+            offset += w.nbytes
+        weight_specs.append([layer_name, array_specs])
+
+    header = json.dumps({"architecture": architecture, "settings": settings,
+                         "vocabulary": vocabulary, "weights": weight_specs}).encode("utf8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+
+    # write to a temporary file first, so that a bundle is never half-written
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for array_offset, w in arrays:
+            f.seek(data_start + array_offset)
+            f.write(w.tobytes())
+        # pad, so that the final array is always backed by the file
+        f.truncate(data_start + _aligned(offset))
+    os.rename(tmp_path, path)
+
+def read_bundle(path):
+    '''
+    returns (header, layer_weights): the header dictionary (with keys
+    architecture, settings and vocabulary) and an OrderedDict mapping layer
+    names to lists of read-only weight arrays, memory-mapped from path.
+    '''
+    with open(path, "rb") as f:
+        magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a model bundle!" % path)
+        if version > FORMAT_VERSION:
+            raise ValueError("%s is a version %s bundle; only versions up to %s are supported" %
+                                (path, version, FORMAT_VERSION))
+        header = json.loads(f.read(header_len).decode("utf8"))
+
+    data_start = _aligned(_PREAMBLE.size + header_len)
+    buf = np.memmap(path, dtype=np.uint8, mode="r")
+    layer_weights = OrderedDict()
+    for layer_name, array_specs in header["weights"]:
+        layer_weights[layer_name] = [np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]),
+                                                buffer=buf, offset=data_start + spec["offset"])
+                                        for spec in array_specs]
+    return header, layer_weights
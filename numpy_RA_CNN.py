@@ -0,0 +1,353 @@
+'''
+A NumPy-only implementation of the RA-CNN (and doc-CNN) forward pass, for
+serving trained models without Keras or a backend. Weights are read by layer
+name from the hdf5 file written by doc_model.save_weights (or model.save);
+e.g.,
+
+    from numpy_RA_CNN import NumpyRationaleCNN
+    r_CNN = NumpyRationaleCNN("rationale-CNN_RSG.hdf5", p)
+    results = r_CNN.predict_and_rank_sentences_for_docs(docs, num_rationales=3)
+
+where p is the Preprocessor the model was trained with and docs is a list
+of Document instances. A model bundle (see model_bundle) can be given in
+place of the weights, in which case p may be omitted. Predictions match
+those of RationaleCNN (up to floating point error).
+
+The n-gram convolutions are computed by first projecting the embedding
+table through each filter bank (once, at load time); convolving a sentence
+is then a sum of n_gram table lookups, rather than a dense product over
+embedded tokens.
+'''
+from __future__ import print_function
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+import model_bundle
+
+
+def read_layer_weights(weights_path):
+    '''
+    Read an hdf5 weights file as written by Keras; returns an OrderedDict
+    mapping each layer name (in model order, including layers without
+    weights) to its list of weight arrays, and the backend the weights
+    were saved with (None if this was not recorded).
+    '''
+    import h5py
+
+    def _str(s):
+        return s.decode("utf8") if isinstance(s, bytes) else s
+
+    layer_weights = OrderedDict()
+    with h5py.File(weights_path, "r") as f:
+        if "model_weights" in f:
+            # saved with model.save
+            f = f["model_weights"]
+        backend = _str(f.attrs["backend"]) if "backend" in f.attrs else None
+        for layer_name in f.attrs["layer_names"]:
+            g = f[_str(layer_name)]
+            layer_weights[_str(layer_name)] = [g[_str(weight_name)][()]
+                                                for weight_name in g.attrs["weight_names"]]
+    return layer_weights, backend
+
+def correlation_kernel(kernel, backend):
+    '''
+    theano convolves (i.e., flips kernels along their spatial axes), whereas
+    the other backends cross-correlate; this maps a conv kernel between the
+    two (it is its own inverse). Kernels are (spatial dims..., in, out).
+    '''
+    if backend == "theano":
+        n_spatial = kernel.ndim - 2
+        return kernel[(slice(None, None, -1),) * n_spatial]
+    return kernel
+
+def convert_conv_kernel(kernel, target_shape, embedding_dims, source_backend, target_backend):
+    '''
+    Convert an n-gram filter kernel between the "conv2d" encoder layout,
+    (1, n_gram*embedding_dims, 1, n_filters), and the "conv1d" layout,
+    (n_gram, embedding_dims, n_filters), and/or between backends.
+    '''
+    kernel = correlation_kernel(kernel, source_backend)
+    n_filters = kernel.shape[-1]
+    n_gram = kernel.size // (n_filters * embedding_dims)
+    if len(target_shape) == 3:
+        kernel = kernel.reshape((n_gram, embedding_dims, n_filters))
+    else:
+        kernel = kernel.reshape((1, n_gram*embedding_dims, 1, n_filters))
+    return correlation_kernel(kernel, target_backend)
+
+def rank_rationales(docs, doc_preds, sent_preds, max_doc_len, num_rationales=3, threshold=0):
+    '''
+    Given document predictions and (n_docs x doc_len x 3) sentence predictions
+    for docs, returns a list of (doc_pred, rationales) tuples, with up to
+    num_rationales of each document's sentences (those with the highest
+    probability of supporting the predicted class, and at least threshold).
+    '''
+    # bias_prob = 1 --> low risk
+    # recall: [1, 0, 0] -> positive rationale; [0, 1, 0] -> negative rationale
+    # so we pick neg rationales (column 1) where doc_pred < .5
+    rationale_cols = (doc_preds < .5).astype("int32")
+    scores = sent_preds[np.arange(len(docs)), :, rationale_cols]
+
+    # never pick padded sentences
+    doc_lens = np.minimum([doc.num_sentences for doc in docs], max_doc_len)
+    scores[np.arange(scores.shape[1])[None,:] >= doc_lens[:,None]] = -np.inf
+
+    # top-k per row, in ascending order of score (as per argsort)
+    k = min(num_rationales, scores.shape[1])
+    top_k = np.argsort(scores, axis=1)[:, scores.shape[1]-k:]
+    # padded sentences sort first, so keep each document's last min(k, doc_len)
+    # (which matters when threshold is -inf)
+    keep = ((np.take_along_axis(scores, top_k, axis=1) >= threshold) &
+            (np.arange(k)[None,:] >= k - np.minimum(doc_lens, k)[:,None]))
+
+    results = []
+    for i, doc in enumerate(docs):
+        rationales = [doc.sentences[r_idx] for r_idx in top_k[i][keep[i]]]
+        results.append((doc_preds[i], rationales))
+
+    return results
+
+def rationale_doc_outputs(sent_vectors, sent_preds, X, mask_padding, doc_W, doc_b):
+    '''
+    The document-level part of the RA-CNN forward pass: given sentence vectors
+    and sentence_predictions for the (n_docs x doc_len x max_sent_len) inputs
+    X, returns (doc_preds, sentence_weights, doc_vectors).
+    '''
+    sent_weights = sent_preds[:,:,:2].max(axis=-1)
+    if mask_padding:
+        sent_weights = sent_weights * (X != 0).any(axis=-1)
+
+    doc_vectors = np.einsum("bdf,bd->bf", sent_vectors, sent_weights)
+    doc_preds = sigmoid(doc_vectors.dot(doc_W) + doc_b)[:,0]
+    return doc_preds, sent_weights, doc_vectors
+
+
+class SentenceCache:
+    '''
+    An LRU cache of the per-sentence outputs of a model (sentence vectors and
+    sentence_predictions), keyed by a hash of each padded int32 token row,
+    for corpora that repeat sentences verbatim. Clear it if the model's
+    weights change.
+    '''
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        n_lookups = self.hits + self.misses
+        return self.hits / float(n_lookups) if n_lookups > 0 else 0.
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def sentence_outputs(self, X, encode_rows):
+        '''
+        Sentence vectors and predictions for the (n_docs x doc_len x max_sent_len)
+        inputs X. Only rows not in the cache are computed -- each distinct one
+        once -- by encode_rows, which maps an (n_rows x max_sent_len) matrix to
+        (sentence vectors, sentence predictions) arrays.
+        '''
+        rows = np.ascontiguousarray(X, dtype="int32").reshape(-1, X.shape[-1])
+        keys = [hashlib.sha1(row).digest() for row in rows]
+
+        # the outputs for this batch, by key (which the cache may not
+        # hold on to, if it is smaller than the batch)
+        outputs, missing = {}, OrderedDict()
+        for i, key in enumerate(keys):
+            if key in outputs or key in missing:
+                continue
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                missing[key] = i
+            else:
+                # re-insert, as most recently used
+                self.entries[key] = outputs[key] = entry
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            fresh_vectors, fresh_preds = encode_rows(rows[list(missing.values())])
+            for key, sent_vector, sent_pred in zip(missing, fresh_vectors, fresh_preds):
+                # copies, as rows are views that would keep the whole batch alive
+                self.entries[key] = outputs[key] = (sent_vector.copy(), sent_pred.copy())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        sent_vectors = np.array([outputs[key][0] for key in keys])
+        sent_preds = np.array([outputs[key][1] for key in keys])
+        return (sent_vectors.reshape(X.shape[:2] + sent_vectors.shape[1:]),
+                sent_preds.reshape(X.shape[:2] + sent_preds.shape[1:]))
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+class NumpyRationaleCNN:
+
+    def __init__(self, weights_path, preprocessor=None, sentence_cache_size=None):
+        '''
+        weights_path: doc_model weights, as saved by RationaleCNN training
+                    (either model, either encoder, any backend), or a model
+                    bundle (see model_bundle)
+        preprocessor: the Preprocessor instance the model was trained with;
+                    if None, that of the bundle is used
+        sentence_cache_size: if not None, the per-sentence outputs of (the
+                    rationale) model are cached for up to this many distinct
+                    sentences; see SentenceCache
+        '''
+        if model_bundle.is_bundle(weights_path):
+            header, layer_weights = model_bundle.read_bundle(weights_path)
+            backend = header["settings"]["backend"]
+            if preprocessor is None:
+                # (rationale_CNN imports this module)
+                from rationale_CNN import Preprocessor
+                preprocessor = Preprocessor.from_settings(header["settings"]["preprocessor"], 
+                                                          header["vocabulary"])
+        else:
+            layer_weights, backend = read_layer_weights(weights_path)
+        assert preprocessor is not None, "a preprocessor is required, unless loading a bundle"
+        self.preprocessor = preprocessor
+
+        embeddings = layer_weights["embedding"][0]
+        embedding_dims = embeddings.shape[1]
+
+        # each bank of n-gram filters, as (n_gram x max_features+1 x n_filters)
+        # projected embeddings and bias. These are in model layer order, which
+        # is the order in which their outputs are concatenated.
+        self.filters = []
+        for layer_name, weights in layer_weights.items():
+            if layer_name.startswith("conv2d_"):
+                kernel, bias = weights
+                n_filters = kernel.shape[-1]
+                n_gram = kernel.size // (n_filters * embedding_dims)
+                kernel = convert_conv_kernel(kernel, (n_gram, embedding_dims, n_filters),
+                                             embedding_dims, backend, None)
+                tables = np.einsum("ve,nef->nvf", embeddings, kernel).astype("float32")
+                self.filters.append((tables, bias.astype("float32")))
+
+        # the rationale model weights sentences; the doc-CNN sums them
+        self.rationale_model = "sentence_predictions" in layer_weights
+        self.mask_padding = "sentence_mask" in layer_weights
+        if self.rationale_model:
+            self.sentence_W, self.sentence_b = layer_weights["sentence_predictions"]
+        self.doc_W, self.doc_b = layer_weights["doc_prediction"]
+
+        self.sentence_cache = None
+        if sentence_cache_size is not None and self.rationale_model:
+            self.sentence_cache = SentenceCache(sentence_cache_size)
+
+    def forward(self, X):
+        '''
+        X is a (n_docs x doc_len x max_sent_len) array of token indices;
+        returns (doc_preds, sentence_preds, sentence_weights, doc_vectors).
+        The sentence outputs are None for the doc-CNN model.
+        '''
+        sent_vectors = self.encode_sentences(X)
+        if not self.rationale_model:
+            doc_vectors = sent_vectors.sum(axis=1)
+            return sigmoid(doc_vectors.dot(self.doc_W) + self.doc_b)[:,0], None, None, doc_vectors
+
+        sent_preds = self.predict_sentences(sent_vectors)
+        doc_preds, sent_weights, doc_vectors = rationale_doc_outputs(sent_vectors, sent_preds, X,
+                                                    self.mask_padding, self.doc_W, self.doc_b)
+        return doc_preds, sent_preds, sent_weights, doc_vectors
+
+    def forward_cached(self, X):
+        ''' as per forward (for the rationale model), but using the sentence cache '''
+        sent_vectors, sent_preds = self.sentence_cache.sentence_outputs(X, self.encode_sentence_rows)
+        doc_preds, sent_weights, doc_vectors = rationale_doc_outputs(sent_vectors, sent_preds, X,
+                                                    self.mask_padding, self.doc_W, self.doc_b)
+        return doc_preds, sent_preds, sent_weights, doc_vectors
+
+    def encode_sentence_rows(self, rows):
+        ''' sentence vectors and predictions for an (n_rows x max_sent_len) matrix '''
+        sent_vectors = self.encode_sentences(rows[:,None,:])[:,0]
+        return sent_vectors, self.predict_sentences(sent_vectors)
+
+    def predict_sentences(self, sent_vectors):
+        return softmax(sent_vectors.dot(self.sentence_W) + self.sentence_b)
+
+    def encode_sentences(self, X):
+        ''' (n_docs x doc_len x n_sentence_features) sentence vectors for inputs X '''
+        max_sent_len = X.shape[2]
+        sent_vectors = []
+        for tables, bias in self.filters:
+            n_gram = tables.shape[0]
+            n_windows = max_sent_len - n_gram + 1
+            conv = bias + tables[0][X[:,:,:n_windows]]
+            for offset in range(1, n_gram):
+                conv += tables[offset][X[:,:,offset:offset+n_windows]]
+            # max pooling commutes with the relu, so apply it after
+            sent_vectors.append(np.maximum(conv.max(axis=2), 0))
+        return np.concatenate(sent_vectors, axis=-1)
+
+    def predict_docs(self, docs, batch_size=256):
+        '''
+        As per RationaleCNN.predict_docs: returns (doc_preds, sentence_preds,
+        sentence_weights, doc_vectors) for a list of Document instances. If
+        the model masks padding, each batch is only padded to its longest
+        document (padded sentences contribute nothing), and sentence outputs
+        for rows beyond that are zero.
+        '''
+        p = self.preprocessor
+        for doc in docs:
+            if doc.sentence_sequences is None:
+                doc.generate_sequences(p)
+        doc_lens = np.minimum([doc.num_sentences for doc in docs], p.max_doc_len)
+
+        doc_preds = np.zeros(len(docs))
+        doc_vectors = None
+        sent_preds, sent_weights = None, None
+        if self.rationale_model:
+            sent_preds = np.zeros((len(docs), p.max_doc_len, 3))
+            sent_weights = np.zeros((len(docs), p.max_doc_len))
+
+        for start in range(0, len(docs), batch_size):
+            end = min(start + batch_size, len(docs))
+            doc_len = max(1, doc_lens[start:end].max()) if self.mask_padding else p.max_doc_len
+            X = np.array([doc.get_padded_sequences(p, labels_too=False, doc_len=doc_len)
+                            for doc in docs[start:end]])
+
+            forward = self.forward if self.sentence_cache is None else self.forward_cached
+            b_doc_preds, b_sent_preds, b_sent_weights, b_doc_vectors = forward(X)
+            if doc_vectors is None:
+                doc_vectors = np.zeros((len(docs), b_doc_vectors.shape[1]))
+            doc_preds[start:end] = b_doc_preds
+            doc_vectors[start:end] = b_doc_vectors
+            if self.rationale_model:
+                sent_preds[start:end, :doc_len] = b_sent_preds
+                sent_weights[start:end, :doc_len] = b_sent_weights
+
+        return doc_preds, sent_preds, sent_weights, doc_vectors
+
+    def predict_and_rank_sentences_for_doc(self, doc, num_rationales=3, threshold=0):
+        '''
+        Given a Document instance, make doc-level prediction and return
+        rationales.
+        '''
+        return self.predict_and_rank_sentences_for_docs([doc], batch_size=1,
+                                                        num_rationales=num_rationales,
+                                                        threshold=threshold)[0]
+
+    def predict_and_rank_sentences_for_docs(self, docs, batch_size=256, num_rationales=3, threshold=0,
+                                            store=None):
+        ''' as per RationaleCNN.predict_and_rank_sentences_for_docs '''
+        if store is not None:
+            return store.predict_and_rank_sentences_for_docs(self, docs, batch_size=batch_size,
+                                                             num_rationales=num_rationales,
+                                                             threshold=threshold)
+        doc_preds, sent_preds, _, _ = self.predict_docs(docs, batch_size=batch_size)
+        return rank_rationales(docs, doc_preds, sent_preds, self.preprocessor.max_doc_len,
+                                num_rationales=num_rationales, threshold=threshold)
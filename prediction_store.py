@@ -0,0 +1,189 @@
+'''
+A persistent (SQLite) store of document predictions, for rescoring the same
+document collections repeatedly. Entries are keyed by a hash of a document's
+sentences and a fingerprint of the model that scored it, and hold the
+document probability and per-sentence predictions -- enough to rank
+rationales with any num_rationales and threshold. E.g.,
+
+    store = PredictionStore("predictions.db", model_fingerprint(bundle_path, r_CNN.preprocessor))
+    results = r_CNN.predict_and_rank_sentences_for_docs(docs, store=store)
+
+only scores documents that are not already in the store (with either
+RationaleCNN or NumpyRationaleCNN). Entries for other models (or the same
+weights with other preprocessing) are never returned; see invalidate to
+remove them. For the doc-CNN only document probabilities are stored.
+'''
+import json
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+
+from numpy_RA_CNN import rank_rationales
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    ''' a fingerprint of a model (bundle or weights) file: the sha1 of its contents '''
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def model_fingerprint(path, preprocessor):
+    '''
+    a fingerprint of a model file together with the preprocessing it is run
+    with (settings and vocabulary): the same weights behind a different
+    Preprocessor make different predictions
+    '''
+    preprocessing = json.dumps([preprocessor.get_settings(), preprocessor.get_vocabulary()],
+                               sort_keys=True).encode("utf8")
+    return hashlib.sha1(file_fingerprint(path).encode("ascii") + preprocessing).hexdigest()
+
+def doc_hash(doc):
+    return hashlib.sha1(json.dumps(doc.sentences).encode("utf8")).hexdigest()
+
+
+class PredictionStore:
+
+    def __init__(self, path, fingerprint, max_entries=1000000):
+        '''
+        path: the SQLite database file (created if need be)
+        fingerprint: identifies the model whose predictions are stored and
+                    looked up; e.g., model_fingerprint(bundle_path, preprocessor)
+        max_entries: once the store holds more entries than this, the least
+                    recently used are evicted
+        '''
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                               model TEXT NOT NULL,
+                               doc_hash TEXT NOT NULL,
+                               doc_pred REAL NOT NULL,
+                               sentence_preds BLOB NOT NULL,
+                               last_used REAL NOT NULL,
+                               PRIMARY KEY (model, doc_hash))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def hit_rate(self):
+        n_lookups = self.hits + self.misses
+        return self.hits / float(n_lookups) if n_lookups > 0 else 0.
+
+    def get(self, hashes):
+        '''
+        returns a dictionary mapping those of hashes in the store (for this
+        model) to (doc_pred, sentence_preds) tuples
+        '''
+        found = {}
+        # (in chunks, to stay under SQLite's limit on query parameters)
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start+500]
+            rows = self.db.execute(
+                    "SELECT doc_hash, doc_pred, sentence_preds FROM predictions "
+                    "WHERE model = ? AND doc_hash IN (%s)" % ",".join("?" * len(chunk)),
+                    [self.fingerprint] + list(chunk))
+            for h, doc_pred, sentence_preds in rows:
+                found[h] = (doc_pred, np.frombuffer(sentence_preds, dtype="float32").reshape(-1, 3))
+
+        now = time.time()
+        self.db.executemany("UPDATE predictions SET last_used = ? WHERE model = ? AND doc_hash = ?",
+                            [(now, self.fingerprint, h) for h in found])
+        self.db.commit()
+        return found
+
+    def put(self, hashes, doc_preds, sentence_preds):
+        '''
+        store predictions for hashes: doc_preds and a list of the matching
+        (n_sentences x 3) sentence prediction arrays (with no rows for the
+        doc-CNN)
+        '''
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                            [(self.fingerprint, h, float(doc_pred),
+                              sqlite3.Binary(np.ascontiguousarray(s_preds, dtype="float32").tobytes()), now)
+                                for h, doc_pred, s_preds in zip(hashes, doc_preds, sentence_preds)])
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        n_over = len(self) - self.max_entries
+        if n_over > 0:
+            self.db.execute("DELETE FROM predictions WHERE rowid IN "
+                            "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)", (n_over,))
+
+    def invalidate(self, fingerprint=None):
+        '''
+        remove the entries of the model with the given fingerprint or, if
+        fingerprint is None, those of all models other than this one (e.g.,
+        after retraining)
+        '''
+        if fingerprint is None:
+            self.db.execute("DELETE FROM predictions WHERE model != ?", (self.fingerprint,))
+        else:
+            self.db.execute("DELETE FROM predictions WHERE model = ?", (fingerprint,))
+        self.db.commit()
+
+    def predict_docs(self, model, docs, batch_size=256):
+        '''
+        returns (doc_preds, sentence_preds) for docs, as per model.predict_docs
+        (model being a RationaleCNN or NumpyRationaleCNN), but scoring only
+        those documents that are not in the store (and then storing them).
+        sentence_preds is None for the doc-CNN.
+        '''
+        max_doc_len = model.preprocessor.max_doc_len
+        hashes = [doc_hash(doc) for doc in docs]
+        found = self.get(hashes)
+
+        doc_preds = np.zeros(len(docs))
+        sent_preds = None
+        if model.rationale_model:
+            sent_preds = np.zeros((len(docs), max_doc_len, 3), dtype="float32")
+        missing = []
+        for i, h in enumerate(hashes):
+            if h in found:
+                doc_preds[i], s_preds = found[h]
+                if sent_preds is not None:
+                    sent_preds[i, :len(s_preds)] = s_preds
+            else:
+                missing.append(i)
+        self.hits += len(docs) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            m_doc_preds, m_sent_preds, _, _ = model.predict_docs([docs[i] for i in missing],
+                                                                 batch_size=batch_size)
+            doc_preds[missing] = m_doc_preds
+            if m_sent_preds is None:
+                # (doc-CNN: no sentence rows to store)
+                m_sent_preds = np.zeros((len(missing), 0, 3), dtype="float32")
+            else:
+                sent_preds[missing, :m_sent_preds.shape[1]] = m_sent_preds
+            doc_lens = np.minimum([docs[i].num_sentences for i in missing], m_sent_preds.shape[1])
+            self.put([hashes[i] for i in missing], m_doc_preds,
+                     [s_preds[:doc_len] for s_preds, doc_len in zip(m_sent_preds, doc_lens)])
+
+        return doc_preds, sent_preds
+
+    def predict_and_rank_sentences_for_docs(self, model, docs, batch_size=256, num_rationales=3, threshold=0):
+        '''
+        as per RationaleCNN.predict_and_rank_sentences_for_docs, via
+        predict_docs; the doc-CNN has no rationales, so every document's
+        are empty
+        '''
+        doc_preds, sent_preds = self.predict_docs(model, docs, batch_size=batch_size)
+        if sent_preds is None:
+            return [(doc_pred, []) for doc_pred in doc_preds]
+        return rank_rationales(docs, doc_preds, sent_preds, model.preprocessor.max_doc_len,
+                                num_rationales=num_rationales, threshold=threshold)
@@ -30,42 +30,243 @@ except:
     pass 
 
 import random
+import os
+import copy
+import hashlib
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
 
 import numpy as np
 
-from keras.optimizers import SGD, RMSprop
-from keras import backend as K 
-K.set_image_dim_ordering("th")
-K.set_image_data_format("channels_first")
-
-from keras.models import Model, Sequential, model_from_json #load_model
-from keras.preprocessing import sequence
-from keras.engine.topology import Layer
-from keras.preprocessing.sequence import pad_sequences
-from keras.layers import Input, Embedding, Dense, merge
-from keras.layers.merge import concatenate
-from keras.layers.core import Dense, Dropout, Activation, Flatten, Reshape, Permute, Lambda
-from keras.layers.wrappers import TimeDistributed
-from keras.layers.embeddings import Embedding
-from keras.layers.convolutional import Conv1D, Convolution2D, Conv2D, MaxPooling1D, MaxPooling2D
-from keras.preprocessing.text import text_to_word_sequence, Tokenizer
-from keras.callbacks import ModelCheckpoint, EarlyStopping
-from keras.constraints import maxnorm
-from keras.regularizers import l2
+from numpy_RA_CNN import (read_layer_weights, convert_conv_kernel, rank_rationales,
+                          rationale_doc_outputs, SentenceCache)
+import model_bundle
+
+# Keras (and a backend) is only imported once a model is built or loaded
+# (see import_keras), so that Preprocessor and Document can be used -- e.g.,
+# by preprocessing workers -- without paying for it.
+K = None
+
+def import_keras():
+    '''
+    Import keras and the layers used here into the module namespace, 
+    and configure the backend; a no-op after the first call.
+    '''
+    global K, SGD, RMSprop, Model, Sequential, model_from_json, Layer
+    global Input, Embedding, Dense, merge, concatenate, multiply
+    global Dropout, Activation, Flatten, Reshape, Permute, Lambda, TimeDistributed
+    global Conv1D, Convolution2D, Conv2D, MaxPooling1D, MaxPooling2D, GlobalMaxPooling1D
+    global ModelCheckpoint, EarlyStopping, maxnorm, l2, VariableDropout
+    if K is not None:
+        return 
+
+    from keras import backend
+    backend.set_image_dim_ordering("th")
+    backend.set_image_data_format("channels_first")
+
+    from keras.optimizers import SGD, RMSprop
+    from keras.models import Model, Sequential, model_from_json #load_model
+    from keras.engine.topology import Layer
+    from keras.layers import Input, Embedding, Dense, merge
+    from keras.layers.merge import concatenate, multiply
+    from keras.layers.core import Dense, Dropout, Activation, Flatten, Reshape, Permute, Lambda
+    from keras.layers.wrappers import TimeDistributed
+    from keras.layers.embeddings import Embedding
+    from keras.layers.convolutional import Conv1D, Convolution2D, Conv2D, MaxPooling1D, MaxPooling2D
+    from keras.layers.pooling import GlobalMaxPooling1D
+    from keras.callbacks import ModelCheckpoint, EarlyStopping
+    from keras.constraints import maxnorm
+    from keras.regularizers import l2
+
+    class VariableDropout(Layer):
+        '''
+        Dropout whose rate is held in a backend variable, so that it can be
+        changed (via set_rate) without rebuilding or recompiling the model.
+        Note that models using this layer need it passed as a custom object
+        to model_from_json.
+        '''
+        def __init__(self, rate, **kwargs):
+            super(VariableDropout, self).__init__(**kwargs)
+            self.rate = K.variable(rate, name="%s_rate" % self.name)
+            self.supports_masking = True
+
+        def call(self, inputs, training=None):
+            retain_prob = 1. - self.rate
+            def dropped_inputs():
+                keep = K.cast(K.less(K.random_uniform(K.shape(inputs)), retain_prob), K.floatx())
+                return inputs * keep / retain_prob
+            return K.in_train_phase(dropped_inputs, inputs, training=training)
+
+        def set_rate(self, rate):
+            K.set_value(self.rate, rate)
+
+        def get_config(self):
+            config = {"rate": float(K.get_value(self.rate))}
+            base_config = super(VariableDropout, self).get_config()
+            return dict(list(base_config.items()) + list(config.items()))
+
+    # set last, since it marks keras as imported
+    K = backend
+
+
+class Tokenizer:
+    '''
+    The parts of keras' Tokenizer (keras.preprocessing.text) used by the 
+    Preprocessor, with the same behavior and attributes; defined here so 
+    that preprocessing doesn't require Keras. (Preprocessors pickled with 
+    a keras Tokenizer still work.)
+    '''
+    def __init__(self, num_words=None, filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n', 
+                    lower=True, split=" "):
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.char_level = False
+        self.word_counts = OrderedDict()
+        self.word_docs = {}
+        self.document_count = 0
+        self.word_index = {}
+        self.index_docs = {}
+
+    def text_to_word_sequence(self, text):
+        if self.lower:
+            text = text.lower()
+        text = text.translate(dict((ord(c), self.split) for c in self.filters))
+        return [w for w in text.split(self.split) if w]
+
+    def fit_on_texts(self, texts):
+        self.document_count = 0
+        for text in texts:
+            self.document_count += 1
+            seq = self.text_to_word_sequence(text)
+            for w in seq:
+                self.word_counts[w] = self.word_counts.get(w, 0) + 1
+            for w in set(seq):
+                self.word_docs[w] = self.word_docs.get(w, 0) + 1
+
+        # the sort is stable, so ties are broken by first occurrence; 
+        # index 0 is reserved (for padding)
+        sorted_voc = [w for w, _ in sorted(self.word_counts.items(), key=lambda x: x[1], reverse=True)]
+        self.word_index = dict(zip(sorted_voc, range(1, len(sorted_voc)+1)))
+        self.index_docs = dict((self.word_index[w], c) for w, c in self.word_docs.items())
+
+    def texts_to_sequences_generator(self, texts):
+        num_words = self.num_words
+        for text in texts:
+            indices = [self.word_index.get(w) for w in self.text_to_word_sequence(text)]
+            yield [idx for idx in indices if idx is not None and not (num_words and idx >= num_words)]
+
+    def texts_to_sequences(self, texts):
+        return list(self.texts_to_sequences_generator(texts))
+
+
+class EpochPrefetcher:
+    '''
+    Builds per-epoch training data in a background thread, so that
+    sampling the next epoch overlaps with training on the current one.
+
+    sample_func is called once per epoch, with the prefetcher's own 
+    np.random.RandomState (seeded from the global RNG on construction, so 
+    that sampling neither races with nor perturbs keras' shuffling on the 
+    main thread), and its results are handed over in order through a queue
+    holding at most queue_depth epochs; if queue_depth is 0, each epoch is
+    instead built synchronously on request. Iterating yields the n_epochs 
+    results; the time spent waiting on each is printed and kept in 
+    self.wait_times.
+    '''
+    def __init__(self, sample_func, n_epochs, queue_depth=1):
+        self.sample_func = sample_func
+        self.n_epochs = n_epochs
+        self.queue_depth = queue_depth
+        self.wait_times = []
+        self.random_state = np.random.RandomState(np.random.randint(2**31 - 1))
+
+        if queue_depth > 0:
+            self.queue = queue.Queue(maxsize=queue_depth)
+            self.producer = threading.Thread(target=self._produce)
+            # don't keep the interpreter alive if training is interrupted
+            self.producer.daemon = True
+            self.producer.start()
+
+    def _produce(self):
+        try:
+            for _ in range(self.n_epochs):
+                self.queue.put((True, self.sample_func(self.random_state)))
+        except Exception as e:
+            # re-raised in the consumer 
+            self.queue.put((False, e))
+
+    def next_epoch(self):
+        start = time.time()
+        if self.queue_depth > 0:
+            ok, epoch_data = self.queue.get()
+            if not ok:
+                raise epoch_data
+        else:
+            epoch_data = self.sample_func(self.random_state)
+        wait = time.time() - start
+        self.wait_times.append(wait)
+        print("waited %.3f secs for epoch data" % wait)
+        return epoch_data
+
+    def __iter__(self):
+        for _ in range(self.n_epochs):
+            yield self.next_epoch()
+
 
 class RationaleCNN:
 
     def __init__(self, preprocessor, filters=None, n_filters=32, 
                         sent_dropout=0.5, doc_dropout=0.5, 
                         end_to_end_train=False, f_beta=2,
+                        n_buckets=None, mask_padding=True,
+                        adjustable_dropout=False, freeze_embeddings=False,
+                        encoder="conv2d",
                         document_model_architecture_path=None,
-                        document_model_weights_path=None):
+                        document_model_weights_path=None,
+                        bundle_path=None):
         '''
         parameters
         ---
         preprocessor: an instance of the Preprocessor class, defined below
+                    (may be None if loading from a bundle; see bundle_path)
+        n_buckets: if not None, models are built with a variable document length
+                    and documents are grouped into (at most) this many length 
+                    buckets for training and inference, each padded only to 
+                    the longest document in its bucket. Requires the RA-CNN
+                    with mask_padding (see check_bucketing).
+        mask_padding: if True, padded (all-zero) sentences get zero weight in
+                    the RA-CNN document vector and are ignored by the 
+                    sentence-level loss.
+        adjustable_dropout: if True, dropout rates can be changed after the 
+                    model is built (see set_dropout_rates); useful for reusing 
+                    one model across hyperparameter search trials.
+        freeze_embeddings: if True, the embedding layer is initialized with 
+                    the preprocessor's word vectors (which must be loaded) 
+                    and not updated in training; this avoids the dense 
+                    (max_features+1 x embedding_dims) gradient update that
+                    otherwise dominates the cost of each training step.
+        encoder: how sentences are encoded; "conv2d" (the original layout: a 
+                    2D convolution over each document's flattened embedded 
+                    sentences) or "conv1d" (a time-distributed 1D convolution 
+                    with global max pooling, which is usually faster on CPU). 
+                    Both produce the same sentence vectors given the same 
+                    weights; see load_doc_model_weights to convert between them.
+        bundle_path: if given, the trained model is loaded from this bundle 
+                    (see save_bundle), and its model settings override the 
+                    arguments above; if preprocessor is None, the bundled 
+                    vocabulary and preprocessing settings are used.
         '''
+        import_keras()
         self.preprocessor = preprocessor
 
         if filters is None:
@@ -80,8 +281,18 @@ class RationaleCNN:
         self.doc_dropout  = doc_dropout
         self.sentence_model_trained = False 
         self.end_to_end_train = end_to_end_train
-        self.sentence_prob_model = None 
+        self.inference_model = None 
+        self.rationale_model = None
+        self.sentence_encoder_model = None
+        self.sentence_cache = None
         self.f_beta = f_beta
+        self.n_buckets = n_buckets
+        self.mask_padding = mask_padding
+        self.adjustable_dropout = adjustable_dropout
+        self.freeze_embeddings = freeze_embeddings
+        self.encoder = encoder
+        self.initial_weights = None
+        self.check_bucketing()
 
         if document_model_architecture_path is not None: 
             assert(document_model_weights_path is not None)
@@ -90,13 +301,20 @@ class RationaleCNN:
 
             with open(document_model_architecture_path) as doc_arch:
                 doc_arch_str = doc_arch.read()
-                self.doc_model = model_from_json(doc_arch_str)
+                self.doc_model = model_from_json(doc_arch_str, 
+                                                 custom_objects={"VariableDropout": VariableDropout})
             
             self.doc_model.load_weights(document_model_weights_path)
 
             self.set_final_sentence_model() # setup sentence model, too
+            # (the architecture, rather than the constructor, says whether padding is masked)
+            self.mask_padding = self.has_sentence_mask()
+            self.check_bucketing()
             print("ok!")
 
+        if bundle_path is not None:
+            self.load_bundle(bundle_path)
+
 
     @staticmethod
     def metric_func_maker(metric_name="f", beta=1):
@@ -153,11 +371,15 @@ class RationaleCNN:
         return tuple((1, shape[-1]))
 
     @staticmethod
-    def balanced_sample(X, y, sentences=None, binary=False, k=1, n_rows=None):
+    def balanced_sample(X, y, sentences=None, binary=False, k=1, n_rows=None, random_state=None):
+        ''' random_state: an np.random.RandomState to draw from (default: the global one) '''
+        rs = np.random if random_state is None else random_state
         if binary:
             _, neg_indices = np.where([y <= 0]) 
             _, pos_indices = np.where([y > 0])
-            sampled_neg_indices = np.random.choice(neg_indices, pos_indices.shape[0], replace=False)
+            # (there may be fewer negatives than positives, e.g., in small buckets)
+            n_neg = min(pos_indices.shape[0], neg_indices.shape[0])
+            sampled_neg_indices = rs.choice(neg_indices, n_neg, replace=False)
             train_indices = np.concatenate([pos_indices, sampled_neg_indices])
         else:        
             _, pos_rationale_indices = np.where([y[:,0] > 0]) 
@@ -171,13 +393,13 @@ class RationaleCNN:
                 # instances
                 num_rationale_indices = int(n_rows / 2.0)
                 if pos_rationale_indices.shape[0] > 0:
-                    rationale_indices = np.random.choice(pos_rationale_indices, num_rationale_indices, replace=True)
+                    rationale_indices = rs.choice(pos_rationale_indices, num_rationale_indices, replace=True)
                 else: 
-                    rationale_indices = np.random.choice(neg_rationale_indices, num_rationale_indices, replace=True)
+                    rationale_indices = rs.choice(neg_rationale_indices, num_rationale_indices, replace=True)
 
                 # sample the rest as `negative' (neutral) instances
                 num_non_rationales = n_rows - num_rationale_indices
-                sampled_non_rationale_indices = np.random.choice(non_rationale_indices, num_non_rationales, replace=True)
+                sampled_non_rationale_indices = rs.choice(non_rationale_indices, num_non_rationales, replace=True)
                 train_indices = np.concatenate([rationale_indices, sampled_non_rationale_indices])
                 
             else:
@@ -189,61 +411,349 @@ class RationaleCNN:
 
                 sampled_non_rationale_indices = non_rationale_indices
                 if m < non_rationale_indices.shape[0]:
-                    sampled_non_rationale_indices = np.random.choice(non_rationale_indices, m, replace=True)
+                    sampled_non_rationale_indices = rs.choice(non_rationale_indices, m, replace=True)
 
                 train_indices = np.concatenate([pos_rationale_indices, neg_rationale_indices, 
                                                     sampled_non_rationale_indices])
             
 
 
-        np.random.shuffle(train_indices) # why not
+        rs.shuffle(train_indices) # why not
         if sentences is not None: 
             return X[train_indices,:], y[train_indices], [sentences[idx] for idx in train_indices]
         return X[train_indices,:], y[train_indices]
 
 
-    def build_simple_doc_model(self):
-        # maintains sentence structure, but does not impose weights.
-        tokens_input = Input(name='input', 
-                            shape=(self.preprocessor.max_doc_len, self.preprocessor.max_sent_len), 
-                            dtype='int32')
+    def make_dropout(self, rate, name):
+        if self.adjustable_dropout:
+            return VariableDropout(rate, name=name)
+        return Dropout(rate, name=name)
 
-        tokens_reshaped = Reshape([self.preprocessor.max_doc_len*self.preprocessor.max_sent_len])(tokens_input)
+    def make_embedding(self, weights=None):
+        ''' the token embedding layer; frozen (and initialized from word vectors) if freeze_embeddings '''
+        if self.freeze_embeddings:
+            assert self.preprocessor.init_vectors is not None, "freezing embeddings requires word vectors!"
+            return Embedding(self.preprocessor.max_features+1, self.preprocessor.embedding_dims, 
+                                weights=self.preprocessor.init_vectors, trainable=False,
+                                name="embedding")
+        return Embedding(self.preprocessor.max_features+1, self.preprocessor.embedding_dims, 
+                            weights=weights, name="embedding")
 
-    
-        x = Embedding(self.preprocessor.max_features+1, self.preprocessor.embedding_dims, 
-                        weights=self.preprocessor.init_vectors,
-                        name="embedding")(tokens_reshaped)
+    def encode_sentences(self, x, doc_len):
+        '''
+        x is the embedded tokens, (batch, doc_len*max_sent_len, embedding_dims); 
+        returns a list with one (batch, doc_len, n_filters) tensor of max-pooled
+        features per n-gram filter size, via the configured encoder. Filter 
+        layers are named conv2d_<n_gram> for either encoder, so that weights 
+        can be matched by name.
+        '''
+        max_sent_len, embedding_dims = self.preprocessor.max_sent_len, self.preprocessor.embedding_dims
+        convolutions = []
 
-        x = Reshape((1, self.preprocessor.max_doc_len, 
-                     self.preprocessor.max_sent_len*self.preprocessor.embedding_dims), 
-                     name="reshape")(x)
+        if self.encoder == "conv1d":
+            x = Reshape((doc_len, max_sent_len, embedding_dims), name="reshape")(x)
+            for n_gram in self.ngram_filters:
+                cur_conv = TimeDistributed(Conv1D(self.n_filters, n_gram, activation="relu"), 
+                                            name="conv2d_"+str(n_gram))(x)
+                one_max = TimeDistributed(GlobalMaxPooling1D(), name="conv_"+str(n_gram))(cur_conv)
+                convolutions.append(one_max)
+            return convolutions
 
-        convolutions = []
+        # reshape to preserve document structure -> 
+        #       (doc_len x (word_in_sent x embedding_dim))
 
+        # the 1 here is a dummy for the `channels' expected
+        # by conv2d --> 
+        #   (batch, channels, doc_len, (word_in_sent x embedding_dim))
+        x = Reshape((1, doc_len, max_sent_len*embedding_dims), name="reshape")(x)
         for n_gram in self.ngram_filters:
-            cur_conv = Convolution2D(self.n_filters, 1, 
-                                     n_gram*self.preprocessor.embedding_dims, 
-                                     subsample=(1, self.preprocessor.embedding_dims),
-                                     activation="relu",
-                                     name="conv2d_"+str(n_gram))(x)
-
-            # this output (n_filters x max_doc_len x 1)
-            one_max = MaxPooling2D(pool_size=(1, self.preprocessor.max_sent_len - n_gram + 1), 
+            cur_conv = Conv2D(self.n_filters, (1, n_gram*embedding_dims), 
+                                strides=(1, embedding_dims),
+                                name="conv2d_"+str(n_gram), activation="relu")(x)
+
+            # this output (1 x new_rows x new_cols x n_filters)
+            one_max = MaxPooling2D(pool_size=(1, max_sent_len-n_gram+1), 
                                    name="pooling_"+str(n_gram))(cur_conv)
 
             # flip around, to get (1 x max_doc_len x n_filters)
             permuted = Permute((2,1,3), name="permuted_"+str(n_gram)) (one_max)
             
             # drop extra dimension
-            r = Reshape((self.preprocessor.max_doc_len, self.n_filters), 
+            r = Reshape((doc_len, self.n_filters), 
                             name="conv_"+str(n_gram))(permuted)
             
             convolutions.append(r)
+        return convolutions
+
+    def load_doc_model_weights(self, weights_path):
+        '''
+        Load doc_model weights from an hdf5 file (as written by save_weights),
+        matching layers by name. n-gram filter kernels are converted as needed,
+        so that weights saved with either encoder (or backend) can be loaded.
+        '''
+        layer_weights, source_backend = read_layer_weights(weights_path)
+        self.set_doc_model_weights(layer_weights, source_backend)
+
+    def set_doc_model_weights(self, layer_weights, source_backend=None):
+        ''' 
+        set doc_model weights from a dictionary mapping layer names to lists of 
+        weight arrays, as saved with source_backend (default: the current one)
+        '''
+        if source_backend is None:
+            source_backend = K.backend()
+
+        for layer in self.doc_model.layers:
+            if len(layer.weights) == 0:
+                continue
+            weights = layer_weights[layer.name]
+            if layer.name.startswith("conv2d_"):
+                weights[0] = convert_conv_kernel(weights[0], K.int_shape(layer.weights[0]), 
+                                                 self.preprocessor.embedding_dims, 
+                                                 source_backend, K.backend())
+            layer.set_weights(weights)
+
+        if self.sentence_cache is not None:
+            # cached sentence outputs are for the old weights
+            self.sentence_cache.clear()
+
+    def save_bundle(self, bundle_path):
+        '''
+        Write the trained document model (architecture and weights), the 
+        vocabulary and the preprocessing and model settings to a single 
+        file, which can be loaded with RationaleCNN(None, bundle_path=...).
+        '''
+        p = self.preprocessor
+        settings = {"backend": K.backend(),
+                    "preprocessor": p.get_settings(),
+                    "model": {"filters": self.ngram_filters, "n_filters": self.n_filters, 
+                              "sent_dropout": self.sent_dropout, "doc_dropout": self.doc_dropout,
+                              "end_to_end_train": self.end_to_end_train, "f_beta": self.f_beta,
+                              "n_buckets": self.n_buckets, "mask_padding": self.mask_padding,
+                              "adjustable_dropout": self.adjustable_dropout, 
+                              "freeze_embeddings": self.freeze_embeddings, "encoder": self.encoder}}
+        # tokens beyond max_features are never used
+        vocabulary = p.get_vocabulary()[:p.max_features]
+        layer_weights = OrderedDict((layer.name, layer.get_weights()) for layer in self.doc_model.layers)
+        model_bundle.write_bundle(bundle_path, self.doc_model.to_json(), layer_weights, 
+                                    vocabulary, settings)
+
+    def load_bundle(self, bundle_path):
+        ''' load the model (and, if need be, the preprocessor) from a bundle written by save_bundle '''
+        print("loading model bundle: %s" % bundle_path)
+        header, layer_weights = model_bundle.read_bundle(bundle_path)
+        settings = header["settings"]
+
+        model_settings = dict(settings["model"])
+        self.ngram_filters = model_settings.pop("filters")
+        for setting, value in model_settings.items():
+            setattr(self, setting, value)
+
+        if self.preprocessor is None:
+            self.preprocessor = Preprocessor.from_settings(settings["preprocessor"], header["vocabulary"])
+
+        self.doc_model = model_from_json(header["architecture"], 
+                                         custom_objects={"VariableDropout": VariableDropout})
+        self.set_doc_model_weights(layer_weights, settings["backend"])
+        self.set_final_sentence_model()
+        self.check_bucketing(masked=self.has_sentence_mask())
+
+    def set_dropout_rates(self, sent_dropout, doc_dropout):
+        ''' change dropout rates in place; requires adjustable_dropout '''
+        assert(self.adjustable_dropout)
+        self.sent_dropout, self.doc_dropout = sent_dropout, doc_dropout
+        for layer_name, rate in (("dropout", sent_dropout), ("doc_v_dropout", doc_dropout)):
+            for model in (self.doc_model, getattr(self, "sentence_model", None)):
+                if model is not None and layer_name in [layer.name for layer in model.layers]:
+                    model.get_layer(layer_name).set_rate(rate)
+
+    def snapshot_weights(self):
+        ''' remember the current (e.g., freshly initialized) weights of all layers '''
+        self.initial_weights = dict((layer.name, layer.get_weights()) for layer in self.doc_model.layers)
+
+    def reset_weights(self):
+        '''
+        restore the weights saved by snapshot_weights and zero the optimizer 
+        state (iterations, moments and accumulators all start at zero), 
+        without rebuilding or recompiling anything.
+        '''
+        for layer in self.doc_model.layers:
+            layer.set_weights(self.initial_weights[layer.name])
+
+        for model in (self.doc_model, getattr(self, "sentence_model", None)):
+            if model is not None and getattr(model, "optimizer", None) is not None:
+                optimizer_weights = model.optimizer.weights
+                K.batch_set_value([(w, np.zeros(K.int_shape(w))) for w in optimizer_weights])
+
+    def check_bucketing(self, masked=None):
+        '''
+        Bucketing is only output-invariant if padded sentences contribute 
+        nothing to the document vector, i.e., for the RA-CNN with padding 
+        masked (masked defaults to self.mask_padding). Otherwise every padded 
+        row adds relu(bias) features to the document vector, so a document's 
+        prediction would depend on its bucket's length (and so on the other 
+        documents it is scored with).
+        '''
+        if masked is None:
+            masked = self.mask_padding
+        if self.n_buckets is not None and not masked:
+            raise ValueError("length bucketing (n_buckets) requires the RA-CNN with mask_padding")
+
+    def has_sentence_mask(self):
+        ''' does doc_model mask padded sentences (as per mask_padding)? '''
+        return "sentence_mask" in [layer.name for layer in self.doc_model.layers]
+
+    def get_doc_len_dims(self):
+        '''
+        returns the document length to use for the model input and for
+        the reshapes that follow it; in bucketed mode the former is None
+        (variable) and the latter -1 (inferred).
+        '''
+        if self.n_buckets is not None:
+            return None, -1
+        return self.preprocessor.max_doc_len, self.preprocessor.max_doc_len
+
+    @staticmethod
+    def bucket_documents(documents, n_buckets, max_doc_len, verbose=False):
+        '''
+        Group documents into (at most) n_buckets buckets by number of sentences
+        (truncated at max_doc_len). Returns a list of (bucket_doc_len, doc_indices)
+        tuples, where bucket_doc_len is the length every document in the bucket 
+        is to be padded to. If verbose, also reports the fraction of padded 
+        sentence rows before and after bucketing.
+        '''
+        doc_lens = np.clip([d.num_sentences for d in documents], 1, max_doc_len)
+
+        # boundaries are (roughly) equal-frequency quantiles of the lengths
+        sorted_lens = np.sort(doc_lens)
+        quantile_idx = np.ceil(np.arange(1, n_buckets+1) * len(doc_lens) / float(n_buckets)).astype("int32") - 1
+        boundaries = np.unique(sorted_lens[quantile_idx])
+        bucket_ids = np.searchsorted(boundaries, doc_lens)
+
+        if verbose:
+            padding_before = 1.0 - doc_lens.sum() / float(len(doc_lens) * max_doc_len)
+            padding_after  = 1.0 - doc_lens.sum() / float(boundaries[bucket_ids].sum())
+            print("bucket lengths: %s; padding ratio before bucketing: %.3f, after: %.3f" % (
+                        boundaries.tolist(), padding_before, padding_after))
+
+        return [(int(boundaries[b]), np.where(bucket_ids == b)[0]) for b in range(boundaries.shape[0])]
+
+    @staticmethod
+    def sentence_mask(X):
+        '''
+        X is (n_docs x doc_len x max_sent_len); returns a (n_docs x doc_len) 
+        float mask that is 0 for padded (all-zero) sentences and 1 otherwise.
+        '''
+        return np.any(X != 0, axis=-1).astype("float32")
+
+    def sentence_sample_weights(self, X):
+        ''' per-sentence sample weights for the sentence model (or None) '''
+        if not self.mask_padding:
+            return None
+        return RationaleCNN.sentence_mask(X)
+
+    @staticmethod
+    def evaluate_buckets(model, bucket_sets, batch_size=50, sample_weight_func=None):
+        '''
+        evaluate model on each (X, y) bucket; returns metrics averaged over
+        buckets, weighted by bucket size.
+        '''
+        results, sizes = [], []
+        for X, y in bucket_sets:
+            sample_weight = None if sample_weight_func is None else sample_weight_func(X)
+            results.append(model.evaluate(X, y, batch_size=batch_size, sample_weight=sample_weight))
+            sizes.append(X.shape[0])
+        return list(np.average(np.array(results), axis=0, weights=sizes))
+
+    @staticmethod
+    def rationale_sampling_indices(y_sent):
+        '''
+        For a (n_docs x doc_len x 3) sentence label tensor, precompute the rows
+        that balanced_sample_docs draws from for each document: its positive 
+        rationales (or negative rationales, if it has no positive ones) and its
+        non-rationales (or, in the rare case of a document without any, its 
+        rationales). Each is returned as a (flat row indices, per-doc starts, 
+        per-doc counts) tuple. Assumes every document has a rationale.
+        '''
+        def _flatten(mask):
+            counts = mask.sum(axis=1)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            return np.where(mask)[1], starts, counts
+
+        has_pos = (y_sent[:,:,0] > 0).any(axis=1)
+        rationale_mask = np.where(has_pos[:,None], y_sent[:,:,0] > 0, y_sent[:,:,1] > 0)
+        non_rationale_mask = y_sent[:,:,2] > 0
+        no_non_rationales = ~non_rationale_mask.any(axis=1)
+        non_rationale_mask[no_non_rationales] = rationale_mask[no_non_rationales]
+        return _flatten(rationale_mask), _flatten(non_rationale_mask)
+
+    @staticmethod
+    def balanced_sentence_order(y, random_state=None):
+        '''
+        For a flat (n_sentences x 3) sentence label matrix, an epoch's worth of
+        row indices in which every rationale (positive or negative) is paired 
+        with a randomly drawn non-rationale, so that each (even-sized) 
+        minibatch taken in order is exactly balanced. Draws from random_state
+        (an np.random.RandomState; default: the global one).
+        '''
+        rs = np.random if random_state is None else random_state
+        is_rationale = y[:,:2].max(axis=1) > 0
+        rationale_idx = rs.permutation(np.flatnonzero(is_rationale))
+        non_rationale_idx = np.flatnonzero(~is_rationale)
+        non_rationale_idx = rs.choice(non_rationale_idx, size=len(rationale_idx), 
+                                    replace=len(non_rationale_idx) < len(rationale_idx))
+        return np.column_stack((rationale_idx, non_rationale_idx)).ravel()
+
+    @staticmethod
+    def balanced_sample_docs(X, y, sampling_indices, n_rows=None, random_state=None):
+        '''
+        Vectorized version of calling balanced_sample(X[i], y[i], n_rows=n_rows)
+        for every document i: builds all balanced pseudo documents at once, 
+        each comprising n_rows (default: doc length) rows, half of them 
+        rationales (drawn with replacement) and the rest non-rationales, 
+        shuffled. sampling_indices is from rationale_sampling_indices(y). 
+        Draws from random_state (an np.random.RandomState; default: the 
+        global one). Returns the sampled X and y and the (n_docs x n_rows) 
+        sampled row indices.
+        '''
+        rs = np.random if random_state is None else random_state
+        n_docs = X.shape[0]
+        if n_rows is None:
+            n_rows = X.shape[1]
+        num_rationale_indices = int(n_rows / 2.0)
+
+        def _draw(flat_starts_counts, k):
+            flat, starts, counts = flat_starts_counts
+            offsets = (rs.random_sample((n_docs, k)) * counts[:,None]).astype("int64")
+            return flat[starts[:,None] + offsets]
+
+        rationale_indices, non_rationale_indices = sampling_indices
+        rows = np.concatenate([_draw(rationale_indices, num_rationale_indices), 
+                               _draw(non_rationale_indices, n_rows - num_rationale_indices)], axis=1)
+        # shuffle within each pseudo document
+        rows = np.take_along_axis(rows, np.argsort(rs.random_sample(rows.shape), axis=1), axis=1)
+
+        doc_indices = np.arange(n_docs)[:,None]
+        return X[doc_indices, rows], y[doc_indices, rows], rows
+
+    def build_simple_doc_model(self):
+        # maintains sentence structure, but does not impose weights.
+        # (nor mask padding, so cannot be bucketed)
+        self.check_bucketing(masked=False)
+        input_doc_len, doc_len = self.get_doc_len_dims()
+        tokens_input = Input(name='input', 
+                            shape=(input_doc_len, self.preprocessor.max_sent_len), 
+                            dtype='int32')
+
+        tokens_reshaped = Reshape((-1,))(tokens_input)
+
+    
+        x = self.make_embedding(weights=self.preprocessor.init_vectors)(tokens_reshaped)
+
+        convolutions = self.encode_sentences(x, doc_len)
 
         #sent_vectors = merge(convolutions, name="sentence_vectors", mode="concat")
         sent_vectors = concatenate(convolutions, name="sentence_vectors")
-        sent_vectors = Dropout(self.sent_dropout, name="dropout")(sent_vectors)
+        sent_vectors = self.make_dropout(self.sent_dropout, name="dropout")(sent_vectors)
 
         '''
         For this model, we simply take an unweighted sum of the sentence vectors
@@ -263,7 +773,7 @@ class RationaleCNN:
                                 output_shape=sum_sentence_vector_output_shape,
                                 name="document_vector")(sent_vectors)
 
-        doc_vector = Dropout(self.doc_dropout, name="doc_v_dropout")(doc_vector)
+        doc_vector = self.make_dropout(self.doc_dropout, name="doc_v_dropout")(doc_vector)
         output = Dense(1, activation="sigmoid", name="doc_prediction")(doc_vector)
 
         self.doc_model = Model(inputs=tokens_input, outputs=output)
@@ -279,60 +789,22 @@ class RationaleCNN:
 
     def build_RA_CNN_model(self):
         # input dim is (max_doc_len x max_sent_len) -- eliding the batch size
+        input_doc_len, doc_len = self.get_doc_len_dims()
         tokens_input = Input(name='input', 
-                            shape=(self.preprocessor.max_doc_len, self.preprocessor.max_sent_len), 
+                            shape=(input_doc_len, self.preprocessor.max_sent_len), 
                             dtype='int32')
         
 
         # flatten; create a very wide matrix to hand to embedding layer
-        tokens_reshaped = Reshape([self.preprocessor.max_doc_len*self.preprocessor.max_sent_len])(tokens_input)
+        tokens_reshaped = Reshape((-1,))(tokens_input)
         # embed the tokens; output will be (p.max_doc_len*p.max_sent_len x embedding_dims)
         # here we should initialize with weights from sentence model embedding layer!
         # also pass weights for initialization
-        x = Embedding(self.preprocessor.max_features+1, self.preprocessor.embedding_dims, 
-                        name="embedding")(tokens_reshaped)
-
-
-        # reshape to preserve document structure -> 
-        #       (doc_len x (word_in_sent x embedding_dim))
-
-        # the 1 here is a dummy for the `channels' expected
-        # by conv2d --> 
-        #   (batch, channels, doc_len, (word_in_sent x embedding_dim))
-        x = Reshape((1, self.preprocessor.max_doc_len, 
-                     self.preprocessor.max_sent_len*self.preprocessor.embedding_dims), 
-                     name="reshape")(x)
-        #x = Reshape((self.preprocessor.max_doc_len, 
-        #             self.preprocessor.max_sent_len*self.preprocessor.embedding_dims), 
-        #             name="reshape")(x)
+        x = self.make_embedding()(tokens_reshaped)
 
         total_sentence_dims = len(self.ngram_filters) * self.n_filters 
 
-        convolutions = []
-        for n_gram in self.ngram_filters:
-            
-            #cur_conv = Convolution2D(self.n_filters, 1, 
-            #                         n_gram*self.preprocessor.embedding_dims, 
-            #                         subsample=(1, self.preprocessor.embedding_dims),
-            #                         activation="relu",
-            #                         name="conv2d_"+str(n_gram))(x)
-
-            cur_conv = Conv2D(self.n_filters, (1, n_gram*self.preprocessor.embedding_dims), 
-                                strides=(1, self.preprocessor.embedding_dims),
-                                name="conv2d_"+str(n_gram), activation="relu")(x)
-
-            # this output (1 x new_rows x new_cols x n_filters)
-            one_max = MaxPooling2D(pool_size=(1, self.preprocessor.max_sent_len-n_gram+1), 
-                                   name="pooling_"+str(n_gram))(cur_conv)
-
-            # flip around, to get (1 x max_doc_len x n_filters)
-            permuted = Permute((2,1,3), name="permuted_"+str(n_gram)) (one_max)
-            
-            # drop extra dimension
-            r = Reshape((self.preprocessor.max_doc_len, self.n_filters), 
-                            name="conv_"+str(n_gram))(permuted)
-            
-            convolutions.append(r)
+        convolutions = self.encode_sentences(x, doc_len)
 
         sent_vectors = merge(convolutions, name="sentence_vectors", mode="concat")
         # it's not clear that it even makes sense to apply drop out here!
@@ -348,9 +820,11 @@ class RationaleCNN:
         # updating how we do sentence model 
         self.sentence_model = Model(inputs=tokens_input, outputs=sent_preds)
         
+        # with mask_padding, per-sentence sample weights zero out padded rows
         self.sentence_model.compile(loss='categorical_crossentropy', 
                                     metrics=["accuracy"], 
-                                    optimizer="adagrad")
+                                    optimizer="adagrad",
+                                    sample_weight_mode="temporal" if self.mask_padding else None)
         print (self.sentence_model.summary())
         
         #####
@@ -358,8 +832,16 @@ class RationaleCNN:
         
         sw_layer = Lambda(lambda x: K.max(x[:,0:2], axis=1), output_shape=(1,)) 
         
-        # should really explicitly zero out sentences that were padded...
-        sent_weights = TimeDistributed(sw_layer, name="sentence_weights")(sent_preds)
+        if self.mask_padding:
+            # explicitly zero out (the weights of) sentences that were padded, 
+            # so that they contribute nothing to the document vector
+            sent_weights = TimeDistributed(sw_layer, name="unmasked_sentence_weights")(sent_preds)
+            sent_mask = Lambda(lambda x: K.expand_dims(K.cast(K.any(K.not_equal(x, 0), axis=-1), K.floatx())),
+                                output_shape=lambda input_shape: (input_shape[0], input_shape[1], 1),
+                                name="sentence_mask")(tokens_input)
+            sent_weights = multiply([sent_weights, sent_mask], name="sentence_weights")
+        else:
+            sent_weights = TimeDistributed(sw_layer, name="sentence_weights")(sent_preds)
  
         def scale_merge(inputs):
             sent_vectors, sent_weights = inputs[0], inputs[1]
@@ -387,7 +869,7 @@ class RationaleCNN:
 
         # trim extra dim
         doc_vector = Reshape((total_sentence_dims,), name="reshaped_doc")(doc_vector)
-        doc_vector = Dropout(self.doc_dropout, name="doc_v_dropout")(doc_vector)
+        doc_vector = self.make_dropout(self.doc_dropout, name="doc_v_dropout")(doc_vector)
 
         doc_output = Dense(1, activation="sigmoid", name="doc_prediction")(doc_vector)
         
@@ -406,54 +888,252 @@ class RationaleCNN:
         print(self.doc_model.summary())
 
 
+    def build_flat_sentence_model(self):
+        '''
+        A model over single sentences, (max_sent_len,) token sequences, with the
+        same embedding, conv2d_* and sentence_prediction layers (names and 
+        weight shapes) as build_RA_CNN_model; for pretraining without padded
+        pseudo documents. See train_sentence_model_flat.
+        '''
+        tokens_input = Input(name='sentence_input', 
+                            shape=(self.preprocessor.max_sent_len,), dtype='int32')
+        x = self.make_embedding()(tokens_input)
+
+        # i.e., a document of one sentence
+        convolutions = [Flatten()(conv) for conv in self.encode_sentences(x, 1)]
+
+        if len(convolutions) > 1:
+            sent_vector = concatenate(convolutions, name="sentence_vector")
+        else:
+            sent_vector = convolutions[0]
+
+        sent_preds = Dense(3, activation="softmax", name="sentence_prediction", 
+                            kernel_regularizer=l2(0.01))(sent_vector)
+
+        self.flat_sentence_model = Model(inputs=tokens_input, outputs=sent_preds)
+        self.flat_sentence_model.compile(loss='categorical_crossentropy', 
+                                    metrics=["accuracy"], optimizer="adagrad")
+
+    def transfer_flat_sentence_weights(self):
+        ''' copy the flat sentence model's (shared) layer weights into doc_model, by layer name '''
+        for layer_name in ["embedding"] + ["conv2d_"+str(n_gram) for n_gram in self.ngram_filters]:
+            self.doc_model.get_layer(layer_name).set_weights(
+                        self.flat_sentence_model.get_layer(layer_name).get_weights())
+
+        # the time distributed wrapper holds the weights of its Dense layer 
+        self.doc_model.get_layer("sentence_predictions").set_weights(
+                        self.flat_sentence_model.get_layer("sentence_prediction").get_weights())
+
     def set_final_sentence_model(self):
         '''
         allow convenient access to sentence-level predictions, after training
+        (via the inference model; see set_inference_model)
         '''
-        sent_prob_outputs = self.doc_model.get_layer("sentence_predictions")
-        sent_model = K.function(inputs=self.doc_model.inputs + [K.learning_phase()], 
-                        outputs=[sent_prob_outputs.output])
-        self.sentence_prob_model = sent_model
+        self.set_inference_model()
 
 
-    def predict_and_rank_sentences_for_doc(self, doc, num_rationales=3, threshold=0):
+    def set_inference_model(self):
         '''
-        Given a Document instance, make doc-level prediction and return
-        rationales.
+        a single (inference-only) model that shares weights with doc_model
+        and returns, in one forward pass: the document probability, the
+        per-sentence softmax, the sentence weights and the document vector.
+        (For the doc-CNN model, only the document probability and vector.)
         '''
-        # @TODO making two preds seems awkward/inefficient!
-        if self.sentence_prob_model is None:
-            self.set_final_sentence_model()
+        self.rationale_model = "sentence_predictions" in [layer.name for layer in self.doc_model.layers]
+        if not self.rationale_model:
+            outputs = [self.doc_model.get_layer(layer_name).output for layer_name in 
+                            ("doc_prediction", "document_vector")]
+            self.inference_model = Model(inputs=self.doc_model.inputs, outputs=outputs)
+            return
 
-        if doc.sentence_sequences is None:
-            # this will be the usual case
-            doc.generate_sequences(self.preprocessor)
+        outputs = [self.doc_model.get_layer(layer_name).output for layer_name in 
+                        ("doc_prediction", "sentence_predictions", "sentence_weights", "reshaped_doc")]
+        self.inference_model = Model(inputs=self.doc_model.inputs, outputs=outputs)
 
-        X_doc = np.array([doc.get_padded_sequences(self.preprocessor, labels_too=False)])
-        
-        # doc pred
-        doc_pred = self.doc_model.predict(X_doc)[0][0]
+        # the per-sentence outputs alone, for the sentence cache
+        outputs = [self.doc_model.get_layer(layer_name).output for layer_name in 
+                        ("sentence_vectors", "sentence_predictions")]
+        self.sentence_encoder_model = Model(inputs=self.doc_model.inputs, outputs=outputs)
+
+
+    def enable_sentence_cache(self, max_size=100000):
+        '''
+        Cache per-sentence outputs (sentence vectors and predictions) across 
+        predict_docs calls, for up to max_size distinct sentences, so that 
+        sentences repeated across documents (boilerplate, section headings, 
+        resubmitted documents) are only encoded once. Inference only: call 
+        self.sentence_cache.clear() if the weights change afterwards. Hit 
+        rates are available via self.sentence_cache.hit_rate().
+        '''
+        self.sentence_cache = SentenceCache(max_size)
+        return self.sentence_cache
+
+
+    def encode_sentence_rows(self, rows, batch_size=256):
+        '''
+        Sentence vectors and predictions for an (n_rows x max_sent_len) matrix 
+        of token sequences, packed into pseudo documents of max_doc_len rows.
+        '''
+        if self.sentence_encoder_model is None:
+            self.set_inference_model()
+
+        doc_len = self.preprocessor.max_doc_len
+        n_rows = rows.shape[0]
+        n_docs = -(-n_rows // doc_len)
+        X = np.zeros((n_docs * doc_len, rows.shape[1]), dtype="int32")
+        X[:n_rows] = rows
+        sent_vectors, sent_preds = self.sentence_encoder_model.predict(
+                        X.reshape(n_docs, doc_len, rows.shape[1]), batch_size=batch_size)
+        return (sent_vectors.reshape(n_docs * doc_len, -1)[:n_rows],
+                sent_preds.reshape(n_docs * doc_len, -1)[:n_rows])
 
-        # now rank sentences; 0 indicates 'test time'
-        sent_preds = self.sentence_prob_model(inputs=[X_doc, 0])[0].squeeze()[:doc.num_sentences]
 
-        # bias_prob = 1 --> low risk 
-        # recall: [1, 0, 0] -> positive rationale; [0, 1, 0] -> negative rationale
-        idx = 0
-        if doc_pred < .5:
-            # pick neg rationales
-            idx = 1
+    def predict_docs_cached(self, docs, batch_size=256):
+        '''
+        As per predict_docs, but taking sentence outputs from (and adding them
+        to) the sentence cache, so that only unseen sentences are encoded. 
+        Documents are padded (and, with n_buckets, bucketed) as per 
+        predict_docs, and padding is masked if doc_model masks it.
+        '''
+        p = self.preprocessor
+        doc_W, doc_b = self.doc_model.get_layer("doc_prediction").get_weights()
+        mask_padding = self.has_sentence_mask()
+        encode_rows = lambda rows: self.encode_sentence_rows(rows, batch_size=batch_size)
+
+        # (doc_len, doc_indices) batches
+        if self.n_buckets is None:
+            batches = [(p.max_doc_len, np.arange(start, min(start+batch_size, len(docs))))
+                            for start in range(0, len(docs), batch_size)]
+        else:
+            batches = [(bucket_len, doc_indices[start:start+batch_size]) 
+                            for bucket_len, doc_indices in RationaleCNN.bucket_documents(docs, self.n_buckets, p.max_doc_len)
+                            for start in range(0, len(doc_indices), batch_size)]
+
+        # sentence outputs are zero-padded to the longest batch
+        longest = max(doc_len for doc_len, _ in batches)
+        doc_preds = np.zeros(len(docs))
+        sent_preds = np.zeros((len(docs), longest, 3))
+        sent_weights = np.zeros((len(docs), longest))
+        doc_vectors = None
+        for doc_len, doc_indices in batches:
+            X = np.array([docs[i].get_padded_sequences(p, labels_too=False, doc_len=doc_len) 
+                            for i in doc_indices])
+            b_sent_vectors, b_sent_preds = self.sentence_cache.sentence_outputs(X, encode_rows)
+            b_doc_preds, b_sent_weights, b_doc_vectors = rationale_doc_outputs(b_sent_vectors, b_sent_preds, X, 
+                                                            mask_padding, doc_W, doc_b)
+            if doc_vectors is None:
+                doc_vectors = np.zeros((len(docs), b_doc_vectors.shape[1]))
+
+            doc_preds[doc_indices] = b_doc_preds
+            sent_preds[doc_indices, :doc_len] = b_sent_preds
+            sent_weights[doc_indices, :doc_len] = b_sent_weights
+            doc_vectors[doc_indices] = b_doc_vectors
+
+        return doc_preds, sent_preds, sent_weights, doc_vectors
+
+
+    def predict_docs(self, docs, batch_size=256):
+        '''
+        Run the fused inference model over a list of Document instances; 
+        returns (doc_preds, sentence_preds, sentence_weights, doc_vectors)
+        arrays, with rows in the same order as docs. If a sentence cache is
+        enabled (see enable_sentence_cache), predict_docs_cached is used. For
+        the doc-CNN model, the sentence outputs are None.
+        '''
+        if self.inference_model is None:
+            self.set_inference_model()
+
+        for doc in docs:
+            if doc.sentence_sequences is None:
+                # this will be the usual case
+                doc.generate_sequences(self.preprocessor)
+
+        if not self.rationale_model:
+            X_docs = np.array([doc.get_padded_sequences(self.preprocessor, labels_too=False) for doc in docs])
+            doc_preds, doc_vectors = self.inference_model.predict(X_docs, batch_size=batch_size)
+            return doc_preds[:,0], None, None, doc_vectors
+
+        if self.sentence_cache is not None:
+            return self.predict_docs_cached(docs, batch_size=batch_size)
+
+        if self.n_buckets is None:
+            X_docs = np.array([doc.get_padded_sequences(self.preprocessor, labels_too=False) for doc in docs])
+
+            doc_preds, sent_preds, sent_weights, doc_vectors = self.inference_model.predict(X_docs, batch_size=batch_size)
+            return doc_preds[:,0], sent_preds, sent_weights[:,:,0], doc_vectors
+
+        # bucketed: run each bucket at its own length, then scatter the results
+        # back into input order (sentence outputs are zero-padded to the
+        # longest bucket)
+        buckets = RationaleCNN.bucket_documents(docs, self.n_buckets, self.preprocessor.max_doc_len)
+        longest = max(bucket_len for bucket_len, _ in buckets)
+        doc_preds = np.zeros(len(docs))
+        sent_preds = np.zeros((len(docs), longest, 3))
+        sent_weights = np.zeros((len(docs), longest))
+        doc_vectors = None
+        for bucket_len, doc_indices in buckets:
+            X_bucket = np.array([docs[i].get_padded_sequences(self.preprocessor, labels_too=False, doc_len=bucket_len) 
+                                    for i in doc_indices])
+            b_doc_preds, b_sent_preds, b_sent_weights, b_doc_vectors = self.inference_model.predict(X_bucket, batch_size=batch_size)
+            if doc_vectors is None:
+                doc_vectors = np.zeros((len(docs), b_doc_vectors.shape[1]))
+
+            doc_preds[doc_indices] = b_doc_preds[:,0]
+            sent_preds[doc_indices, :bucket_len] = b_sent_preds
+            sent_weights[doc_indices, :bucket_len] = b_sent_weights[:,:,0]
+            doc_vectors[doc_indices] = b_doc_vectors
+
+        return doc_preds, sent_preds, sent_weights, doc_vectors
+
+
+    def predict_and_rank_sentences_for_doc(self, doc, num_rationales=3, threshold=0):
+        '''
+        Given a Document instance, make doc-level prediction and return
+        rationales.
+        '''
+        return self.predict_and_rank_sentences_for_docs([doc], batch_size=1,
+                                                        num_rationales=num_rationales,
+                                                        threshold=threshold)[0]
+
 
-        rationale_indices = sent_preds[:,idx].argsort()[-num_rationales:]
-        rationales = [doc.sentences[r_idx] for r_idx in rationale_indices]
+    def predict_and_rank_sentences_for_docs(self, docs, batch_size=256, num_rationales=3, threshold=0,
+                                            store=None):
+        '''
+        Batched version of predict_and_rank_sentences_for_doc. Given a list of
+        Document instances, returns a list of (doc_pred, rationales) tuples,
+        in the same order as docs. Sentences with a rationale probability
+        below threshold are not returned as rationales. If store (a 
+        prediction_store.PredictionStore) is given, only documents not 
+        already in it are scored.
+        '''
+        if store is not None:
+            return store.predict_and_rank_sentences_for_docs(self, docs, batch_size=batch_size,
+                                                             num_rationales=num_rationales,
+                                                             threshold=threshold)
 
-        return (doc_pred, rationales)
+        # doc and sentence preds from a single forward pass
+        doc_preds, sent_preds, _, _ = self.predict_docs(docs, batch_size=batch_size)
+        return rank_rationales(docs, doc_preds, sent_preds, self.preprocessor.max_doc_len,
+                                num_rationales=num_rationales, threshold=threshold)
 
 
     def train_sentence_model(self, train_documents, nb_epoch=5, 
                                 downsample=True, 
                                 sent_val_split=.2, 
-                                sentence_model_weights_path="sentence_model_weights.hdf5"):
+                                sentence_model_weights_path="sentence_model_weights.hdf5",
+                                keep_sampled_sentences=False,
+                                prefetch_depth=1, flat=False):
+        '''
+        if keep_sampled_sentences is True (and downsampling), the sentences 
+        comprising the most recent epoch's pseudo documents are kept in 
+        self.sampled_sentences, e.g., for inspection.
+
+        prefetch_depth: when downsampling, the number of epochs' pseudo 
+        documents to build ahead of training (0 to sample synchronously).
+
+        flat: if True, pretrain on individual sentences rather than on 
+        (pseudo) documents; see train_sentence_model_flat.
+        '''
 
         # assumes sentence sequences have been generated!
         assert(train_documents[0].sentence_sequences is not None)
@@ -465,6 +1145,22 @@ class RationaleCNN:
         validation_size = int(sent_val_split*len(train_documents))
         print("using sentences from %s docs for sentence prediction validation!" % 
                     validation_size)
+
+        if flat:
+            self.train_sentence_model_flat(train_documents[:-validation_size], 
+                                            train_documents[-validation_size:],
+                                            nb_epoch=nb_epoch, prefetch_depth=prefetch_depth,
+                                            sentence_model_weights_path=sentence_model_weights_path)
+            self.finalize_sentence_model(sentence_model_weights_path)
+            return 
+
+        if self.n_buckets is not None:
+            self.train_sentence_model_bucketed(train_documents[:-validation_size], 
+                                                train_documents[-validation_size:],
+                                                nb_epoch=nb_epoch, downsample=downsample,
+                                                sentence_model_weights_path=sentence_model_weights_path)
+            self.finalize_sentence_model(sentence_model_weights_path)
+            return 
     
         #######
         # build the train and validation sets
@@ -503,40 +1199,35 @@ class RationaleCNN:
 
             # then draw nb_epoch balanced samples; take one pass on each
             skip_count = 0
-            for iter_ in range(nb_epoch):
+            # the rows each document's pseudo documents are drawn from; 
+            # these don't change across epochs
+            sampling_indices = RationaleCNN.rationale_sampling_indices(y_sent)
+
+            '''
+            A tricky bit here is that the model expects a given doc length as input,
+            so here we take a kind of hacky approach of duplicating the downsampled
+            rows per documents. Basically this assembles 'balanced' pseudo documents
+            for input to the model (all at once; see balanced_sample_docs). These 
+            are built in the background, while the preceding epoch trains.
+            '''
+            def sample_epoch(random_state):
+                X_temp, y_sent_temp, sampled_rows = RationaleCNN.balanced_sample_docs(X_doc, y_sent, sampling_indices,
+                                                                                      random_state=random_state)
+                return X_temp, y_sent_temp, self.sentence_sample_weights(X_temp), sampled_rows
+
+            epochs = EpochPrefetcher(sample_epoch, nb_epoch, queue_depth=prefetch_depth)
+            for iter_, (X_temp, y_sent_temp, w_temp, sampled_rows) in enumerate(epochs):
 
                 print ("on epoch: %s" % iter_)
 
-                X_temp, y_sent_temp, sentences_temp = [], [], []
-                for i in range(X_doc.shape[0]):
-                    # i is indexing the document here!
-                    X_doc_i = X_doc[i]
-                    y_sent_i = y_sent[i]
-
-                    # downsample each document
-                        
-                    '''
-                    A tricky bit here is that the model expects a given doc length as input,
-                    so here we take a kind of hacky approach of duplicating the downsampled
-                    rows per documents. Basically this assembles 'balanced' pseudo documents
-                    for input to the model.
-                    '''
-                    n_target_rows = X_doc_i.shape[0]
-                    X_doc_i_temp, y_sent_i_temp, sampled_sentences = RationaleCNN.balanced_sample(X_doc_i, y_sent_i, 
-                                                                                sentences=train_sentences[i],
-                                                                                n_rows=n_target_rows)
-                   
-                    
-                    X_temp.append(X_doc_i_temp)
-                    y_sent_temp.append(y_sent_i_temp)
-                    sentences_temp.append(sampled_sentences)
-
-                X_temp = np.array(X_temp)
-                y_sent_temp = np.array(y_sent_temp)
+                if keep_sampled_sentences:
+                    self.sampled_sentences = [[train_sentences[i][r_idx] for r_idx in rows] 
+                                                for i, rows in enumerate(sampled_rows)]
                 
-                self.sentence_model.fit(X_temp, y_sent_temp, epochs=1)
+                self.sentence_model.fit(X_temp, y_sent_temp, epochs=1, sample_weight=w_temp)
 
-                cur_val_results = self.sentence_model.evaluate(X_doc_validation, y_sent_validation)
+                cur_val_results = self.sentence_model.evaluate(X_doc_validation, y_sent_validation, 
+                                        sample_weight=self.sentence_sample_weights(X_doc_validation))
                 #import pdb; pdb.set_trace()
                 out_str = ["%s: %s" % (metric, val) for metric, val in zip(self.sentence_model.metrics_names, cur_val_results)]
                 print ("\n".join(out_str))
@@ -562,37 +1253,170 @@ class RationaleCNN:
 
             hist = self.sentence_model.fit(X_doc, y_sent, 
                         epochs=nb_epoch, 
-                        validation_data=(X_doc_validation, y_sent_validation),
+                        sample_weight=self.sentence_sample_weights(X_doc),
+                        validation_data=(X_doc_validation, y_sent_validation, 
+                                            self.sentence_sample_weights(X_doc_validation)),
                         callbacks=[checkpointer])
 
 
-        
+        self.finalize_sentence_model(sentence_model_weights_path)
 
+
+    def finalize_sentence_model(self, sentence_model_weights_path):
         # reload best weights
         self.sentence_model.load_weights(sentence_model_weights_path)
         
         # 12/13/16 -- check if leaving sentence model trainable
         if not self.end_to_end_train:
-            print ("freezing sentence prediction layer weights!")
-            sent_softmax_layer = self.doc_model.get_layer("sentence_predictions")
-            sent_softmax_layer.trainable = False 
+            self.freeze_sentence_predictions()
 
-            # after freezing these weights, recompile doc model (as per 
-            # https://keras.io/getting-started/faq/#how-can-i-freeze-keras-layers)
-            self.doc_model.compile(metrics=["accuracy",     
-                                        RationaleCNN.metric_func_maker(metric_name="f", beta=self.f_beta), 
-                                        RationaleCNN.metric_func_maker(metric_name="recall"), 
-                                        RationaleCNN.metric_func_maker(metric_name="precision")], 
-                                        loss="binary_crossentropy", optimizer="adadelta")
+    def freeze_sentence_predictions(self):
+        sent_softmax_layer = self.doc_model.get_layer("sentence_predictions")
+        if not sent_softmax_layer.trainable:
+            # already frozen (e.g., model reused across search trials);
+            # no need to recompile
+            return 
+
+        print ("freezing sentence prediction layer weights!")
+        sent_softmax_layer.trainable = False 
+
+        # after freezing these weights, recompile doc model (as per 
+        # https://keras.io/getting-started/faq/#how-can-i-freeze-keras-layers)
+        self.doc_model.compile(metrics=["accuracy",     
+                                    RationaleCNN.metric_func_maker(metric_name="f", beta=self.f_beta), 
+                                    RationaleCNN.metric_func_maker(metric_name="recall"), 
+                                    RationaleCNN.metric_func_maker(metric_name="precision")], 
+                                    loss="binary_crossentropy", optimizer="adadelta")
+
+    def train_sentence_model_flat(self, train_documents, validation_documents, nb_epoch=5, 
+                                    batch_size=128, prefetch_depth=1,
+                                    sentence_model_weights_path="sentence_model_weights.hdf5"):
+        '''
+        Pretrain the sentence-level layers on a flat (n_sentences x max_sent_len)
+        matrix of the (unpadded) sentences of documents with rationales, in 
+        exactly class-balanced minibatches (see balanced_sentence_order). The
+        best weights (by validation loss) are then copied into doc_model by 
+        layer name and saved to sentence_model_weights_path, in the layout 
+        of self.sentence_model.
+        '''
+        def _flat_sentences(documents):
+            X, y = [], []
+            for d in documents:
+                cur_y = np.array(d.sentences_y)
+                if np.max(cur_y[:,:2]) > 0:
+                    X.append(d.sentence_sequences)
+                    y.append(cur_y)
+            return np.vstack(X), np.vstack(y)
+
+        X, y = _flat_sentences(train_documents)
+        X_validation, y_validation = _flat_sentences(validation_documents)
+        print("pretraining on %s sentences (validating on %s)" % (X.shape[0], X_validation.shape[0]))
+
+        self.build_flat_sentence_model()
+
+        def sample_epoch(random_state):
+            rows = RationaleCNN.balanced_sentence_order(y, random_state=random_state)
+            return X[rows], y[rows]
+
+        best_loss, best_weights = np.inf, None
+        epochs = EpochPrefetcher(sample_epoch, nb_epoch, queue_depth=prefetch_depth)
+        for iter_, (X_temp, y_temp) in enumerate(epochs):
+            print ("on epoch: %s" % iter_)
+
+            # don't shuffle, so as to keep minibatches balanced
+            self.flat_sentence_model.fit(X_temp, y_temp, batch_size=batch_size, epochs=1, 
+                                            shuffle=False)
+
+            cur_val_results = self.flat_sentence_model.evaluate(X_validation, y_validation, 
+                                                                batch_size=batch_size)
+            out_str = ["%s: %s" % (metric, val) for metric, val in zip(self.flat_sentence_model.metrics_names, cur_val_results)]
+            print ("\n".join(out_str))
+
+            loss, cur_acc = cur_val_results
+            if loss < best_loss:
+                best_loss = loss 
+                best_weights = self.flat_sentence_model.get_weights()
+                print("new best sentence loss: %s\n" % best_loss)
+
+        # (no epochs, or no finite validation loss: keep the current weights)
+        if best_weights is not None:
+            self.flat_sentence_model.set_weights(best_weights)
+        self.transfer_flat_sentence_weights()
+        self.sentence_model.save_weights(sentence_model_weights_path, overwrite=True)
+
+    def train_sentence_model_bucketed(self, train_documents, validation_documents, nb_epoch=5, 
+                                        downsample=True, 
+                                        sentence_model_weights_path="sentence_model_weights.hdf5"):
+        '''
+        length-bucketed variant of train_sentence_model: each bucket of documents 
+        is padded only to its own length; weights are shared across buckets.
+        '''
+        def _has_rationale(d):
+            y = np.array(d.sentences_y[:self.preprocessor.max_doc_len])
+            return y.shape[0] > 0 and np.max(y[:,:2]) > 0
+
+        def _bucket_sets(documents):
+            # only train/validate on docs that actually have at least one rationale
+            documents = [d for d in documents if _has_rationale(d)]
+            bucket_sets = []
+            for bucket_len, doc_indices in RationaleCNN.bucket_documents(documents, self.n_buckets, 
+                                                                          self.preprocessor.max_doc_len,
+                                                                          verbose=True):
+                X_y = [documents[i].get_padded_sequences(self.preprocessor, doc_len=bucket_len) for i in doc_indices]
+                bucket_sets.append((np.array([X for X, _ in X_y]), np.array([y for _, y in X_y])))
+            return bucket_sets
+
+        train_sets = _bucket_sets(train_documents)
+        validation_sets = _bucket_sets(validation_documents)
+        sampling_indices = [RationaleCNN.rationale_sampling_indices(y_sent_bucket) for _, y_sent_bucket in train_sets]
+
+        best_loss = np.inf
+        for iter_ in range(nb_epoch):
+            print ("on epoch: %s" % iter_)
+
+            for b in np.random.permutation(len(train_sets)):
+                X_bucket, y_sent_bucket = train_sets[b]
+                if downsample:
+                    # balanced pseudo documents, as in train_sentence_model
+                    X_bucket, y_sent_bucket, _ = RationaleCNN.balanced_sample_docs(X_bucket, y_sent_bucket, 
+                                                                                   sampling_indices[b])
+
+                self.sentence_model.fit(X_bucket, y_sent_bucket, epochs=1, 
+                                        sample_weight=self.sentence_sample_weights(X_bucket))
+
+            cur_val_results = RationaleCNN.evaluate_buckets(self.sentence_model, validation_sets, 
+                                                            sample_weight_func=self.sentence_sample_weights)
+            out_str = ["%s: %s" % (metric, val) for metric, val in zip(self.sentence_model.metrics_names, cur_val_results)]
+            print ("\n".join(out_str))
+
+            loss, cur_acc = cur_val_results
+            if loss < best_loss:
+                best_loss = loss 
+                self.sentence_model.save_weights(sentence_model_weights_path, overwrite=True)
+                print("new best sentence accuracy: %s\n" % cur_acc)
+                print("new best sentence loss: %s\n" % best_loss)
 
     def train_document_model(self, train_documents, nb_epoch=5, downsample=False, 
                                 doc_val_split=.2, batch_size=50,
                                 document_model_weights_path="document_model_weights.hdf5",
-                                pos_class_weight=1):
-
+                                pos_class_weight=1, prefetch_depth=1):
+        '''
+        prefetch_depth: when downsampling, the number of epochs' samples to 
+                    build ahead of training (0 to sample synchronously).
+        '''
         validation_size = int(doc_val_split*len(train_documents))
         print("validating using %s out of %s train documents." % (validation_size, len(train_documents)))
 
+        if self.n_buckets is not None:
+            self.train_document_model_bucketed(train_documents[:-validation_size], 
+                                                train_documents[-validation_size:],
+                                                nb_epoch=nb_epoch, downsample=downsample,
+                                                batch_size=batch_size, 
+                                                document_model_weights_path=document_model_weights_path,
+                                                pos_class_weight=pos_class_weight)
+            self.doc_model.load_weights(document_model_weights_path)
+            return 
+
         ###
         # build the train set
         ###
@@ -626,13 +1450,15 @@ class RationaleCNN:
 
             cur_f, best_f = None, -np.inf  # - inf for F-score
 
-            # then draw nb_epoch balanced samples; take one pass on each
-            for iter_ in range(nb_epoch):
+            # then draw nb_epoch balanced samples (in the background; 
+            # see EpochPrefetcher); take one pass on each
+            epochs = EpochPrefetcher(lambda random_state: RationaleCNN.balanced_sample(X_doc, y_doc, binary=True,
+                                                                                        random_state=random_state),
+                                     nb_epoch, queue_depth=prefetch_depth)
+            for iter_, (X_tmp, y_tmp) in enumerate(epochs):
 
                 print ("on epoch: %s" % iter_)
 
-                X_tmp, y_tmp = RationaleCNN.balanced_sample(X_doc, y_doc, binary=True)
-
                 self.doc_model.fit(X_tmp, y_tmp, batch_size=batch_size, epochs=1,
                                          class_weight={0:1, 1:pos_class_weight})
 
@@ -667,6 +1493,56 @@ class RationaleCNN:
         # reload best weights
         self.doc_model.load_weights(document_model_weights_path)
 
+    def train_document_model_bucketed(self, train_documents, validation_documents, nb_epoch=5, 
+                                        downsample=False, batch_size=50,
+                                        document_model_weights_path="document_model_weights.hdf5",
+                                        pos_class_weight=1):
+        '''
+        length-bucketed variant of train_document_model: each bucket of documents 
+        is padded only to its own length; weights are shared across buckets.
+        '''
+        def _bucket_sets(documents):
+            bucket_sets = []
+            for bucket_len, doc_indices in RationaleCNN.bucket_documents(documents, self.n_buckets, 
+                                                                          self.preprocessor.max_doc_len,
+                                                                          verbose=True):
+                X_bucket = np.array([documents[i].get_padded_sequences(self.preprocessor, labels_too=False, 
+                                                                         doc_len=bucket_len) for i in doc_indices])
+                y_bucket = np.array([documents[i].doc_y for i in doc_indices])
+                bucket_sets.append((X_bucket, y_bucket))
+            return bucket_sets
+
+        train_sets = _bucket_sets(train_documents)
+        validation_sets = _bucket_sets(validation_documents)
+
+        # as in train_document_model, select on F when downsampling and 
+        # on accuracy otherwise
+        best_val = -np.inf
+        for iter_ in range(nb_epoch):
+            print ("on epoch: %s" % iter_)
+
+            for b in np.random.permutation(len(train_sets)):
+                X_bucket, y_bucket = train_sets[b]
+                if downsample:
+                    if np.sum(y_bucket > 0) == 0:
+                        # nothing to balance against in this bucket
+                        continue
+                    X_bucket, y_bucket = RationaleCNN.balanced_sample(X_bucket, y_bucket, binary=True)
+
+                self.doc_model.fit(X_bucket, y_bucket, batch_size=batch_size, epochs=1,
+                                         class_weight={0:1, 1:pos_class_weight})
+
+            cur_val_results = RationaleCNN.evaluate_buckets(self.doc_model, validation_sets, batch_size=batch_size)
+            out_str = ["%s: %s" % (metric, val) for metric, val in zip(self.doc_model.metrics_names, cur_val_results)]
+            print ("\n".join(out_str))
+
+            loss, cur_acc, cur_f, cur_recall, cur_precision = cur_val_results
+            cur_val = cur_f if downsample else cur_acc
+            if cur_val > best_val:
+                best_val = cur_val
+                self.doc_model.save_weights(document_model_weights_path, overwrite=True)
+                print("new best %s: %s\n" % ("F" if downsample else "accuracy", best_val))
+
 class Document:
     def __init__(self, doc_id, sentences, doc_label=None, sentences_labels=None, 
                     min_sent_len=1):
@@ -696,54 +1572,148 @@ class Document:
     def __len__(self):
         return self.n 
 
-    def generate_sequences(self, p):
+    def generate_sequences(self, p, sentence_sequences=None):
         ''' 
         p is a preprocessor that has been instantiated
         elsewhere! this will be used to map sentences to 
-        integer sequences here.
+        integer sequences here (unless these are passed in 
+        as sentence_sequences, e.g., by 
+        Preprocessor.generate_document_sequences).
         '''
-        self.sentence_sequences = p.build_sequences(self.sentences)
+        if sentence_sequences is None:
+            sentence_sequences = p.build_sequences(self.sentences)
+        self.sentence_sequences = sentence_sequences
         self.padded_sentences = self.sentences + [''] * (p.max_doc_len - self.n)
 
 
-    def get_padded_sequences_for_X_y(self, p, X, y):
+    def get_padded_sequences_for_X_y(self, p, X, y, doc_len=None):
+        # doc_len defaults to p.max_doc_len; shorter lengths are used
+        # for length-bucketed batches
+        if doc_len is None:
+            doc_len = p.max_doc_len
         n_sentences = X.shape[0]
-        if n_sentences > p.max_doc_len:
-            X = X[:p.max_doc_len]
-            y = y[:p.max_doc_len]
-        elif n_sentences < p.max_doc_len:
+        if n_sentences > doc_len:
+            X = X[:doc_len]
+            y = y[:doc_len]
+        elif n_sentences < doc_len:
             #dummy_rows = p.max_features * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32') 
-            dummy_rows = 0 * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32')
+            dummy_rows = 0 * np.ones((doc_len-n_sentences, p.max_sent_len), dtype='int32')
             X = np.vstack((X, dummy_rows))
         
-            dummy_lbls = [np.array([0,0,1]) for _ in range(p.max_doc_len-n_sentences)]
+            dummy_lbls = [np.array([0,0,1]) for _ in range(doc_len-n_sentences)]
             y = np.vstack((y, dummy_lbls))
 
         return np.array(X), np.array(y)
 
-    def get_padded_sequences_for_X(self, p, X):
+    def get_padded_sequences_for_X(self, p, X, doc_len=None):
+        if doc_len is None:
+            doc_len = p.max_doc_len
         n_sentences = X.shape[0]
-        if n_sentences > p.max_doc_len:
-            X = X[:p.max_doc_len]
-        elif n_sentences < p.max_doc_len:
+        if n_sentences > doc_len:
+            X = X[:doc_len]
+        elif n_sentences < doc_len:
             # pad
             #dummy_rows = p.max_features * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32') 
-            dummy_rows = 0 * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32')
+            dummy_rows = 0 * np.ones((doc_len-n_sentences, p.max_sent_len), dtype='int32')
             X = np.vstack((X, dummy_rows))
         return np.array(X)
 
 
-    def get_padded_sequences(self, p, labels_too=True):
+    def get_padded_sequences(self, p, labels_too=True, doc_len=None):
         # return p.build_sequences(self.sentences, pad_documents=True)              
         #n_sentences = self.sentence_sequences.shape[0]
         X = self.sentence_sequences
 
         if labels_too:
             y = self.sentences_y
-            return self.get_padded_sequences_for_X_y(p, X, y)
+            return self.get_padded_sequences_for_X_y(p, X, y, doc_len=doc_len)
 
         # otherwise only return X
-        return self.get_padded_sequences_for_X(p, X)
+        return self.get_padded_sequences_for_X(p, X, doc_len=doc_len)
+
+def load_word2vec_subset(path, word_index, max_features, chunk_size=1 << 20):
+    '''
+    Stream a binary word2vec file in one pass (reading chunk_size bytes at
+    a time), copying only the vectors for tokens in word_index (with index
+    <= max_features) into a preallocated (max_features+1 x dims) float32
+    matrix whose rows are keyed by token index. Row 0 (padding) and rows
+    with no token are zeros; rows for tokens not found in the file are
+    initialized randomly, as in init_word_vectors. Returns (matrix, number
+    of tokens not found).
+    '''
+    wanted = dict((w, idx) for w, idx in word_index.items() if idx <= max_features)
+
+    with open(path, 'rb') as w2v_file:
+        vocab_size, dims = [int(x) for x in w2v_file.readline().split()]
+        matrix = np.zeros((max_features+1, dims), dtype="float32")
+        found = np.zeros(max_features+1, dtype=bool)
+        n_bytes = dims * np.dtype("float32").itemsize
+
+        buf, pos, eof = b'', 0, False
+        n_remaining = len(wanted)
+        for _ in range(vocab_size):
+            if n_remaining == 0:
+                # everything we need has been found
+                break
+
+            # as per gensim: the word runs up to a space (ignoring newlines),
+            # and is followed by its vector; read on until both are buffered
+            space = buf.find(b' ', pos)
+            while (space < 0 or len(buf) - (space + 1) < n_bytes) and not eof:
+                chunk = w2v_file.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                space = buf.find(b' ')
+            if space < 0 or len(buf) - (space + 1) < n_bytes:
+                # (truncated file)
+                break
+
+            idx = wanted.get(buf[pos:space].replace(b'\n', b'').decode("utf-8", "ignore"))
+            if idx is not None and not found[idx]:
+                matrix[idx] = np.frombuffer(buf, dtype="<f4", count=dims, offset=space + 1)
+                found[idx] = True
+                n_remaining -= 1
+            pos = space + 1 + n_bytes
+
+    oov_indices = [idx for idx in wanted.values() if not found[idx]]
+    random_init_rows(matrix, oov_indices)
+    return matrix, len(oov_indices)
+
+def random_init_rows(matrix, row_indices):
+    ''' randomly (uniform in (-1, 1]) initialize the given rows of an embedding matrix, in one draw '''
+    matrix[row_indices] = np.random.random((len(row_indices), matrix.shape[1]))*-2 + 1
+
+
+# worker-side state and functions for the parallel Preprocessor methods; 
+# each pool worker gets its own (text-free) copy of the preprocessor.
+_worker_preprocessor = None
+
+def _init_preprocessor_worker(p):
+    global _worker_preprocessor
+    _worker_preprocessor = p
+
+def _count_tokens_worker(texts):
+    ''' token and document counts for a shard of texts, as per Tokenizer.fit_on_texts '''
+    p = _worker_preprocessor
+    if p.stopword:
+        texts = p.remove_stopwords(texts)
+
+    # a fresh tokenizer (with the same settings) for the splitting, in case 
+    # p.tokenizer is a keras one
+    tokenizer = p.tokenizer
+    splitter = Tokenizer(filters=tokenizer.filters, lower=tokenizer.lower, split=tokenizer.split)
+    word_counts, word_docs = OrderedDict(), {}
+    for text in texts:
+        seq = splitter.text_to_word_sequence(text)
+        for w in seq:
+            word_counts[w] = word_counts.get(w, 0) + 1
+        for w in set(seq):
+            word_docs[w] = word_docs.get(w, 0) + 1
+    return word_counts, word_docs, len(texts)
+
+def _build_sequences_worker(texts):
+    return _worker_preprocessor.build_sequences(texts)
+
 
 class Preprocessor:
     def __init__(self, max_features, max_sent_len, embedding_dims=200, wvs=None, 
@@ -776,51 +1746,191 @@ class Preprocessor:
         self.stopword = stopword
         # lifted directly from spacy's EN list
         #self.stopwords = [u'all', u'six', u'just', u'less', u'being', u'indeed', u'over', u'move', u'anyway', u'four', u'not', u'own', u'through', u'using', u'fify', u'where', u'mill', u'only', u'find', u'before', u'one', u'whose', u'system', u'how', u'somewhere', u'much', u'thick', u'show', u'had', u'enough', u'should', u'to', u'must', u'whom', u'seeming', u'yourselves', u'under', u'ours', u'two', u'has', u'might', u'thereafter', u'latterly', u'do', u'them', u'his', u'around', u'than', u'get', u'very', u'de', u'none', u'cannot', u'every', u'un', u'they', u'front', u'during', u'thus', u'now', u'him', u'nor', u'name', u'regarding', u'several', u'hereafter', u'did', u'always', u'who', u'didn', u'whither', u'this', u'someone', u'either', u'each', u'become', u'thereupon', u'sometime', u'side', u'towards', u'therein', u'twelve', u'because', u'often', u'ten', u'our', u'doing', u'km', u'eg', u'some', u'back', u'used', u'up', u'go', u'namely', u'computer', u'are', u'further', u'beyond', u'ourselves', u'yet', u'out', u'even', u'will', u'what', u'still', u'for', u'bottom', u'mine', u'since', u'please', u'forty', u'per', u'its', u'everything', u'behind', u'does', u'various', u'above', u'between', u'it', u'neither', u'seemed', u'ever', u'across', u'she', u'somehow', u'be', u'we', u'full', u'never', u'sixty', u'however', u'here', u'otherwise', u'were', u'whereupon', u'nowhere', u'although', u'found', u'alone', u're', u'along', u'quite', u'fifteen', u'by', u'both', u'about', u'last', u'would', u'anything', u'via', u'many', u'could', u'thence', u'put', u'against', u'keep', u'etc', u'amount', u'became', u'ltd', u'hence', u'onto', u'or', u'con', u'among', u'already', u'co', u'afterwards', u'formerly', u'within', u'seems', u'into', u'others', u'while', u'whatever', u'except', u'down', u'hers', u'everyone', u'done', u'least', u'another', u'whoever', u'moreover', u'couldnt', u'throughout', u'anyhow', u'yourself', u'three', u'from', u'her', u'few', u'together', u'top', u'there', u'due', u'been', u'next', u'anyone', u'eleven', u'cry', u'call', u'therefore', u'interest', u'then', u'thru', u'themselves', u'hundred', u'really', u'sincere', u'empty', u'more', u'himself', u'elsewhere', u'mostly', u'on', u'fire', u'am', u'becoming', u'hereby', u'amongst', u'else', u'part', u'everywhere', u'too', u'kg', u'herself', u'former', u'those', u'he', u'me', u'myself', u'made', u'twenty', u'these', u'was', u'bill', u'cant', u'us', u'until', u'besides', u'nevertheless', u'below', u'anywhere', u'nine', u'can', u'whether', u'of', u'your', u'toward', u'my', u'say', u'something', u'and', u'whereafter', u'whenever', u'give', u'almost', u'wherever', u'is', u'describe', u'beforehand', u'herein', u'doesn', u'an', u'as', u'itself', u'at', u'have', u'in', u'seem', u'whence', u'ie', u'any', u'fill', u'again', u'hasnt', u'inc', u'thereby', u'thin', u'no', u'perhaps', u'latter', u'meanwhile', u'when', u'detail', u'same', u'wherein', u'beside', u'also', u'that', u'other', u'take', u'which', u'becomes', u'you', u'if', u'nobody', u'unless', u'whereas', u'see', u'though', u'may', u'after', u'upon', u'most', u'hereupon', u'eight', u'but', u'serious', u'nothing', u'such', u'why', u'off', u'a', u'don', u'whereby', u'third', u'i', u'whole', u'noone', u'sometimes', u'well', u'amoungst', u'yours', u'their', u'rather', u'without', u'so', u'five', u'the', u'first', u'with', u'make', u'once']
-        self.stopwords = ["a", "about", "again", "all", "almost", "also", "although", "always", "among", "an", "and", "another", "any", "are", "as", "at", "b", "be", "because", "been", "before", "being", "between", "both", "but", "by", "c", "can", "could", "did", "do", "d", "does", "each", "either", "enough", "etc", "f", "for", "from", "had", "has", "have", "here", "how", "h", "i", "if", "in", "into", "is", "it", "its", "j", "just", "k", "made", "make", "may", "must", "n", "o", "of", "often", "on", "p", "q", "r", "s", "so", "that", "the", "them", "then", "their", "those", "thus", "to", "t", "u", "use", "used", "v", "w", "x", "y", "z", "we", "was"]
+        self.stopwords = set(["a", "about", "again", "all", "almost", "also", "although", "always", "among", "an", "and", "another", "any", "are", "as", "at", "b", "be", "because", "been", "before", "being", "between", "both", "but", "by", "c", "can", "could", "did", "do", "d", "does", "each", "either", "enough", "etc", "f", "for", "from", "had", "has", "have", "here", "how", "h", "i", "if", "in", "into", "is", "it", "its", "j", "just", "k", "made", "make", "may", "must", "n", "o", "of", "often", "on", "p", "q", "r", "s", "so", "that", "the", "them", "then", "their", "those", "thus", "to", "t", "u", "use", "used", "v", "w", "x", "y", "z", "we", "was"])
+
+        # maps raw (space-delimited) tokens to their token indices; filled 
+        # lazily by build_sequences and reset whenever the tokenizer is fit
+        self.token_cache = {}
+
 
+    def get_settings(self):
+        ''' the preprocessing settings, e.g., for saving in a model bundle '''
+        tokenizer = self.tokenizer
+        return {"max_features": self.max_features, "max_sent_len": self.max_sent_len,
+                "max_doc_len": self.max_doc_len, "embedding_dims": self.embedding_dims,
+                "stopword": self.stopword, "filters": tokenizer.filters, 
+                "lower": tokenizer.lower, "split": tokenizer.split}
+
+    @staticmethod
+    def from_settings(settings, vocabulary):
+        ''' a Preprocessor with the given settings (as per get_settings) and vocabulary '''
+        p = Preprocessor(settings["max_features"], settings["max_sent_len"], 
+                         embedding_dims=settings["embedding_dims"], 
+                         max_doc_len=settings["max_doc_len"], stopword=settings["stopword"])
+        p.tokenizer = Tokenizer(num_words=settings["max_features"], filters=settings["filters"], 
+                                lower=settings["lower"], split=settings["split"])
+        p.set_vocabulary(vocabulary)
+        return p
+
+    def __getstate__(self):
+        # no need to pickle the token cache; it is rebuilt on demand
+        state = self.__dict__.copy()
+        state["token_cache"] = {}
+        return state
 
     def remove_stopwords(self, texts):
-        stopworded_texts = []
-        for text in texts: 
-            # note the naive segmentation; although this is same as the 
-            # keras module does.
-            #stopworded_text = " ".join([t for t in text.split(" ") if not t.lower() in self.stopwords])
-            stopworded_text = []
-            for t in text.split(" "):
-                if not t in self.stopwords:
-                    if t.isdigit():
-                        t = "numbernumbernumber"
-                    stopworded_text.append(t)
-            #stopworded_text = " ".join([t for t in text.split(" ") if not t in self.stopwords])
-            stopworded_text = " ".join(stopworded_text)
-            stopworded_texts.append(stopworded_text)
-        return stopworded_texts
+        # note the naive segmentation; although this is same as the 
+        # keras module does.
+        stopwords = self.stopwords
+        return [" ".join(["numbernumbernumber" if t.isdigit() else t 
+                            for t in text.split(" ") if t not in stopwords]) 
+                    for text in texts]
 
 
-    def preprocess(self, all_docs):
+    def preprocess(self, all_docs, n_jobs=1):
         ''' 
         This fits tokenizer and builds up input vectors (X) from the list 
         of texts in all_texts. Needs to be called before train!
+
+        If n_jobs > 1, the tokenizer is fit using a pool of n_jobs processes
+        (see fit_tokenizer_parallel); in this case processed_texts is not kept.
         '''
         self.raw_texts = all_docs
-        if self.stopword:
-            #for text in self.raw_texts: 
-            self.processed_texts = self.remove_stopwords(self.raw_texts)
+        if n_jobs > 1:
+            self.processed_texts = None
+            self.fit_tokenizer_parallel(n_jobs)
         else:
-            self.processed_texts = self.raw_texts
+            if self.stopword:
+                #for text in self.raw_texts: 
+                self.processed_texts = self.remove_stopwords(self.raw_texts)
+            else:
+                self.processed_texts = self.raw_texts
+
+            self.fit_tokenizer()
 
-        self.fit_tokenizer()
         if self.use_pretrained_embeddings:
             self.init_word_vectors()
 
 
+    def preprocess_stream(self, sentences):
+        '''
+        As per preprocess, but fits the tokenizer to an iterable of sentences 
+        (e.g., a generator over a streamed corpus) as they are read, without 
+        keeping them; the fitted vocabulary is the same.
+        '''
+        self.raw_texts, self.processed_texts = None, None
+        if self.stopword:
+            sentences = (self.remove_stopwords([s])[0] for s in sentences)
+        self.tokenizer.fit_on_texts(sentences)
+        self.set_word_indices()
+
+        if self.use_pretrained_embeddings:
+            self.init_word_vectors()
+
     def fit_tokenizer(self):
         ''' Fits tokenizer to all raw texts; remembers indices->words mappings. '''
         self.tokenizer.fit_on_texts(self.processed_texts)
+        self.set_word_indices()
+
+    def set_vocabulary(self, words):
+        ''' 
+        Set the tokenizer vocabulary directly (e.g., from a cache) rather than
+        fitting it; words should be ordered by token index (starting at 1).
+        '''
+        self.tokenizer.word_index = dict(zip(words, range(1, len(words)+1)))
+        self.set_word_indices()
+        if self.use_pretrained_embeddings:
+            self.init_word_vectors()
+
+    def get_vocabulary(self):
+        ''' the tokenizer vocabulary, as a list of words ordered by token index '''
+        word_index = self.tokenizer.word_index
+        return sorted(word_index, key=word_index.get)
+
+    def set_word_indices(self):
+        self.token_cache = {}
         self.word_indices_to_words = {}
         for token, idx in self.tokenizer.word_index.items():
             self.word_indices_to_words[idx] = token
 
+    def worker_copy(self):
+        ''' a shallow copy without the (large) texts and vectors, to ship to pool workers '''
+        p = copy.copy(self)
+        p.raw_texts, p.processed_texts = None, None
+        p.word_embeddings, p.init_vectors = None, None
+        p.token_cache = {}
+        return p
+
+    @staticmethod
+    def shard(texts, shard_size):
+        return [texts[i:i+shard_size] for i in range(0, len(texts), shard_size)]
+
+    def fit_tokenizer_parallel(self, n_jobs, shard_size=10000):
+        ''' 
+        Fits tokenizer to raw_texts by counting tokens over contiguous shards in a
+        pool of n_jobs processes. Shard counts are merged in order, so the 
+        resulting vocabulary (including the order of ties) is identical to 
+        that produced by Tokenizer.fit_on_texts.
+        '''
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_preprocessor_worker, 
+                                    initargs=(self.worker_copy(),))
+        try:
+            shard_counts = pool.map(_count_tokens_worker, Preprocessor.shard(self.raw_texts, shard_size))
+        finally:
+            pool.close()
+            pool.join()
+
+        word_counts, word_docs, document_count = OrderedDict(), {}, 0
+        for shard_word_counts, shard_word_docs, shard_document_count in shard_counts:
+            for w, c in shard_word_counts.items():
+                word_counts[w] = word_counts.get(w, 0) + c
+            for w, c in shard_word_docs.items():
+                word_docs[w] = word_docs.get(w, 0) + c
+            document_count += shard_document_count
+
+        # as per keras: the sort is stable, so ties are broken by first occurrence
+        tokenizer = self.tokenizer
+        tokenizer.word_counts, tokenizer.word_docs = word_counts, word_docs
+        tokenizer.document_count = document_count
+        sorted_voc = [w for w, _ in sorted(word_counts.items(), key=lambda x: x[1], reverse=True)]
+        tokenizer.word_index = dict(zip(sorted_voc, range(1, len(sorted_voc)+1)))
+        tokenizer.index_docs = dict((tokenizer.word_index[w], c) for w, c in word_docs.items())
+
+        self.set_word_indices()
+
+    def build_sequences_parallel(self, texts, n_jobs, shard_size=10000):
+        ''' as per build_sequences, but over shards of texts in a pool of n_jobs processes '''
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_preprocessor_worker, 
+                                    initargs=(self.worker_copy(),))
+        try:
+            blocks = pool.map(_build_sequences_worker, Preprocessor.shard(texts, shard_size))
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(blocks) == 0:
+            return np.zeros((0, self.max_sent_len), dtype="int32")
+        return np.vstack(blocks)
+
+    def generate_document_sequences(self, documents, n_jobs=1):
+        ''' 
+        Batch version of Document.generate_sequences: builds the sequences for 
+        all sentences at once (in parallel if n_jobs > 1) and hands each 
+        document a view onto its rows.
+        '''
+        all_sentences, offsets = [], [0]
+        for d in documents:
+            all_sentences.extend(d.sentences)
+            offsets.append(len(all_sentences))
+
+        if n_jobs > 1:
+            X = self.build_sequences_parallel(all_sentences, n_jobs)
+        else:
+            X = self.build_sequences(all_sentences)
+
+        for i, d in enumerate(documents):
+            d.generate_sequences(self, sentence_sequences=X[offsets[i]:offsets[i+1]])
+
 
     def decode(self, x):
         ''' For convenience; map from word index vector to words'''
@@ -832,39 +1942,117 @@ class Preprocessor:
                 words.append(self.word_indices_to_words[t_idx])
         return " ".join(words) 
 
-    def build_sequences(self, texts, pad_documents=False):
-        processed_texts = texts 
+    def token_to_indices(self, t):
+        '''
+        Map a single raw (space-delimited) token to its list of token indices,
+        applying stopwording and digit mapping, then the same lower-casing, 
+        character filtering, splitting and vocabulary cut-off as keras' 
+        Tokenizer.texts_to_sequences.
+        '''
         if self.stopword:
-            processed_texts = self.remove_stopwords(texts)
+            if t in self.stopwords:
+                return []
+            if t.isdigit():
+                t = "numbernumbernumber"
 
-        X = list(self.tokenizer.texts_to_sequences_generator(processed_texts))
+        tokenizer = self.tokenizer
+        if tokenizer.lower:
+            t = t.lower()
+        t = t.translate(dict((ord(c), tokenizer.split) for c in tokenizer.filters))
 
-        # need to pad the number of sentences, too.
-        X = np.array(pad_sequences(X, maxlen=self.max_sent_len))
+        word_index, num_words = tokenizer.word_index, tokenizer.num_words
+        indices = [word_index.get(w) for w in t.split(tokenizer.split) if w]
+        return [idx for idx in indices if idx is not None and not (num_words and idx >= num_words)]
+
+    def build_sequences(self, texts, pad_documents=False):
+        '''
+        Map texts to a (len(texts) x max_sent_len) int32 matrix of token indices
+        in a single pass (stopwording, digit mapping and indexing), writing 
+        directly into the output. Sequences are pre-padded and pre-truncated,
+        so this is identical to running remove_stopwords, then the tokenizer's 
+        texts_to_sequences and pad_sequences.
+        '''
+        token_cache = getattr(self, "token_cache", None)
+        if token_cache is None:
+            # preprocessors pickled before the cache existed
+            token_cache = self.token_cache = {}
+
+        X = np.zeros((len(texts), self.max_sent_len), dtype="int32")
+        for i, text in enumerate(texts):
+            seq = []
+            for t in text.split(" "):
+                indices = token_cache.get(t)
+                if indices is None:
+                    indices = token_cache[t] = self.token_to_indices(t)
+                seq.extend(indices)
+
+            # need to pad the number of sentences, too.
+            seq = seq[-self.max_sent_len:]
+            if seq:
+                X[i, self.max_sent_len-len(seq):] = seq
 
         return X
 
+    def load_word_vectors(self, path, cache_dir=None):
+        '''
+        Alternative to passing wvs to the constructor: once the tokenizer has 
+        been fit, stream the binary word2vec file at path and keep only the 
+        vectors for our vocabulary (see load_word2vec_subset). If cache_dir 
+        is given, the resulting matrix is cached there, keyed by the word2vec
+        file and the vocabulary.
+        '''
+        cache_path = None
+        if cache_dir is not None:
+            h = hashlib.sha1()
+            w2v_stat = os.stat(path)
+            h.update(("%s,%s,%s,%s" % (os.path.abspath(path), w2v_stat.st_size, 
+                                        w2v_stat.st_mtime, self.max_features)).encode("utf-8"))
+            h.update("\n".join(self.get_vocabulary()[:self.max_features]).encode("utf-8"))
+            cache_path = os.path.join(cache_dir, "w2v_subset_%s.npy" % h.hexdigest())
+
+        if cache_path is not None and os.path.exists(cache_path):
+            print("loading word vectors from cache: %s" % cache_path)
+            matrix = np.load(cache_path)
+        else:
+            matrix, n_oov = load_word2vec_subset(path, self.tokenizer.word_index, self.max_features)
+            print("%s of %s tokens not found in word vectors (randomly initialized)" % (
+                        n_oov, min(len(self.tokenizer.word_index), self.max_features)))
+            if cache_path is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                np.save(cache_path, matrix)
+
+        self.use_pretrained_embeddings = True
+        self.embedding_dims = matrix.shape[1]
+        # note that we make this a singleton list because that's
+        # what Keras wants. 
+        self.init_vectors = [matrix]
+
     def init_word_vectors(self):
         ''' 
-        Initialize word vectors.
+        Initialize word vectors: a (max_features+1 x embedding_dims) float32 
+        matrix whose rows are keyed by token index. Row 0 (padding) and rows 
+        with no token are zeros; vectors for tokens in word_embeddings are 
+        gathered in one indexing operation, and the remaining (OOV) tokens 
+        are randomly initialized in one draw.
         '''
-        self.init_vectors = []
-        unknown_words_to_vecs = {}
+        matrix = np.zeros((self.max_features+1, self.embedding_dims), dtype="float32")
+
+        wv_vocab = self.word_embeddings.vocab
+        token_indices, wv_indices, oov_indices = [], [], []
         for t, token_idx in self.tokenizer.word_index.items():
             if token_idx <= self.max_features:
-                try:
-                    self.init_vectors.append(self.word_embeddings[t])
-                except:
-                    if t not in unknown_words_to_vecs:
-                        # randomly initialize
-                        unknown_words_to_vecs[t] = np.random.random(
-                                                self.embedding_dims)*-2 + 1
-
-                    self.init_vectors.append(unknown_words_to_vecs[t])
+                if t in wv_vocab:
+                    token_indices.append(token_idx)
+                    wv_indices.append(wv_vocab[t].index)
+                else:
+                    oov_indices.append(token_idx)
 
-        # init padding token!
-        self.init_vectors.append(np.zeros(self.embedding_dims))
+        matrix[token_indices] = self.word_embeddings.syn0[wv_indices]
+        random_init_rows(matrix, oov_indices)
+        print("%s of %s tokens not found in word vectors (randomly initialized)" % (
+                    len(oov_indices), len(token_indices) + len(oov_indices)))
 
         # note that we make this a singleton list because that's
         # what Keras wants. 
-        self.init_vectors = [np.vstack(self.init_vectors)]
+        self.init_vectors = [matrix]
@@ -0,0 +1,301 @@
+'''
+Score a (large, unlabeled) corpus with a trained model, e.g.,
+
+    python score_RA_CNN.py --model=rationale-CNN_RSG.bundle --input=corpus.csv --output=scores.jsonl --n-jobs=8
+
+The input is in the training CSV format (doc_id,doc_lbl,sentence_number,
+sentence,sentence_lbl; only doc_id and sentence are used, and the rows of
+each document must be contiguous). Documents are read in batches and
+scored across n_jobs worker processes, each of which loads the model once;
+results are written (in input order) as they come back, so memory use is
+bounded by the number of batches in flight rather than the corpus size.
+
+The output is JSONL or CSV (by file extension), with the doc id, the
+predicted probability and the top-k rationales of each document. If the
+output file exists, documents already in it are skipped, so an interrupted
+run can simply be restarted (see --restart to start over instead).
+'''
+from __future__ import print_function
+import csv
+import sys
+csv.field_size_limit(sys.maxsize)
+import os
+import json
+import time
+import pickle
+import optparse
+import itertools
+import collections
+import multiprocessing
+
+# (neither imports keras)
+from rationale_CNN import Document
+from numpy_RA_CNN import NumpyRationaleCNN
+
+# the model of each worker process; see init_worker
+model = None
+
+
+def iter_sentences(path):
+    '''
+    yields (doc_id, sentences) for each document in the CSV at path, in
+    file order; as per train_RA_CNN.iter_documents (which imports keras and
+    the training dependencies), but without labels. Raises ValueError if 
+    the rows of a document are not contiguous.
+    '''
+    with open(path) as data_file:
+        reader = csv.reader(data_file)
+        id_idx, sent_idx = 0, 3
+        rows = reader
+        first_row = next(reader, None)
+        if first_row is not None:
+            if "doc_id" in first_row:
+                id_idx, sent_idx = first_row.index("doc_id"), first_row.index("sentence")
+            else:
+                # no header; put the first row back
+                rows = itertools.chain([first_row], reader)
+
+        seen_ids = set()
+        for doc_id, doc_rows in itertools.groupby(rows, key=lambda row: row[id_idx]):
+            if doc_id in seen_ids:
+                raise ValueError("rows for doc_id %s are not contiguous in %s" % (doc_id, path))
+            seen_ids.add(doc_id)
+            # replace empty entries with " ", as per read_data
+            yield doc_id, [row[sent_idx] or " " for row in doc_rows]
+
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def load_model(model_path, preprocessor_path=None, engine="numpy"):
+    '''
+    a NumpyRationaleCNN (engine "numpy") or RationaleCNN (engine "keras")
+    for the trained model at model_path; see the command line options below
+    '''
+    preprocessor = None
+    if preprocessor_path is not None:
+        with open(preprocessor_path, "rb") as preprocessor_file:
+            preprocessor = pickle.load(preprocessor_file)
+
+    if engine == "numpy":
+        return NumpyRationaleCNN(model_path, preprocessor)
+    import rationale_CNN
+    return rationale_CNN.RationaleCNN(preprocessor, bundle_path=model_path)
+
+def init_worker(model_path, preprocessor_path, engine):
+    global model
+    model = load_model(model_path, preprocessor_path, engine)
+
+def score_batch(doc_batch, forward_batch_size, num_rationales, threshold):
+    '''
+    returns (doc_id, doc_pred, rationales) for each (doc_id, sentences) in
+    doc_batch, scored forward_batch_size documents at a time
+    '''
+    docs = [Document(doc_id, sentences) for doc_id, sentences in doc_batch]
+    results = model.predict_and_rank_sentences_for_docs(docs, batch_size=forward_batch_size,
+                                                        num_rationales=num_rationales,
+                                                        threshold=threshold)
+    return [(doc.doc_id, float(doc_pred), rationales) for doc, (doc_pred, rationales) in zip(docs, results)]
+
+
+class ResultWriter:
+    ''' appends results to a JSONL or CSV file '''
+
+    def __init__(self, path, num_rationales):
+        self.path = path
+        self.csv = path.endswith(".csv")
+        self.num_rationales = num_rationales
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.out_file = open(path, "a", encoding="utf-8", newline="")
+        if self.csv:
+            self.writer = csv.writer(self.out_file, lineterminator="\n")
+            if new_file:
+                self.writer.writerow(["doc_id", "probability"] +
+                                     ["rationale_%s" % (k+1) for k in range(num_rationales)])
+
+    def write(self, results):
+        for doc_id, doc_pred, rationales in results:
+            if self.csv:
+                rationales = list(rationales) + [""] * (self.num_rationales - len(rationales))
+                self.writer.writerow([doc_id, doc_pred] + rationales)
+            else:
+                self.out_file.write(json.dumps({"doc_id": doc_id, "probability": doc_pred,
+                                                "rationales": rationales}) + "\n")
+        # so that a restarted run sees every batch written so far
+        self.out_file.flush()
+
+    def close(self):
+        self.out_file.close()
+
+def complete_csv_length(contents):
+    '''
+    the length (in bytes) of the complete records at the start of CSV
+    contents; as rationales may contain newlines, a record does not
+    necessarily end at the last newline
+    '''
+    lines = [line + b"\n" for line in contents.split(b"\n")[:-1]]
+    n_read = [0]
+    def _lines():
+        for line in lines:
+            n_read[0] += len(line)
+            yield line.decode("utf-8")
+
+    complete_len = 0
+    try:
+        # (strict, so that a record cut off inside a quoted value is an error)
+        for _ in csv.reader(_lines(), strict=True):
+            complete_len = n_read[0]
+    except csv.Error:
+        pass
+    return complete_len
+
+def completed_doc_ids(path):
+    '''
+    the ids of documents already in the output at path; truncates a
+    partially written final record, if any (e.g., from a killed run)
+    '''
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, "rb+") as out_file:
+        contents = out_file.read()
+        if path.endswith(".csv"):
+            complete_len = complete_csv_length(contents)
+        else:
+            complete_len = contents.rfind(b"\n") + 1
+        if complete_len < len(contents):
+            out_file.truncate(complete_len)
+
+    with open(path, encoding="utf-8", newline="") as out_file:
+        if path.endswith(".csv"):
+            return set(row["doc_id"] for row in csv.DictReader(out_file))
+        return set(str(json.loads(line)["doc_id"]) for line in out_file if line.strip())
+
+
+def score_corpus(model_path, input_path, output_path, preprocessor_path=None, engine="numpy",
+                    n_jobs=1, batch_size=1024, forward_batch_size=128, num_rationales=3,
+                    threshold=0, restart=False, report_every=10000):
+    '''
+    Score the documents in input_path, writing results to output_path; see
+    above. Documents are handed to workers batch_size at a time, and each
+    worker runs the model on forward_batch_size of them at a time (which
+    bounds its activations' memory). Returns the number of documents scored
+    (in this run).
+    '''
+    if restart and os.path.exists(output_path):
+        os.remove(output_path)
+    done = completed_doc_ids(output_path)
+    if done:
+        print("resuming: skipping %s documents already in %s" % (len(done), output_path))
+
+    # (doc ids are compared as strings, as read from the CSV)
+    docs = (doc for doc in iter_sentences(input_path) if doc[0] not in done)
+    writer = ResultWriter(output_path, num_rationales)
+    score_args = (forward_batch_size, num_rationales, threshold)
+    init_args = (model_path, preprocessor_path, engine)
+
+    n_scored, last_report = 0, 0
+    start = time.time()
+    def report():
+        print("scored %s documents in %.1f secs (%.1f docs/sec)" %
+                (n_scored, time.time() - start, n_scored / max(time.time() - start, 1e-9)))
+
+    if n_jobs == 1:
+        init_worker(*init_args)
+        results = (score_batch(doc_batch, *score_args) for doc_batch in batches(docs, batch_size))
+        pool = None
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=init_worker, initargs=init_args)
+        results = _score_async(pool, batches(docs, batch_size), score_args, max_pending=2*n_jobs)
+
+    try:
+        for batch_results in results:
+            writer.write(batch_results)
+            n_scored += len(batch_results)
+            if n_scored - last_report >= report_every:
+                report()
+                last_report = n_scored
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.terminate()
+
+    report()
+    return n_scored
+
+def _score_async(pool, doc_batches, score_args, max_pending):
+    '''
+    yields the results of score_batch for doc_batches, in order, keeping at
+    most max_pending batches in flight (Pool.imap would read all of its
+    input up front)
+    '''
+    pending = collections.deque()
+    for doc_batch in doc_batches:
+        pending.append(pool.apply_async(score_batch, (doc_batch,) + score_args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-m', '--model', dest="model_path",
+        help="trained model: a bundle (see RationaleCNN.save_bundle) or, for the numpy engine, doc_model weights")
+
+    parser.add_option('-p', '--preprocessor', dest="preprocessor_path",
+        help="pickled Preprocessor the model was trained with (not needed for bundles)",
+        default=None)
+
+    parser.add_option('-i', '--input', dest="input_path",
+        help="CSV of documents to score (doc_id,doc_lbl,sentence_number,sentence,sentence_lbl)")
+
+    parser.add_option('-o', '--output', dest="output_path",
+        help="output path; .csv for CSV, otherwise JSONL",
+        default="scores.jsonl")
+
+    parser.add_option('-e', '--engine', dest="engine",
+        help="inference engine; one of {numpy, keras}",
+        default="numpy")
+
+    parser.add_option('--nj', '--n-jobs', dest="n_jobs",
+        help="number of worker processes",
+        default=multiprocessing.cpu_count(), type="int")
+
+    parser.add_option('--bs', '--batch-size', dest="batch_size",
+        help="documents per batch (scored by one worker at a time)",
+        default=1024, type="int")
+
+    parser.add_option('--fbs', '--forward-batch-size', dest="forward_batch_size",
+        help="documents per forward pass of the model, within a batch",
+        default=128, type="int")
+
+    parser.add_option('-k', '--num-rationales', dest="num_rationales",
+        help="number of rationales to output per document",
+        default=3, type="int")
+
+    parser.add_option('-t', '--threshold', dest="threshold",
+        help="minimum probability of output rationales",
+        default=0, type="float")
+
+    parser.add_option('--restart', dest="restart",
+        help="overwrite existing output, rather than resuming",
+        action='store_true', default=False)
+
+    (options, args) = parser.parse_args()
+    if options.model_path is None or options.input_path is None:
+        parser.error("--model and --input are required")
+
+    score_corpus(options.model_path, options.input_path, options.output_path,
+                 preprocessor_path=options.preprocessor_path, engine=options.engine,
+                 n_jobs=options.n_jobs, batch_size=options.batch_size,
+                 forward_batch_size=options.forward_batch_size,
+                 num_rationales=options.num_rationales, threshold=options.threshold,
+                 restart=options.restart)
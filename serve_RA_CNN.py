@@ -0,0 +1,270 @@
+'''
+A local inference server for a trained model, over HTTP on a TCP port or a
+Unix socket (Python 3; asyncio), e.g.,
+
+    python serve_RA_CNN.py --model=rationale-CNN_RSG.bundle --port=8000
+
+Endpoints:
+
+    POST /predict   {"sentences": [...], "num_rationales": 3, "threshold": 0}
+                    -> {"probability": ..., "rationales": [...]}
+    GET /metrics    counts of requests served, failed requests and batches,
+                    p50/p99 latency (over the last n requests) and the
+                    current queue depth
+    GET /health
+
+Concurrent requests are coalesced into micro-batches: a batch is run once
+max_batch_size documents are queued, or max_wait_ms after the first of them
+arrived, whichever comes first. The model is loaded and run on a single
+dedicated thread (Keras models are not safe to share across threads), so
+the event loop keeps accepting requests while a batch is being scored.
+Requests with a body over max_body_bytes are refused (413).
+
+See loadtest_RA_CNN.py for a load test.
+'''
+import json
+import time
+import asyncio
+import optparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from rationale_CNN import Document
+from numpy_RA_CNN import rank_rationales
+from score_RA_CNN import load_model
+
+
+class MicroBatcher:
+
+    def __init__(self, load_model_func, max_batch_size=64, max_wait_ms=5, n_latencies=10000):
+        '''
+        load_model_func: returns the model (RationaleCNN or NumpyRationaleCNN);
+                    called on the model thread
+        n_latencies: the number of (most recent) requests latency
+                    percentiles are computed over
+        '''
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.model = self.executor.submit(load_model_func).result()
+
+        self.queue = None
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.n_requests, self.n_batches, self.n_errors = 0, 0, 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batch_task = asyncio.ensure_future(self.batch_loop())
+
+    async def predict(self, sentences, num_rationales=3, threshold=0):
+        ''' returns (doc_pred, rationales) for a document with the given sentences '''
+        start = time.time()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((Document(None, sentences), num_rationales, threshold, future))
+        try:
+            result = await future
+        finally:
+            self.latencies.append(time.time() - start)
+        # (failures are counted per batch, in n_errors)
+        self.n_requests += 1
+        return result
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.score, batch)
+            except Exception as e:
+                self.n_errors += len(batch)
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.n_batches += 1
+            for (_, _, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def score(self, batch):
+        ''' runs on the model thread '''
+        docs = [doc for doc, _, _, _ in batch]
+        doc_preds, sent_preds, _, _ = self.model.predict_docs(docs, batch_size=len(docs))
+        if sent_preds is None:
+            # (the doc-CNN has no rationales)
+            return [(float(doc_pred), []) for doc_pred in doc_preds]
+        max_doc_len = self.model.preprocessor.max_doc_len
+        # (requests may ask for different numbers of rationales)
+        return [rank_rationales([doc], doc_preds[i:i+1], sent_preds[i:i+1], max_doc_len,
+                                num_rationales=num_rationales, threshold=threshold)[0]
+                    for i, (doc, num_rationales, threshold, _) in enumerate(batch)]
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0., 0.)
+        return {"requests": self.n_requests, "errors": self.n_errors, "batches": self.n_batches,
+                "mean_batch_size": self.n_requests / float(max(self.n_batches, 1)),
+                "latency_ms_p50": p50, "latency_ms_p99": p99,
+                "queue_depth": self.queue.qsize()}
+
+
+async def read_request(reader, max_body_bytes=1 << 20):
+    '''
+    returns (method, path, headers, body), or None if the connection was
+    closed; body is None (and is not read) if its Content-Length is over
+    max_body_bytes. Raises ValueError for malformed requests.
+    '''
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = headers.get("content-length", "0")
+    if not content_length.isdigit():
+        raise ValueError("invalid Content-Length: %s" % content_length)
+    if int(content_length) > max_body_bytes:
+        return method, path, headers, None
+    body = await reader.readexactly(int(content_length))
+    return method, path, headers, body
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode("utf8")
+    writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\n"
+                  "Connection: %s\r\n\r\n" % (status, len(body), "keep-alive" if keep_alive else "close")
+                  ).encode("latin-1") + body)
+
+def make_handler(batcher, max_body_bytes=1 << 20):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, max_body_bytes)
+                except ValueError as e:
+                    write_response(writer, "400 Bad Request", {"error": str(e)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                if body is None:
+                    # (the unread body is still on the connection, so close it)
+                    keep_alive = False
+                    write_response(writer, "413 Payload Too Large",
+                                   {"error": "request body must be at most %s bytes" % max_body_bytes},
+                                   keep_alive)
+                elif method == "POST" and path == "/predict":
+                    try:
+                        params = json.loads(body.decode("utf8"))
+                        sentences = params["sentences"]
+                        if not sentences or not all(isinstance(s, str) for s in sentences):
+                            raise ValueError("sentences must be a non-empty list of strings")
+                        num_rationales = int(params.get("num_rationales", 3))
+                        threshold = float(params.get("threshold", 0))
+                    except (ValueError, KeyError, TypeError) as e:
+                        write_response(writer, "400 Bad Request", {"error": str(e)}, keep_alive)
+                    else:
+                        try:
+                            doc_pred, rationales = await batcher.predict(sentences, num_rationales, threshold)
+                            write_response(writer, "200 OK", {"probability": float(doc_pred),
+                                                              "rationales": rationales}, keep_alive)
+                        except Exception as e:
+                            write_response(writer, "500 Internal Server Error", {"error": str(e)}, keep_alive)
+                elif method == "GET" and path == "/metrics":
+                    write_response(writer, "200 OK", batcher.metrics(), keep_alive)
+                elif method == "GET" and path == "/health":
+                    write_response(writer, "200 OK", {"status": "ok"}, keep_alive)
+                else:
+                    write_response(writer, "404 Not Found", {"error": "no such endpoint"}, keep_alive)
+
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(batcher, host="127.0.0.1", port=8000, unix_socket=None, max_body_bytes=1 << 20):
+    await batcher.start()
+    handler = make_handler(batcher, max_body_bytes)
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        print("serving on %s" % unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print("serving on http://%s:%s" % (host, port))
+    async with server:
+        await server.serve_forever()
+
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-m', '--model', dest="model_path",
+        help="trained model: a bundle (see RationaleCNN.save_bundle) or, for the numpy engine, doc_model weights")
+
+    parser.add_option('-p', '--preprocessor', dest="preprocessor_path",
+        help="pickled Preprocessor the model was trained with (not needed for bundles)",
+        default=None)
+
+    parser.add_option('-e', '--engine', dest="engine",
+        help="inference engine; one of {numpy, keras}",
+        default="numpy")
+
+    parser.add_option('--host', dest="host",
+        help="host to listen on",
+        default="127.0.0.1")
+
+    parser.add_option('--port', dest="port",
+        help="port to listen on",
+        default=8000, type="int")
+
+    parser.add_option('-u', '--unix-socket', dest="unix_socket",
+        help="listen on this Unix socket (rather than a port)",
+        default=None)
+
+    parser.add_option('--mbs', '--max-batch-size', dest="max_batch_size",
+        help="maximum number of documents per micro-batch",
+        default=64, type="int")
+
+    parser.add_option('--mw', '--max-wait-ms', dest="max_wait_ms",
+        help="maximum time (in ms) to wait for a micro-batch to fill",
+        default=5, type="float")
+
+    parser.add_option('--mb', '--max-body-bytes', dest="max_body_bytes",
+        help="maximum request body size (in bytes); larger requests get a 413",
+        default=1 << 20, type="int")
+
+    (options, args) = parser.parse_args()
+    if options.model_path is None:
+        parser.error("--model is required")
+
+    batcher = MicroBatcher(lambda: load_model(options.model_path, options.preprocessor_path, options.engine),
+                           max_batch_size=options.max_batch_size, max_wait_ms=options.max_wait_ms)
+    asyncio.run(serve(batcher, host=options.host, port=options.port, unix_socket=options.unix_socket,
+                      max_body_bytes=options.max_body_bytes))
@@ -0,0 +1,122 @@
+'''
+Kernel conversion between the conv2d and conv1d encoder layouts (and the
+theano and tensorflow conventions), and the NumPy forward pass, checked
+against direct implementations of the keras layers' arithmetic.
+'''
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+import model_bundle
+from numpy_RA_CNN import NumpyRationaleCNN, convert_conv_kernel, correlation_kernel, rank_rationales
+from rationale_CNN import Preprocessor, Document
+
+EMBEDDING_DIMS, N_FILTERS, MAX_SENT_LEN = 4, 3, 6
+
+
+def conv2d_features(X, kernel, bias, backend):
+    '''
+    the conv2d encoder: a (1 x n_gram*embedding_dims) filter, with stride
+    embedding_dims, over each sentence's flattened embeddings X (n x
+    max_sent_len*embedding_dims), then relu and max pooling
+    '''
+    kernel = correlation_kernel(kernel, backend)[0,:,0,:]
+    width = kernel.shape[0]
+    n_positions = (X.shape[1] - width) // EMBEDDING_DIMS + 1
+    conv = np.stack([X[:, t*EMBEDDING_DIMS:t*EMBEDDING_DIMS+width].dot(kernel)
+                        for t in range(n_positions)], axis=1) + bias
+    return np.maximum(conv, 0).max(axis=1)
+
+def conv1d_features(X, kernel, bias, backend):
+    ''' the conv1d encoder, over (n x max_sent_len x embedding_dims) X '''
+    kernel = correlation_kernel(kernel, backend)
+    n_gram = kernel.shape[0]
+    conv = np.stack([np.einsum("nje,jef->nf", X[:, t:t+n_gram], kernel)
+                        for t in range(X.shape[1] - n_gram + 1)], axis=1) + bias
+    return np.maximum(conv, 0).max(axis=1)
+
+
+@pytest.mark.parametrize("n_gram", [1, 2, 3])
+@pytest.mark.parametrize("source_backend", ["tensorflow", "theano"])
+@pytest.mark.parametrize("target_backend", ["tensorflow", "theano"])
+def test_conv2d_to_conv1d_kernel(n_gram, source_backend, target_backend):
+    rs = np.random.RandomState(n_gram)
+    X = rs.randn(5, MAX_SENT_LEN, EMBEDDING_DIMS)
+    kernel = rs.randn(1, n_gram*EMBEDDING_DIMS, 1, N_FILTERS)
+    bias = rs.randn(N_FILTERS)
+
+    conv1d_kernel = convert_conv_kernel(kernel, (n_gram, EMBEDDING_DIMS, N_FILTERS), EMBEDDING_DIMS,
+                                        source_backend, target_backend)
+    assert conv1d_kernel.shape == (n_gram, EMBEDDING_DIMS, N_FILTERS)
+    np.testing.assert_allclose(conv1d_features(X, conv1d_kernel, bias, target_backend),
+                               conv2d_features(X.reshape(5, -1), kernel, bias, source_backend),
+                               rtol=1e-6, atol=1e-6)
+
+    # ... and back
+    np.testing.assert_array_equal(convert_conv_kernel(conv1d_kernel, kernel.shape, EMBEDDING_DIMS,
+                                                      target_backend, source_backend), kernel)
+
+
+@pytest.mark.parametrize("backend", ["tensorflow", "theano"])
+@pytest.mark.parametrize("mask_padding", [True, False])
+def test_forward_matches_reference(tmp_path, backend, mask_padding):
+    rs = np.random.RandomState(0)
+    sentences = ["w%s w%s w%s" % tuple(rs.randint(0, 30, 3)) for _ in range(20)]
+    p = Preprocessor(max_features=25, max_sent_len=MAX_SENT_LEN, max_doc_len=4,
+                     embedding_dims=EMBEDDING_DIMS, stopword=False)
+    p.preprocess(sentences)
+
+    # conv2d layout weights, as saved by doc_model.save_weights
+    n_grams = [1, 2]
+    layer_weights = OrderedDict([("embedding", [rs.randn(26, EMBEDDING_DIMS) * .5])])
+    for n_gram in n_grams:
+        layer_weights["conv2d_%s" % n_gram] = [rs.randn(1, n_gram*EMBEDDING_DIMS, 1, N_FILTERS) * .5,
+                                               rs.randn(N_FILTERS) * .1]
+    layer_weights["sentence_predictions"] = [rs.randn(len(n_grams)*N_FILTERS, 3), rs.randn(3)]
+    if mask_padding:
+        layer_weights["sentence_mask"] = []
+    layer_weights["doc_prediction"] = [rs.randn(len(n_grams)*N_FILTERS, 1) * .3, rs.randn(1)]
+
+    bundle_path = str(tmp_path / "model.bundle")
+    model_bundle.write_bundle(bundle_path, "{}", layer_weights, p.get_vocabulary(), {"backend": backend})
+    model = NumpyRationaleCNN(bundle_path, p)
+
+    docs = [Document(i, list(rs.choice(sentences, rs.randint(1, 7)))) for i in range(10)]
+    doc_preds, sent_preds, _, _ = model.predict_docs(docs, batch_size=3)
+
+    # the reference RA-CNN forward pass
+    embeddings = layer_weights["embedding"][0]
+    for i, doc in enumerate(docs):
+        X = doc.get_padded_sequences(p, labels_too=False)
+        embedded = embeddings[X].reshape(X.shape[0], -1)
+        sent_vectors = np.hstack([conv2d_features(embedded, *layer_weights["conv2d_%s" % n_gram], backend=backend)
+                                    for n_gram in n_grams])
+        logits = sent_vectors.dot(layer_weights["sentence_predictions"][0]) + layer_weights["sentence_predictions"][1]
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        weights = probs[:,:2].max(axis=1)
+        if mask_padding:
+            weights = weights * (X != 0).any(axis=1)
+        doc_vector = weights.dot(sent_vectors)
+        doc_pred = 1 / (1 + np.exp(-(doc_vector.dot(layer_weights["doc_prediction"][0]) + layer_weights["doc_prediction"][1])))
+
+        assert doc_preds[i] == pytest.approx(doc_pred[0], abs=1e-5)
+        n_sentences = min(doc.num_sentences, p.max_doc_len)
+        np.testing.assert_allclose(sent_preds[i, :n_sentences], probs[:n_sentences], atol=1e-5)
+
+
+@pytest.mark.parametrize("threshold", [0, -np.inf])
+def test_rank_rationales_short_docs(threshold):
+    docs = [Document(0, ["a", "b"]), Document(1, ["c", "d", "e", "f"]), Document(2, ["g"])]
+    sent_preds = np.random.RandomState(0).rand(3, 4, 3)
+    doc_preds = np.array([.7, .2, .9])
+
+    results = rank_rationales(docs, doc_preds, sent_preds, max_doc_len=4, num_rationales=3,
+                              threshold=threshold)
+    for doc, doc_pred, s_preds, (pred, rationales) in zip(docs, doc_preds, sent_preds, results):
+        assert pred == doc_pred
+        col = 0 if doc_pred >= .5 else 1
+        n_sentences = len(doc.sentences)
+        expected = np.argsort(s_preds[:n_sentences, col])[::-1][:3]
+        assert sorted(rationales) == sorted(doc.sentences[i] for i in expected)
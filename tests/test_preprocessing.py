@@ -0,0 +1,87 @@
+'''
+Parity of the in-module Tokenizer and Preprocessor.build_sequences with the
+reference keras pipeline (remove_stopwords -> keras Tokenizer ->
+texts_to_sequences -> pad_sequences). The expected vocabularies and
+sequences below were produced by that pipeline with Keras 2.0.8, so these
+tests run without keras; test_matches_installed_keras repeats the
+comparison against keras itself, if it is installed.
+'''
+import numpy as np
+import pytest
+
+from rationale_CNN import Preprocessor, Tokenizer
+
+CORPUS = ["The patients were randomly assigned to one of 2 groups.",
+          "Randomization was done by a computer-generated list!",
+          "Allocation concealment: sealed, opaque envelopes (numbered 1 to 40).",
+          "",
+          "Patients and   investigators were blinded; the outcome assessors were not.",
+          "THE LIST was kept by an independent pharmacist\tin 2009",
+          "randomly randomly RANDOMLY assigned"]
+MAX_FEATURES, MAX_SENT_LEN = 12, 5
+
+# words in (keras) word_index order, and the padded sequences, by stopword
+KERAS_VOCABULARY = {
+    True: ["randomly", "were", "numbernumbernumber", "the", "patients", "assigned", "list", "one",
+           "groups", "randomization", "done", "computer", "generated", "allocation", "concealment",
+           "sealed", "opaque", "envelopes", "numbered", "40", "investigators", "blinded", "outcome",
+           "assessors", "not", "kept", "independent", "pharmacist", "in"],
+    False: ["randomly", "the", "were", "patients", "assigned", "to", "was", "by", "list", "one", "of",
+            "2", "groups", "randomization", "done", "a", "computer", "generated", "allocation",
+            "concealment", "sealed", "opaque", "envelopes", "numbered", "1", "40", "and",
+            "investigators", "blinded", "outcome", "assessors", "not", "kept", "an", "independent",
+            "pharmacist", "in", "2009"]}
+KERAS_SEQUENCES = {
+    True: [[1, 6, 8, 3, 9], [0, 0, 10, 11, 7], [0, 0, 0, 0, 3], [0, 0, 0, 0, 0],
+           [0, 0, 5, 2, 2], [0, 0, 4, 7, 3], [0, 1, 1, 1, 6]],
+    False: [[1, 5, 6, 10, 11], [0, 0, 7, 8, 9], [0, 0, 0, 0, 6], [0, 0, 0, 0, 0],
+            [0, 4, 3, 2, 3], [0, 2, 9, 7, 8], [0, 1, 1, 1, 5]]}
+
+
+def fit_preprocessor(stopword):
+    p = Preprocessor(max_features=MAX_FEATURES, max_sent_len=MAX_SENT_LEN, stopword=stopword)
+    p.preprocess(CORPUS)
+    return p
+
+
+@pytest.mark.parametrize("stopword", [True, False])
+def test_vocabulary_matches_keras(stopword):
+    p = fit_preprocessor(stopword)
+    assert p.get_vocabulary() == KERAS_VOCABULARY[stopword]
+
+
+@pytest.mark.parametrize("stopword", [True, False])
+def test_build_sequences_matches_keras(stopword):
+    X = fit_preprocessor(stopword).build_sequences(CORPUS)
+    assert X.dtype == np.int32
+    assert X.tolist() == KERAS_SEQUENCES[stopword]
+
+
+@pytest.mark.parametrize("stopword", [True, False])
+def test_streamed_fit_matches(stopword):
+    p = Preprocessor(max_features=MAX_FEATURES, max_sent_len=MAX_SENT_LEN, stopword=stopword)
+    p.preprocess_stream(iter(CORPUS))
+    assert p.get_vocabulary() == KERAS_VOCABULARY[stopword]
+    assert p.build_sequences(CORPUS).tolist() == KERAS_SEQUENCES[stopword]
+
+
+def test_tokenizer_texts_to_sequences():
+    tokenizer = Tokenizer(num_words=MAX_FEATURES)
+    tokenizer.fit_on_texts(CORPUS)
+    assert tokenizer.texts_to_sequences(["randomly, THE were!", "unseen words"]) == [[1, 2, 3], []]
+
+
+@pytest.mark.parametrize("stopword", [True, False])
+def test_matches_installed_keras(stopword):
+    pytest.importorskip("keras")
+    from keras.preprocessing.sequence import pad_sequences
+    from keras.preprocessing.text import Tokenizer as KerasTokenizer
+
+    p = fit_preprocessor(stopword)
+    processed = p.remove_stopwords(CORPUS) if stopword else CORPUS
+    keras_tokenizer = KerasTokenizer(num_words=MAX_FEATURES)
+    keras_tokenizer.fit_on_texts(processed)
+    assert keras_tokenizer.word_index == p.tokenizer.word_index
+
+    X_ref = pad_sequences(keras_tokenizer.texts_to_sequences(processed), maxlen=MAX_SENT_LEN)
+    assert np.array_equal(p.build_sequences(CORPUS), X_ref)
@@ -0,0 +1,86 @@
+'''
+The inference server's micro-batcher and HTTP handling, serving NumPy
+engine models built from bundles in tmp_path.
+'''
+import asyncio
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+import model_bundle
+from numpy_RA_CNN import NumpyRationaleCNN
+from rationale_CNN import Preprocessor
+from serve_RA_CNN import MicroBatcher, make_handler
+
+EMBEDDING_DIMS, N_FILTERS = 4, 3
+SENTENCES = ["w%s w%s w%s" % (i, i+1, i+2) for i in range(20)]
+
+
+def write_model(tmp_path, rationale_model):
+    rs = np.random.RandomState(0)
+    p = Preprocessor(max_features=25, max_sent_len=5, max_doc_len=4,
+                     embedding_dims=EMBEDDING_DIMS, stopword=False)
+    p.preprocess(SENTENCES)
+
+    layer_weights = OrderedDict([("embedding", [rs.randn(26, EMBEDDING_DIMS)]),
+                                 ("conv2d_1", [rs.randn(1, EMBEDDING_DIMS, 1, N_FILTERS),
+                                               rs.randn(N_FILTERS)])])
+    if rationale_model:
+        layer_weights["sentence_predictions"] = [rs.randn(N_FILTERS, 3), rs.randn(3)]
+        layer_weights["sentence_mask"] = []
+    layer_weights["doc_prediction"] = [rs.randn(N_FILTERS, 1), rs.randn(1)]
+
+    bundle_path = str(tmp_path / "model.bundle")
+    model_bundle.write_bundle(bundle_path, "{}", layer_weights, p.get_vocabulary(),
+                              {"backend": "tensorflow"})
+    return lambda: NumpyRationaleCNN(bundle_path, p)
+
+
+async def post_predict(handler, body):
+    ''' returns the raw response to a single POST /predict request '''
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"POST /predict HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                     % len(body) + body)
+    reader.feed_eof()
+
+    class Writer:
+        data = b""
+        def write(self, data):
+            self.data += data
+        async def drain(self):
+            pass
+        def close(self):
+            pass
+
+    writer = Writer()
+    await handler(reader, writer)
+    return writer.data
+
+
+@pytest.mark.parametrize("rationale_model", [True, False])
+def test_predict(tmp_path, rationale_model):
+    batcher = MicroBatcher(write_model(tmp_path, rationale_model), max_batch_size=8)
+
+    async def run():
+        await batcher.start()
+        requests = [batcher.predict(SENTENCES[i:i+3], num_rationales=2) for i in range(5)]
+        return await asyncio.gather(*requests)
+
+    results = asyncio.run(run())
+    assert batcher.n_requests == 5 and batcher.n_errors == 0
+    for doc_pred, rationales in results:
+        assert 0 <= doc_pred <= 1
+        assert len(rationales) == (2 if rationale_model else 0)
+
+
+def test_serve_doc_CNN(tmp_path):
+    batcher = MicroBatcher(write_model(tmp_path, rationale_model=False))
+
+    async def run():
+        await batcher.start()
+        return await post_predict(make_handler(batcher), b'{"sentences": ["w1 w2", "w3"]}')
+
+    response = asyncio.run(run())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert response.endswith(b'"rationales": []}')
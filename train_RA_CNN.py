@@ -1,17 +1,24 @@
 from __future__ import print_function
 import math
 import csv
+import itertools
 import random 
 random.seed(1337)
 import pickle
 import sys
 csv.field_size_limit(sys.maxsize)
 import os 
+import time
+import multiprocessing
+from collections import OrderedDict
+import shutil
+import hashlib
+import json
 import configparser
 import optparse 
 
 import sklearn 
-from sklearn.metrics import accuracy_score
+from sklearn.metrics import accuracy_score, f1_score
 
 import pandas as pd 
 import numpy as np 
@@ -53,30 +60,417 @@ def read_data(path="/work/03213/bwallace/maverick/RoB-keras/RoB-data/train-Xy-w-
         sentences = doc["sentence"].values
         sentence_labels = (doc["sentence_lbl"].values+1)/2
         
-        # convert to binary output vectors, so that e.g., [1, 0, 0]
-        # indicates a positive rationale; [0, 1, 0] a negative rationale
-        # and [0, 0, 1] a non-rationale
-        def _to_vec(sent_y): 
-            sent_lbl_vec = np.zeros(3)
-            if sent_y == 0:
-                sent_lbl_vec[-1] = 1.0
-            else: 
-                # then it's a rationale
-                if doc_label > 0: 
-                    # positive rationale
-                    sent_lbl_vec[0] = 1.0
-                else: 
-                    # negative rationale
-                    sent_lbl_vec[1] = 1.0
-            return sent_lbl_vec
-
-        sentence_label_vectors = [_to_vec(sent_y) for sent_y in sentence_labels]
-        cur_doc = Document(doc_id, sentences, doc_label, sentence_label_vectors)
+        cur_doc = Document(doc_id, sentences, doc_label, 
+                            to_label_vectors(doc_label, sentence_labels))
         documents.append(cur_doc)
 
     return documents
 
+def to_label_vectors(doc_label, sentence_labels):
+    '''
+    convert (0/1) sentence labels to binary output vectors, so that e.g., 
+    [1, 0, 0] indicates a positive rationale; [0, 1, 0] a negative rationale
+    and [0, 0, 1] a non-rationale. (rationales take the polarity of the document.)
+    '''
+    rationale_col = 0 if doc_label > 0 else 1
+    cols = np.where(np.asarray(sentence_labels) == 0, 2, rationale_col)
+    return list(np.eye(3)[cols])
+
+def iter_documents(path):
+    '''
+    Streaming alternative to read_data: yields Document instances one at a 
+    time, holding only the current document's rows in memory. Relies on the
+    rows for each document being contiguous in the file, i.e.,
+
+        doc_id,doc_lbl,sentence_number,sentence,sentence_lbl
+
+    (with or without a header row). Documents are yielded in file order 
+    (read_data orders them by doc_id).
+    '''
+    def _parse_id(doc_id):
+        # ints where possible, as per pandas
+        try:
+            return int(doc_id)
+        except ValueError:
+            return doc_id
+
+    def _make_doc(doc_id, doc_lbl, sentences, sentence_lbls):
+        doc_label = (doc_lbl+1)/2 # convert to 0/1
+        sentence_labels = (np.array(sentence_lbls)+1)/2
+        return Document(_parse_id(doc_id), sentences, doc_label, 
+                        to_label_vectors(doc_label, sentence_labels))
+
+    with open(path) as data_file:
+        reader = csv.reader(data_file)
+        columns = ["doc_id", "doc_lbl", "sentence_number", "sentence", "sentence_lbl"]
+        col_indices = list(range(len(columns)))
+        rows = reader
+        first_row = next(reader, None)
+        if first_row is not None:
+            if "doc_id" in first_row:
+                col_indices = [first_row.index(c) for c in columns]
+            else:
+                # no header; put the first row back
+                rows = itertools.chain([first_row], reader)
+        id_idx, doc_lbl_idx, _, sent_idx, sent_lbl_idx = col_indices
+
+        cur_id, cur_doc_lbl, sentences, sentence_lbls = None, None, [], []
+        seen_ids = set()
+        for row in rows:
+            doc_id = row[id_idx]
+            if doc_id != cur_id:
+                if cur_id is not None:
+                    yield _make_doc(cur_id, cur_doc_lbl, sentences, sentence_lbls)
+                if doc_id in seen_ids:
+                    raise ValueError("rows for doc_id %s are not contiguous in %s" % (doc_id, path))
+                seen_ids.add(doc_id)
+                cur_id, cur_doc_lbl, sentences, sentence_lbls = doc_id, float(row[doc_lbl_idx]), [], []
+
+            # replace empty entries with " ", as per read_data
+            sentences.append(row[sent_idx] or " ")
+            sentence_lbls.append(float(row[sent_lbl_idx]))
+
+        if cur_id is not None:
+            yield _make_doc(cur_id, cur_doc_lbl, sentences, sentence_lbls)
+
+
+
+
+def corpus_cache_key(data_path, max_features, max_sent_len, max_doc_len, stopword, order="doc_id"):
+    '''
+    hash of the data file contents plus the preprocessing settings and the
+    document order: "doc_id" (as per read_data) or "file" (as per 
+    iter_documents). The order fixes the validation split and, via ties in
+    word counts, the vocabulary, so the two are cached separately.
+    '''
+    h = hashlib.sha1()
+    with open(data_path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b''):
+            h.update(block)
+    h.update(("%s,%s,%s,%s,%s" % (max_features, max_sent_len, max_doc_len, stopword, order)).encode("utf-8"))
+    return h.hexdigest()
+
+def save_corpus_cache(cache_path, documents, p):
+    '''
+    Write preprocessed documents (with sentence sequences generated) and the
+    fitted vocabulary of p to cache_path, as .npy arrays (token sequences, 
+    document offsets, labels, sentence text) plus a small metadata.json. 
+    Written to a temporary directory that is renamed into place when done.
+    '''
+    tmp_path = "%s.tmp-%s" % (cache_path, os.getpid())
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+
+    doc_offsets = np.concatenate([[0], np.cumsum([d.sentence_sequences.shape[0] for d in documents])])
+    np.save(os.path.join(tmp_path, "doc_offsets.npy"), doc_offsets.astype("int64"))
+    np.save(os.path.join(tmp_path, "sequences.npy"), 
+            np.vstack([d.sentence_sequences for d in documents]).astype("int32"))
+    np.save(os.path.join(tmp_path, "doc_labels.npy"), np.array([d.doc_y for d in documents], dtype="float32"))
+    np.save(os.path.join(tmp_path, "sentence_labels.npy"), 
+            np.vstack([np.reshape(d.sentences_y, (-1, 3)) for d in documents]).astype("float32"))
+
+    # sentence text, as one utf-8 blob plus byte offsets
+    encoded = [s.encode("utf-8") for d in documents for s in d.sentences]
+    np.save(os.path.join(tmp_path, "sentence_offsets.npy"), 
+            np.concatenate([[0], np.cumsum([len(s) for s in encoded])]).astype("int64"))
+    np.save(os.path.join(tmp_path, "sentence_text.npy"), np.frombuffer(b"".join(encoded), dtype="uint8"))
+
+    metadata = {"max_features": p.max_features, "max_sent_len": p.max_sent_len, 
+                "max_doc_len": p.max_doc_len, "stopword": p.stopword,
+                "doc_ids": [d.doc_id.item() if isinstance(d.doc_id, np.generic) else d.doc_id for d in documents],
+                "vocabulary": p.get_vocabulary()}
+    with open(os.path.join(tmp_path, "metadata.json"), 'w') as outf:
+        json.dump(metadata, outf)
+
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+def load_corpus_cache(cache_path, wvs=None, with_sentences=False):
+    '''
+    Load documents and a Preprocessor from a cache written by save_corpus_cache.
+    Token sequences and labels are memory-mapped, so processes opening the 
+    same cache share pages. If with_sentences is False, documents carry 
+    empty strings in place of their sentence text (which training does not
+    need); pass True to decode the text, e.g., to extract rationales.
+    '''
+    with open(os.path.join(cache_path, "metadata.json")) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    p = rationale_CNN.Preprocessor(max_features=metadata["max_features"], 
+                                    max_sent_len=metadata["max_sent_len"], 
+                                    max_doc_len=metadata["max_doc_len"], 
+                                    wvs=wvs, stopword=metadata["stopword"])
+    p.set_vocabulary(metadata["vocabulary"])
+
+    def _load(name):
+        return np.load(os.path.join(cache_path, name), mmap_mode='r')
+
+    doc_offsets, sequences = _load("doc_offsets.npy"), _load("sequences.npy")
+    doc_labels, sentence_labels = _load("doc_labels.npy"), _load("sentence_labels.npy")
+    if with_sentences:
+        sentence_offsets, sentence_text = _load("sentence_offsets.npy"), _load("sentence_text.npy")
+
+    documents = []
+    for i, doc_id in enumerate(metadata["doc_ids"]):
+        start, end = doc_offsets[i], doc_offsets[i+1]
+        if with_sentences:
+            sentences = [sentence_text[sentence_offsets[j]:sentence_offsets[j+1]].tobytes().decode("utf-8") 
+                            for j in range(start, end)]
+        else:
+            sentences = [""] * (end - start)
+
+        d = Document(doc_id, sentences, float(doc_labels[i]), sentence_labels[start:end])
+        d.generate_sequences(p, sentence_sequences=sequences[start:end])
+        documents.append(d)
+
+    return documents, p
+
+
+DEFAULT_SEARCH_SPACE = {"sent_dropout": [float(x) for x in np.linspace(0, .9, 10)],
+                        "doc_dropout": [.3, .5, .7],
+                        "n_filters": [16, 32, 64],
+                        "filters": [[1,2,3], [3,4,5], [1,2,3,4,5]]}
+
+def document_f_score(r_CNN, documents, batch_size=256):
+    ''' F-score of (thresholded) document predictions (of either model) '''
+    doc_preds = r_CNN.predict_docs(documents, batch_size=batch_size)[0]
+    y_doc = np.array([d.doc_y for d in documents])
+    return f1_score(y_doc, doc_preds > .5)
+
+def load_search_corpus(settings):
+    # the corpus is memory-mapped, so workers share it
+    documents, p = load_corpus_cache(settings["cache_path"])
+    p.load_word_vectors(settings["wvs_path"], cache_dir=settings["cache_dir"])
+    if settings["shuffle_data"]:
+        random.Random(settings["seed"]).shuffle(documents)
+    return documents, p
+
+def build_search_model(p, trial, settings, adjustable_dropout=False):
+    r_CNN = rationale_CNN.RationaleCNN(p, filters=trial["filters"], 
+                                        n_filters=trial["n_filters"], 
+                                        sent_dropout=trial["sent_dropout"], 
+                                        doc_dropout=trial["doc_dropout"],
+                                        end_to_end_train=settings["end_to_end_train"],
+                                        mask_padding=settings["mask_padding"],
+                                        adjustable_dropout=adjustable_dropout)
+    if settings["model_name"] == "doc-CNN":
+        r_CNN.build_simple_doc_model()
+    else:
+        r_CNN.build_RA_CNN_model()
+    return r_CNN
 
+def run_search_trial(trial_and_settings):
+    '''
+    Pool worker for hyperparameter_search: builds the model for one trial 
+    and trains it (see train_search_trial). Returns a list with a single 
+    (trial, validation F, setup seconds) tuple.
+    '''
+    trial, settings = trial_and_settings
+    documents, p = load_search_corpus(settings)
+
+    start = time.time()
+    r_CNN = build_search_model(p, trial, settings)
+    setup_secs = time.time() - start
+    print("trial %s setup (build & compile): %.2f secs" % (trial["trial"], setup_secs))
+
+    return [(trial["trial"], train_search_trial(r_CNN, documents, trial, settings), setup_secs)]
+
+def run_search_trial_group(trials_and_settings):
+    '''
+    Warm-start pool worker for hyperparameter_search: trials share an 
+    architecture (n_filters and filters), so the model is built and compiled 
+    once; for each subsequent trial, weights (and optimizer state) are reset
+    from a snapshot of the initial weights and the dropout rates are set in 
+    place. Returns a list of (trial, validation F, setup seconds) tuples.
+    '''
+    trials, settings = trials_and_settings
+    documents, p = load_search_corpus(settings)
+
+    r_CNN, results = None, []
+    for trial in trials:
+        start = time.time()
+        if r_CNN is None:
+            r_CNN = build_search_model(p, trial, settings, adjustable_dropout=True)
+            r_CNN.snapshot_weights()
+        else:
+            r_CNN.reset_weights()
+            r_CNN.set_dropout_rates(trial["sent_dropout"], trial["doc_dropout"])
+        setup_secs = time.time() - start
+        print("trial %s setup (warm start): %.2f secs" % (trial["trial"], setup_secs))
+
+        results.append((trial["trial"], train_search_trial(r_CNN, documents, trial, settings), setup_secs))
+    return results
+
+def train_search_trial(r_CNN, documents, trial, settings):
+    '''
+    train the document model for trial["epochs"] more epochs, resuming from 
+    the trial's saved weights if trial["resume"] is True (note that optimizer
+    state is not carried over). The sentence model is pre-trained on a trial's
+    first rung only. Each rung checkpoints to its own file; the trial's
+    weights are only replaced if the rung beats the validation F the trial
+    already reached (trial["best_f"]). Returns the trial's best validation F.
+    '''
+    if trial["resume"]:
+        if settings["model_name"] == "rationale-CNN" and not settings["end_to_end_train"]:
+            r_CNN.freeze_sentence_predictions()
+        r_CNN.doc_model.load_weights(trial["weights_path"])
+    elif settings["model_name"] == "rationale-CNN" and settings["nb_epoch_sentences"] > 0:
+        r_CNN.train_sentence_model(documents, nb_epoch=settings["nb_epoch_sentences"], 
+                                    sent_val_split=settings["val_split"], downsample=True,
+                                    sentence_model_weights_path=trial["sentence_weights_path"])
+
+    r_CNN.train_document_model(documents, nb_epoch=trial["epochs"], 
+                                downsample=settings["downsample"],
+                                batch_size=settings["batch_size"],
+                                doc_val_split=settings["val_split"], 
+                                pos_class_weight=settings["pos_class_weight"],
+                                document_model_weights_path=trial["rung_weights_path"])
+
+    validation_size = int(settings["val_split"]*len(documents))
+    val_f = document_f_score(r_CNN, documents[-validation_size:])
+    if trial["resume"] and val_f < trial["best_f"]:
+        # this rung did worse; keep (and go on from) the earlier weights
+        os.remove(trial["rung_weights_path"])
+        r_CNN.doc_model.load_weights(trial["weights_path"])
+        return trial["best_f"]
+
+    os.replace(trial["rung_weights_path"], trial["weights_path"])
+    return val_f
+
+def write_leaderboard(leaderboard, leaderboard_path):
+    ''' write search results, best first, to leaderboard_path.json and .csv '''
+    leaderboard = sorted(leaderboard, key=lambda entry: (-entry["epochs"], -entry["val_f"]))
+    with open("%s.json" % leaderboard_path, 'w') as outf:
+        json.dump(leaderboard, outf, indent=2)
+
+    with open("%s.csv" % leaderboard_path, 'w') as outf:
+        writer = csv.DictWriter(outf, fieldnames=["trial", "rung", "epochs", "val_f", "setup_secs",
+                                                   "sent_dropout", "doc_dropout", "n_filters", "filters"])
+        writer.writeheader()
+        for entry in leaderboard:
+            writer.writerow(entry)
+
+def hyperparameter_search(data_path, wvs_path, search_space=None, n_trials=20, n_jobs=4, 
+                            eta=3, min_epochs=2, max_epochs=25, 
+                            leaderboard_path="search-leaderboard", cache_dir="search_cache",
+                            model_name="rationale-CNN", nb_epoch_sentences=20, val_split=.1,
+                            shuffle_data=False, max_features=20000, max_sent_len=25, 
+                            max_doc_len=200, batch_size=50, end_to_end_train=False,
+                            downsample=False, stopword=True, pos_class_weight=1, 
+                            mask_padding=True, seed=1337, warm_start=False):
+    '''
+    Search over sentence dropout, document dropout, n_filters and filter sizes
+    (search_space maps each of these to a list of candidate values; see 
+    DEFAULT_SEARCH_SPACE), using successive halving: n_trials configurations
+    drawn from the grid are each trained for min_epochs document epochs, in 
+    a pool of n_jobs processes; the best 1/eta (by validation F) are then 
+    trained eta times as long, and so on, up to max_epochs. The corpus is 
+    preprocessed once and shared via the corpus cache (in cache_dir). Results
+    are written to leaderboard_path.json/.csv after every rung.
+
+    The rationale-CNN applies no dropout to sentence vectors, so for it the
+    default search space fixes sent_dropout at 0 (and a search_space with
+    more than one sent_dropout value is rejected).
+
+    If warm_start is True, trials that share an architecture (n_filters and 
+    filters) are run in the same worker, reusing one built and compiled model
+    (see run_search_trial_group); each architecture's trials are split over
+    at most n_jobs workers.
+
+    NOTE: at the moment this is using *all* training data; obviously need to set 
+    aside the actual test fold (as we did for the paper experiments in Theano
+    implementation). 
+    '''
+    if search_space is None:
+        search_space = DEFAULT_SEARCH_SPACE
+        if model_name == "rationale-CNN":
+            search_space = dict(search_space, sent_dropout=[0.])
+    elif model_name == "rationale-CNN" and len(search_space["sent_dropout"]) > 1:
+        raise ValueError("the rationale-CNN applies no sentence dropout; "
+                         "search_space must have a single sent_dropout value")
+
+    # preprocess once; trials load the (memory-mapped) cache
+    cache_path = os.path.join(cache_dir, 
+                    corpus_cache_key(data_path, max_features, max_sent_len, max_doc_len, stopword))
+    if not os.path.exists(cache_path):
+        documents = read_data(path=data_path)
+        p = rationale_CNN.Preprocessor(max_features=max_features, max_sent_len=max_sent_len, 
+                                        max_doc_len=max_doc_len, stopword=stopword)
+        p.preprocess([s for d in documents for s in d.sentences])
+        p.generate_document_sequences(documents)
+        save_corpus_cache(cache_path, documents, p)
+    documents, p = load_corpus_cache(cache_path)
+    # ... and the word vectors, too
+    p.load_word_vectors(wvs_path, cache_dir=cache_dir)
+
+    settings = {"cache_path": cache_path, "cache_dir": cache_dir, "wvs_path": wvs_path, 
+                "model_name": model_name, "nb_epoch_sentences": nb_epoch_sentences, 
+                "val_split": val_split, "shuffle_data": shuffle_data, "batch_size": batch_size, 
+                "end_to_end_train": end_to_end_train, "downsample": downsample, 
+                "pos_class_weight": pos_class_weight, "mask_padding": mask_padding, "seed": seed}
+
+    # draw n_trials distinct configurations from the grid
+    param_names = ["sent_dropout", "doc_dropout", "n_filters", "filters"]
+    grid = list(itertools.product(*[search_space[name] for name in param_names]))
+    random.Random(seed).shuffle(grid)
+    trials = [dict(zip(param_names, values)) for values in grid[:n_trials]]
+    for i, trial in enumerate(trials):
+        trial.update({"trial": i, "weights_path": "%s_trial%s.hdf5" % (leaderboard_path, i),
+                      "rung_weights_path": "%s_trial%s_rung.hdf5" % (leaderboard_path, i),
+                      "sentence_weights_path": "%s_trial%s_sentence.hdf5" % (leaderboard_path, i)})
+
+    leaderboard = [dict((name, trial[name]) for name in param_names + ["trial"]) for trial in trials]
+    alive, epochs_done, budget, rung = list(range(len(trials))), 0, min_epochs, 0
+    while True:
+        epochs = min(budget, max_epochs) - epochs_done
+        print("search rung %s: training %s trials for %s more epochs" % (rung, len(alive), epochs))
+        for i in alive:
+            trials[i].update({"epochs": epochs, "resume": epochs_done > 0,
+                              "best_f": leaderboard[i].get("val_f", -np.inf)})
+
+        if warm_start:
+            architectures = OrderedDict()
+            for i in alive:
+                key = (trials[i]["n_filters"], tuple(trials[i]["filters"]))
+                architectures.setdefault(key, []).append(trials[i])
+            n_chunks = max(1, n_jobs // len(architectures))
+            tasks = [(group[k::n_chunks], settings) for group in architectures.values() 
+                        for k in range(min(n_chunks, len(group)))]
+            worker = run_search_trial_group
+        else:
+            tasks = [(trials[i], settings) for i in alive]
+            worker = run_search_trial
+
+        # one fresh process per task, so that keras graphs do not pile up
+        pool = multiprocessing.Pool(n_jobs, maxtasksperchild=1)
+        try:
+            results = pool.map(worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        epochs_done += epochs
+        for trial_results in results:
+            for i, score, setup_secs in trial_results:
+                leaderboard[i].update({"rung": rung, "epochs": epochs_done, "val_f": float(score),
+                                       "setup_secs": setup_secs})
+        setup_times = [leaderboard[i]["setup_secs"] for i in alive]
+        print("rung %s: mean per-trial setup %.2f secs (total %.2f secs)" % (
+                    rung, np.mean(setup_times), np.sum(setup_times)))
+        write_leaderboard(leaderboard, leaderboard_path)
+
+        if len(alive) <= 1 or epochs_done >= max_epochs:
+            break
+
+        # successive halving: keep the best 1/eta
+        alive = sorted(alive, key=lambda i: leaderboard[i]["val_f"], reverse=True)[:max(1, len(alive) // eta)]
+        budget *= eta
+        rung += 1
+
+    best = max((leaderboard[i] for i in alive), key=lambda entry: entry["val_f"])
+    print("best configuration: %s" % best)
+    return leaderboard
 
 
 def line_search_train(data_path, wvs_path, documents=None, test_mode=False, 
@@ -86,55 +480,32 @@ def line_search_train(data_path, wvs_path, documents=None, test_mode=False,
                                 document_dropout=0.5, run_name="RSG",
                                 shuffle_data=False, n_filters=32, max_features=20000, 
                                 max_sent_len=25, max_doc_len=200,
-                                end_to_end_train=False, downsample=False):
+                                end_to_end_train=False, downsample=False,
+                                stopword=True, pos_class_weight=1, n_jobs=4,
+                                warm_start=False):
     '''
-    NOTE: at the moment this is using *all* training data; obviously need to set 
-    aside the actual test fold (as we did for the paper experiments in Theano
-    implementation). 
+    search over the sentence dropout only (num_steps values in sent_dropout_range),
+    via hyperparameter_search; results are written to <run_name>-leaderboard.json/.csv.
+    For the doc-CNN only: the rationale-CNN applies no sentence dropout.
     '''
+    if model_name == "rationale-CNN":
+        raise ValueError("the rationale-CNN applies no sentence dropout; line search the doc-CNN")
 
-    # read in the docs just once. 
-    documents = read_data(path=data_path)
-    if shuffle_data: 
-        random.shuffle(documents)
-
-    perf_d = {}
-    best_so_far = -np.inf
-    sent_dropout_star = None
-    for sent_dropout in np.linspace(sent_dropout_range[0], sent_dropout_range[1], num_steps):
-        r_CNN, documents, p, X_doc, y_doc, best_performance = \
-            train_CNN_rationales_model(data_path, wvs_path, documents=documents, 
-                                test_mode=test_mode, 
-                                model_name=model_name, 
-                                nb_epoch_sentences=nb_epoch_sentences, 
-                                nb_epoch_doc=nb_epoch_doc, 
-                                val_split=val_split,
-                                sentence_dropout=float(sent_dropout),
-                                document_dropout=document_dropout, 
-                                run_name=run_name,
-                                shuffle_data=shuffle_data,
-                                max_features=max_features, 
-                                max_sent_len=max_sent_len, 
-                                max_doc_len=max_doc_len,
-                                end_to_end_train=end_to_end_train,
-                                downsample=downsample)
-        
-        perf_d[sent_dropout] = best_performance
-
-        print("\n\nbest observed validation performance with sent_dropout_rate: %s was: %s" % (
-                    sent_dropout, best_performance))
-        if best_performance > best_so_far:
-            best_so_far = best_performance
-            sent_dropout_star = sent_dropout
-
-    print ("best dropout: %s; best performance: %s" % (sent_dropout_star, best_so_far))
-
-    print("perf-d!")
-    print(perf_d)
-
+    search_space = {"sent_dropout": [float(x) for x in np.linspace(sent_dropout_range[0], sent_dropout_range[1], num_steps)],
+                    "doc_dropout": [document_dropout], 
+                    "n_filters": [n_filters], 
+                    "filters": [[1,2,3]]}
 
-    with open("perf-d.pickle", "w") as outf:
-        pickle.dump(perf_d, outf)
+    return hyperparameter_search(data_path, wvs_path, search_space=search_space, 
+                                    n_trials=num_steps, n_jobs=n_jobs, max_epochs=nb_epoch_doc,
+                                    leaderboard_path="%s-leaderboard" % run_name,
+                                    model_name=model_name, nb_epoch_sentences=nb_epoch_sentences, 
+                                    val_split=val_split, shuffle_data=shuffle_data, 
+                                    max_features=max_features, max_sent_len=max_sent_len, 
+                                    max_doc_len=max_doc_len, end_to_end_train=end_to_end_train,
+                                    downsample=downsample, stopword=stopword, 
+                                    pos_class_weight=pos_class_weight,
+                                    warm_start=warm_start)
 
 
 
@@ -149,34 +520,103 @@ def train_CNN_rationales_model(data_path, wvs_path, documents=None, test_mode=Fa
                                 end_to_end_train=False,
                                 downsample=False,
                                 stopword=True,
-                                pos_class_weight=1):
-    
-    if documents is None:
-        documents = read_data(path=data_path)
-        if shuffle_data: 
-            random.shuffle(documents)
+                                pos_class_weight=1,
+                                n_buckets=None,
+                                mask_padding=True,
+                                n_jobs=1,
+                                stream_data=False,
+                                cache_dir=None,
+                                subset_wvs=False,
+                                prefetch_depth=1,
+                                flat_sentence_pretraining=False,
+                                freeze_embeddings=False,
+                                encoder="conv2d"):
+    '''
+    encoder selects the sentence encoder layout; "conv2d" or "conv1d" (see
+    rationale_CNN.RationaleCNN).
+
+    if freeze_embeddings is True, the embedding layer is initialized with the
+    word vectors and not updated during training.
 
-    wvs = load_trained_w2v_model(path=wvs_path)
+    if flat_sentence_pretraining is True, the sentence model is pretrained on
+    individual sentences rather than on padded pseudo documents.
 
-    all_sentences = []
-    for d in documents: 
-        all_sentences.extend(d.sentences)
+    prefetch_depth is the number of epochs' (down)samples built in the 
+    background ahead of training; 0 builds each synchronously.
 
-    p = rationale_CNN.Preprocessor(max_features=max_features, 
-                                    max_sent_len=max_sent_len, 
-                                    max_doc_len=max_doc_len, 
-                                    wvs=wvs, stopword=stopword)
+    if subset_wvs is True, rather than loading all word vectors up front, 
+    the word2vec file is streamed once the vocabulary is fit, keeping only
+    the vectors we need (cached in cache_dir, if given).
 
-    # need to do this!
-    p.preprocess(all_sentences)
-    for d in documents: 
-        d.generate_sequences(p)
+    if cache_dir is given (and documents is None), the preprocessed corpus 
+    is cached there, keyed by the data file and preprocessing settings, and 
+    loaded from there on subsequent runs. Note that in this case the corpus 
+    is preprocessed (and cached) in file order, and shuffled afterwards.
+    '''
+    cache_path = None
+    if cache_dir is not None and documents is None:
+        cache_path = os.path.join(cache_dir, 
+                        corpus_cache_key(data_path, max_features, max_sent_len, max_doc_len, stopword,
+                                         order="file" if stream_data else "doc_id"))
+
+    wvs = None
+    if not subset_wvs:
+        wvs = load_trained_w2v_model(path=wvs_path)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        print("loading preprocessed corpus from cache: %s" % cache_path)
+        documents, p = load_corpus_cache(cache_path, wvs=wvs)
+        if shuffle_data: 
+            random.shuffle(documents)
+    else:
+        p = rationale_CNN.Preprocessor(max_features=max_features, 
+                                        max_sent_len=max_sent_len, 
+                                        max_doc_len=max_doc_len, 
+                                        wvs=wvs, stopword=stopword)
+
+        if documents is None and stream_data:
+            # two passes over the file, neither of which holds the raw corpus:
+            # fit the vocabulary, then build each document's sequences as it
+            # is read
+            p.preprocess_stream(s for d in iter_documents(data_path) for s in d.sentences)
+            documents = []
+            for d in iter_documents(data_path):
+                d.generate_sequences(p)
+                documents.append(d)
+            if shuffle_data and cache_path is None: 
+                random.shuffle(documents)
+        else:
+            if documents is None:
+                documents = read_data(path=data_path)
+                if shuffle_data and cache_path is None: 
+                    random.shuffle(documents)
+
+            all_sentences = []
+            for d in documents: 
+                all_sentences.extend(d.sentences)
+
+            # need to do this!
+            p.preprocess(all_sentences, n_jobs=n_jobs)
+            p.generate_document_sequences(documents, n_jobs=n_jobs)
+
+        if cache_path is not None:
+            print("writing preprocessed corpus to cache: %s" % cache_path)
+            save_corpus_cache(cache_path, documents, p)
+            if shuffle_data: 
+                random.shuffle(documents)
+
+    if subset_wvs:
+        p.load_word_vectors(wvs_path, cache_dir=cache_dir)
 
     r_CNN = rationale_CNN.RationaleCNN(p, filters=[1,2,3], 
                                         n_filters=n_filters, 
                                         sent_dropout=sentence_dropout, 
                                         doc_dropout=document_dropout,
-                                        end_to_end_train=end_to_end_train)
+                                        end_to_end_train=end_to_end_train,
+                                        n_buckets=n_buckets,
+                                        mask_padding=mask_padding,
+                                        freeze_embeddings=freeze_embeddings,
+                                        encoder=encoder)
 
     ###################################
     # 1. build document model #
@@ -195,7 +635,9 @@ def train_CNN_rationales_model(data_path, wvs_path, documents=None, test_mode=Fa
         if nb_epoch_sentences > 0:
             print("pre-training sentence model for %s epochs..." % nb_epoch_sentences)
             r_CNN.train_sentence_model(documents, nb_epoch=nb_epoch_sentences, 
-                                        sent_val_split=val_split, downsample=True)
+                                        sent_val_split=val_split, downsample=True,
+                                        prefetch_depth=prefetch_depth,
+                                        flat=flat_sentence_pretraining)
             print("done.")
 
 
@@ -214,7 +656,8 @@ def train_CNN_rationales_model(data_path, wvs_path, documents=None, test_mode=Fa
                                 batch_size=batch_size,
                                 doc_val_split=val_split, 
                                 pos_class_weight=pos_class_weight,
-                                document_model_weights_path=doc_weights_path)
+                                document_model_weights_path=doc_weights_path,
+                                prefetch_depth=prefetch_depth)
     
 
     # load best weights back in
@@ -308,7 +751,7 @@ if __name__ == "__main__":
         action='store_true', default=False)
 
     parser.add_option('--ls', '--line-search', dest="line_search_sent_dropout",
-        help="line search over sentence dropout parameter?", 
+        help="line search over sentence dropout parameter? (doc-CNN only)", 
         action='store_true', default=False)
 
     parser.add_option('--ds', '--downsample', dest="downsample",
@@ -319,7 +762,61 @@ if __name__ == "__main__":
         help="performing stopwording?", 
         action='store_true', default=False)
 
+    parser.add_option('--nb', '--n-buckets', dest="n_buckets",
+        help="group documents into this many length buckets (default: no bucketing; RA-CNN with padding masked only)", 
+        default=None, type="int")
+
+    parser.add_option('--nm', '--no-mask-padding', dest="mask_padding",
+        help="do not mask out padded sentences in the RA-CNN document vector", 
+        action='store_false', default=True)
+
+    parser.add_option('--nj', '--n-jobs', dest="n_jobs",
+        help="number of processes to use for preprocessing (or for search trials)", 
+        default=1, type="int")
+
+    parser.add_option('--st', '--stream', dest="stream_data",
+        help="stream the data file, in two passes (assumes rows for each doc_id are contiguous; ignores n_jobs)", 
+        action='store_true', default=False)
+
+    parser.add_option('--cd', '--cache-dir', dest="cache_dir",
+        help="directory in which to cache the preprocessed corpus (default: no caching)", 
+        default=None)
+
+    parser.add_option('--sub', '--subset-wvs', dest="subset_wvs",
+        help="stream the word vectors file, keeping only in-vocabulary vectors", 
+        action='store_true', default=False)
+
+    parser.add_option('--pd', '--prefetch-depth', dest="prefetch_depth",
+        help="number of epochs of (down)sampled data to build ahead of training (0: no prefetching)", 
+        default=1, type="int")
+
+    parser.add_option('--fsp', '--flat-sentence-pretraining', dest="flat_sentence_pretraining",
+        help="pretrain the sentence model on individual sentences, rather than pseudo documents?", 
+        action='store_true', default=False)
+
+    parser.add_option('--fe', '--freeze-embeddings', dest="freeze_embeddings",
+        help="keep the (pretrained) word embeddings fixed during training?", 
+        action='store_true', default=False)
+
+    parser.add_option('--enc', '--encoder', dest="encoder",
+        help="sentence encoder; one of {conv2d, conv1d}", 
+        default="conv2d")
+
+    parser.add_option('--search', dest="search",
+        help="search over dropout rates, number of filters and filter sizes (with successive halving)?", 
+        action='store_true', default=False)
+
+    parser.add_option('--nt', '--n-trials', dest="n_trials",
+        help="number of configurations to try in the hyperparameter search", 
+        default=20, type="int")
+
+    parser.add_option('--ws', '--warm-start', dest="warm_start",
+        help="reuse built models across search trials that share an architecture?", 
+        action='store_true', default=False)
+
     (options, args) = parser.parse_args()
+    if options.line_search_sent_dropout and options.model == "rationale-CNN":
+        parser.error("--line-search applies to the doc-CNN only (the rationale-CNN applies no sentence dropout)")
   
     config = configparser.ConfigParser()
     print("reading config file: %s" % options.inifile)
@@ -329,7 +826,29 @@ if __name__ == "__main__":
 
     print("running model: %s" % options.model)
 
-    if not options.line_search_sent_dropout:
+    if options.search:
+        print("searching!")
+        hyperparameter_search(data_path, wv_path, n_trials=options.n_trials, 
+                                    n_jobs=options.n_jobs,
+                                    max_epochs=options.document_nb_epochs,
+                                    leaderboard_path="%s-leaderboard" % options.run_name,
+                                    cache_dir=options.cache_dir or "search_cache",
+                                    model_name=options.model, 
+                                    nb_epoch_sentences=options.sentence_nb_epochs,
+                                    val_split=options.val_split,
+                                    shuffle_data=options.shuffle_data,
+                                    max_sent_len=options.max_sent_len,
+                                    max_doc_len=options.max_doc_len,
+                                    max_features=options.max_features,
+                                    batch_size=options.batch_size,
+                                    end_to_end_train=options.end_to_end_train,
+                                    downsample=options.downsample,
+                                    stopword=options.stopword,
+                                    pos_class_weight=options.pos_class_weight,
+                                    mask_padding=options.mask_padding,
+                                    warm_start=options.warm_start)
+
+    elif not options.line_search_sent_dropout:
         r_CNN, documents, p = train_CNN_rationales_model(
                                     data_path, wv_path, 
                                     model_name=options.model, 
@@ -349,10 +868,17 @@ if __name__ == "__main__":
                                     end_to_end_train=options.end_to_end_train, 
                                     downsample=options.downsample,
                                     stopword=options.stopword,
-                                    pos_class_weight=options.pos_class_weight)
-        
-    
-        import pdb; pdb.set_trace() 
+                                    pos_class_weight=options.pos_class_weight,
+                                    n_buckets=options.n_buckets,
+                                    mask_padding=options.mask_padding,
+                                    n_jobs=options.n_jobs,
+                                    stream_data=options.stream_data,
+                                    cache_dir=options.cache_dir,
+                                    subset_wvs=options.subset_wvs,
+                                    prefetch_depth=options.prefetch_depth,
+                                    flat_sentence_pretraining=options.flat_sentence_pretraining,
+                                    freeze_embeddings=options.freeze_embeddings,
+                                    encoder=options.encoder)
 
         # drop word embeddings before we pickle -- we don't need these
         # because embedding weights are already there.
@@ -360,6 +886,9 @@ if __name__ == "__main__":
         with open("preprocessor.pickle", 'wb') as outf: 
             pickle.dump(p, outf)
 
+        # ... and the same, as a single file (see model_bundle)
+        r_CNN.save_bundle("%s_%s.bundle" % (options.model, options.run_name))
+
 
         # sanity check!
         #doc0 = documents[0]
@@ -385,4 +914,6 @@ if __name__ == "__main__":
                                     end_to_end_train=options.end_to_end_train,
                                     downsample=options.downsample,
                                     stopword=options.stopword,
-                                    pos_class_weight=options.pos_class_weight)
+                                    pos_class_weight=options.pos_class_weight,
+                                    n_jobs=options.n_jobs,
+                                    warm_start=options.warm_start)